@@ -0,0 +1,44 @@
+# Lookup tables for the byte ALU ops, used by machines built with
+# alu_tables=True. Binary ops are indexed by carry << 16 | a << 8 | b and unary
+# ops by a. Each entry is the result followed by the flags the op sets, in the
+# order the handlers assign them: (res, carry, overflow, sign, zero) for
+# arithmetic and (res, carry, overflow) for shifts. The word NOT and shifts
+# chain two byte lookups; the tables for the shifts' second byte are indexed
+# by c << 8 | a, where c is the bit that the first byte passes on. Word
+# arithmetic stays on the integer handlers, which two lookups don't beat.
+
+def arith_entry(total, overflow):
+    res = total & 0xff
+    return (res, total != res, overflow, res >= 0x80, res == 0)
+
+def shared(entries):
+    """entries, with equal tuples replaced by one copy."""
+    seen = {}
+    return [seen.setdefault(e, e) for e in entries]
+
+class AluTables:
+    def __init__(self):
+        operands = [(c, a, b) for c in range(2) for a in range(256) for b in range(256)]
+        self.add = shared([arith_entry(a + b + c, c == 1) for c, a, b in operands])
+        self.sub = shared([arith_entry(a - b - c, c == 1) for c, a, b in operands])
+        self.inc = [arith_entry(a + 1, True) for a in range(256)]
+        self.dec = [arith_entry(a - 1, True) for a in range(256)]
+        self.neg = [arith_entry((~a & 0xff) + 1, True) for a in range(256)]
+        self.shl = [((a << 1) & 0xff, a >= 0x80, ((a << 1) & 0xff ^ a) >= 0x80) for a in range(256)]
+        self.sar = [(a >> 1 | a & 0x80, a & 1 == 1, False) for a in range(256)]
+        self.shr = [(a >> 1, a & 1 == 1, a >= 0x80) for a in range(256)]
+        self.not_ = bytes(~a & 0xff for a in range(256))
+        # High byte of SHLW, taking the low byte's top bit, and low byte of
+        # SHRW and SARW, taking the high byte's bottom bit
+        self.shl_in = [((a << 1 | c) & 0xff, a >= 0x80, ((a << 1) & 0xff ^ a) >= 0x80)
+                       for c in range(2) for a in range(256)]
+        self.shr_in = [(a >> 1 | c << 7, a & 1 == 1, a >= 0x80) for c in range(2) for a in range(256)]
+
+_tables = None
+
+def alu_tables():
+    """The tables, built on first use and shared by all machines."""
+    global _tables
+    if _tables is None:
+        _tables = AluTables()
+    return _tables
@@ -0,0 +1,63 @@
+import unittest
+import random
+import pptvm
+
+def machine_state(m):
+    return bytes(m.regfile), [getattr(m.flags, f) for f in pptvm.FLAG_NAMES]
+
+class TestAluTables(unittest.TestCase):
+    def setUp(self):
+        self.reference = pptvm.MachineState([])
+        self.tables = pptvm.MachineState([], alu_tables=True)
+
+    def check(self, op, regs, flags):
+        """Runs op on both machines from the same registers and flags."""
+        results = []
+        for m, prefix in [(self.reference, 'exec_'), (self.tables, 'alu_exec_')]:
+            m.regfile[:] = regs
+            for f, value in zip(pptvm.FLAG_NAMES, flags):
+                setattr(m.flags, f, value)
+            getattr(m, prefix + op)()
+            results.append(machine_state(m))
+        self.assertEqual(results[0], results[1], (op, regs.hex(), flags))
+
+    def test_byte_ops_exhaustively(self):
+        # ADCB and SBBB cover every entry of the add and sub tables, which
+        # ADDB, SUBB and CMPB look up with a carry of 0
+        rng = random.Random(0)
+        regs = bytearray(len(pptvm.REG_NAMES))
+        for op in ['adcb', 'sbbb', 'addb', 'subb', 'cmpb', 'incb', 'decb', 'negb', 'notb', 'shlb', 'sarb', 'shrb']:
+            binary = op in ['adcb', 'sbbb']
+            for carry in [False, True]:
+                for a in range(256):
+                    for b in range(256) if binary else rng.sample(range(256), 4):
+                        regs[pptvm.R_M1L] = a
+                        regs[pptvm.R_M2L] = b
+                        regs[pptvm.R_M3L] = rng.randrange(256)
+                        flags = [rng.random() < 0.5 for f in pptvm.FLAG_NAMES]
+                        flags[1] = carry
+                        self.check(op, bytes(regs), flags)
+
+    def test_word_ops(self):
+        rng = random.Random(0)
+        edges = [0, 1, 0x7f, 0x80, 0xff, 0x100, 0x7fff, 0x8000, 0xfffe, 0xffff]
+        words = edges + [rng.randrange(2**16) for i in range(200)]
+        for op in ['notw', 'shlw', 'sarw', 'shrw']:
+            for x in words:
+                for y in edges + [rng.randrange(2**16) for i in range(20)]:
+                    regs = bytearray(rng.randrange(256) for r in pptvm.REG_NAMES)
+                    regs[pptvm.R_M1H:pptvm.R_M1L + 1] = x.to_bytes(2, 'big')
+                    regs[pptvm.R_M2H:pptvm.R_M2L + 1] = y.to_bytes(2, 'big')
+                    self.check(op, bytes(regs), [rng.random() < 0.5 for f in pptvm.FLAG_NAMES])
+
+    def test_decode(self):
+        m = pptvm.MachineState([pptvm.Instruction('EXEC', ['ADDB'])], alu_tables=True)
+        m.regfile[pptvm.R_M1L] = 0xff
+        m.regfile[pptvm.R_M2L] = 0x02
+        m.step()
+        self.assertEqual(m.regfile[pptvm.R_M3L], 1)
+        self.assertTrue(m.flags.carry)
+
+
+if __name__ == '__main__':
+    unittest.main()
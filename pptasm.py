@@ -1,4 +1,5 @@
 from pptutils import *
+import os
 import json
 import argparse
 
@@ -41,7 +42,8 @@ def parse_section_labels(section_name, lines):
             labeled_regions.append(X86LabeledRegion(l[:-1], []))
     return labeled_regions
 
-def assemble_gas(file_path, output_path):
+def read_sections(file_path):
+    """The lines of each section of the .gas file at file_path."""
     with open(file_path, mode='rt') as file:
         lines = file.readlines()
         lines = [line.replace('\t', ' ').rstrip() for line in lines]
@@ -56,6 +58,15 @@ def assemble_gas(file_path, output_path):
             section_map[args[0]] = section
         else:
             section.append(l)
+    return section_map
+
+def assemble_gas(file_path, output_path, binary=False, optimize=False, extended=False):
+    """Assembles the .gas file at file_path. With optimize set, the micro-ops
+    go through pptopt's passes and the size of each function before and
+    after is returned. With extended set, stack operations, word memory
+    access and cmp or test followed by a conditional jump use the extended
+    ISA's EXEC PUSHW/POPW/CALLW/RETW/RMEMW/WMEMW and BRANCH_OPS."""
+    section_map = read_sections(file_path)
     if '_TEXT' not in section_map:
         raise Exception('No _TEXT section in assembly code')
     text_section = section_map['_TEXT']
@@ -88,19 +99,30 @@ def assemble_gas(file_path, output_path):
         PptInstruction('LOAD1L', 'M3L'),
         PptInstruction('EXEC', 'JMP'),
     ]
-    labels_to_offsets['X$0'] = len(code)
-    code += [PptInstruction('EXEC', 'HLT')]
+    code += [
+        PptInstruction('LABEL', 'X$0'),
+        PptInstruction('EXEC', 'HLT'),
+    ]
     for region in labeled_text:
-        labels_to_offsets[region.label] = len(code)
+        code += [PptInstruction('LABEL', region.label)]
         for line in region.lines:
             try:
-                new_code = code_for_line(line, len(code))
+                new_code = code_for_line(line, len(code), extended)
             except SegmentRegisterException as e:
                 print('Warning: skipping line containing segment register "%s"' % e.message)
                 continue
             new_code[0].comment = condense_spaces(line)
+            fused = fuse_branch(code[-1], new_code) if extended else None
+            if fused is not None:
+                code.pop()
+                new_code = fused
             code += new_code
 
+    sizes = None
+    if optimize:
+        import pptopt
+        code, sizes = pptopt.optimize(code)
+    code = place_labels(code, labels_to_offsets)
     for inst in code:
         if inst.cmd == 'CONSTL':
             assert inst.arg is not None
@@ -115,6 +137,14 @@ def assemble_gas(file_path, output_path):
     data = read_data_section(labeled_data, labels_to_offsets)
     const = read_data_section(labeled_const, labels_to_offsets)
 
+    if binary:
+        text = [(inst.cmd, inst.arg, inst.comment) for inst in code]
+        symbols = { region.label: labels_to_offsets[region.label] for region in labeled_text[1:] }
+        image = pack_image(text, bytes(byte_to_uint(b) for b in data), bytes(byte_to_uint(b) for b in const), symbols)
+        with open(output_path, mode='wb') as file:
+            file.write(image)
+        return sizes
+
     lines = []
     lines.append('text:')
     for i in range(len(code)):
@@ -127,11 +157,62 @@ def assemble_gas(file_path, output_path):
     lines.append('const:')
     for i in range(len(const)):
         lines.append('    ' + int_to_word(i) + '    ' + const[i])
+    lines.append('')
+    lines.append('symbols:')
+    for region in labeled_text[1:]:
+        lines.append('    ' + int_to_word(labels_to_offsets[region.label]) + '    ' + region.label)
 
     with open(output_path, mode='wt') as file:
         file.write('\n'.join(lines))
+    return sizes
     
 
+def isa_costs(file_path):
+    """Micro-ops that the .gas file at file_path assembles to with and
+    without the extended ISA, as {command: (uses, base, extended)} for the
+    commands it changes and 'total' for the whole text."""
+    def size(code):
+        return sum(inst.cmd != 'LABEL' for inst in code)
+    costs = {}
+    for region in parse_section_labels('_TEXT', read_sections(file_path).get('_TEXT', [])):
+        last = PptInstruction('LABEL', region.label)
+        for line in region.lines:
+            try:
+                base = size(code_for_line(line, 0))
+                code = code_for_line(line, 0, extended=True)
+            except SegmentRegisterException:
+                continue
+            # A fused branch also saves the compare of the line before
+            fused = fuse_branch(last, code)
+            extended = size(code) if fused is None else size(fused) - 1
+            last = code[-1]
+            cost = costs.setdefault(parse_line(line)[0], [0, 0, 0])
+            cost[0] += 1
+            cost[1] += base
+            cost[2] += extended
+    total = tuple(sum(cost[i] for cost in costs.values()) for i in range(3))
+    costs = { c: tuple(cost) for c, cost in costs.items() if cost[1] != cost[2] }
+    costs['total'] = total
+    return costs
+
+def isa_report(costs):
+    """isa_costs as text."""
+    lines = ['%-8s %6s %8s %9s %8s' % ('command', 'uses', 'base', 'extended', 'saved')]
+    for c, (uses, base, extended) in costs.items():
+        lines.append('%-8s %6d %8d %9d %8d' % (c, uses, base, extended, base - extended))
+    return '\n'.join(lines)
+
+def place_labels(code, labels_to_offsets):
+    """Drops the LABEL pseudo-instructions from code, recording the offset
+    of the instruction each one points to."""
+    result = []
+    for inst in code:
+        if inst.cmd == 'LABEL':
+            labels_to_offsets[inst.arg] = len(result)
+        else:
+            result.append(inst)
+    return result
+
 def get_label_offsets(labeled_const_or_data, initial_byte_offset):
     byte_offset = initial_byte_offset
     labels_to_offsets = {}
@@ -207,7 +288,13 @@ class SegmentRegisterException(Exception):
     def __init__(self, message):
         self.message = message
 
-def code_for_line(line, offset):
+def code_for_line(line, offset, extended=False):
+    code = code_for_inst(line, offset, extended)
+    if extended:
+        code = widen_memory_ops(code)
+    return code
+
+def code_for_inst(line, offset, extended=False):
     inst, args = parse_line(line)
     cmd = inst.upper()
     size = 'b' if inst[-1] == 'b' else 'w'
@@ -232,19 +319,10 @@ def code_for_line(line, offset):
         return code_for_binary_cmd_b(parse_args(), cmd)
     if cmd in nullary_commands:
         return [PptInstruction('EXEC', cmd)]
-    if cmd.startswith('J') and cmd[1:] in cond_jmp_suffixes:
-        return code_for_cond_jmp(parse_args(True), cmd)
-    if cmd.startswith('J') and cmd[1:] in cond_jump_suffix_map:
-        suffix = cond_jump_suffix_map[cmd[1:]]
-        return code_for_cond_jmp(parse_args(True), 'J' + suffix)
-    if cmd.startswith('JN') and cmd[2:] in cond_jmp_suffixes:
-        return code_for_cond_jmp(parse_args(True), cmd)
-    if cmd.startswith('JN') and cmd[2:] in cond_jump_suffix_map:
-        suffix = cond_jump_suffix_map[cmd[2:]]
-        if suffix.startswith('N'):
-            return code_for_cond_jmp(parse_args(True), 'J' + suffix[1:])
-        else:
-            return code_for_cond_jmp(parse_args(True), 'JN' + suffix)
+    if cond_jmp_cmd(cmd) is not None:
+        return code_for_cond_jmp(parse_args(True), cond_jmp_cmd(cmd))
+    if extended and 'code_for_ext_' + inst in globals():
+        return globals()['code_for_ext_' + inst](parse_args(cmd in cmds_with_branch_ops))
     if cmd == 'CALL':
         return code_for_cmd_call(parse_args(True), offset)
     key = 'code_for_cmd_' + inst
@@ -832,6 +910,23 @@ def code_for_cond_jmp(inst_operands, cmd='JNE'):
     code += [PptInstruction('EXEC', 'JV')]
     return code
 
+def cond_jmp_cmd(cmd):
+    """The conditional jump cmd as J or JN and one of cond_jmp_suffixes,
+    or None if it is not a conditional jump."""
+    if cmd.startswith('J') and cmd[1:] in cond_jmp_suffixes:
+        return cmd
+    if cmd.startswith('J') and cmd[1:] in cond_jump_suffix_map:
+        return 'J' + cond_jump_suffix_map[cmd[1:]]
+    if cmd.startswith('JN') and cmd[2:] in cond_jmp_suffixes:
+        return cmd
+    if cmd.startswith('JN') and cmd[2:] in cond_jump_suffix_map:
+        suffix = cond_jump_suffix_map[cmd[2:]]
+        if suffix.startswith('N'):
+            return 'J' + suffix[1:]
+        else:
+            return 'JN' + suffix
+    return None
+
 cond_jmp_suffixes = ['A', 'C', 'Z', 'O', 'S', 'G', 'L']
 
 cond_jump_suffix_map = {
@@ -939,7 +1034,10 @@ def code_for_cmd_call(inst_operands, offset=0):
         ]
 
     code = []
-    i = Immediate(offset, size='w')
+    # The return address is a label placed after the JMP, so that it stays
+    # right when passes like the peephole optimizer move code around
+    return_label = 'R$%d' % offset
+    i = Immediate(0, size='w', label=return_label)
     if dst.type == 'MEM':
         code += code_to_calc_address_if_needed(inst_operands, write_to_dst=False)
         code += code_for_read_w(dst, reg='3')
@@ -973,8 +1071,8 @@ def code_for_cmd_call(inst_operands, offset=0):
         code += code_for_read_w(dst, reg='1')
     code += [
         PptInstruction('EXEC', 'JMP'),
+        PptInstruction('LABEL', return_label),
     ]
-    i.offset += len(code)
     return code
 
 def code_for_cmd_ret(inst_operands):
@@ -1014,6 +1112,92 @@ def code_for_cmd_ret(inst_operands):
     ]
     return code
 
+# Extended ISA: stack operations as the single EXEC PUSHW, POPW, CALLW and
+# RETW ops, word memory access with RMEMW and WMEMW and compare-and-branch
+# ops for a cmp or test and the conditional jump after it, which pptvm runs
+# but the PowerPoint CPU has no slides for. PUSHW and CALLW take their
+# operand in M1 and POPW leaves the word in M3.
+
+def parse_ops(text):
+    return [tuple(op.split()) for op in text.split('|')]
+
+# The byte by byte word reads of code_for_read_w (into M3, M1 or M2) and
+# writes of code_for_write_w, and the word-wide RMEMW/WMEMW forms they
+# become. The scratch registers left different (mp, M5, M2L, and M1 after
+# a read into M3) are not read again by the rest of a line.
+WORD_MEMORY_OPS = [(parse_ops(pattern), parse_ops(replacement)) for pattern, replacement in [
+    ('EXEC SMP|EXEC RMEM|STOREL M5L|EXEC IMP|EXEC RMEM|STOREL M5H|LOAD1H M5H|LOAD1L M5L|COPYH|COPYL',
+     'EXEC SMP|EXEC RMEMW'),
+    ('EXEC SMP|EXEC RMEM|STOREL M5L|EXEC IMP|EXEC RMEM|LOAD1H M3L|LOAD1L M5L',
+     'EXEC SMP|EXEC RMEMW|LOAD1H M3H|LOAD1L M3L'),
+    ('EXEC SMP|EXEC RMEM|STOREL M5L|EXEC IMP|EXEC RMEM|LOAD2H M3L|LOAD2L M5L',
+     'EXEC SMP|EXEC RMEMW|LOAD2H M3H|LOAD2L M3L'),
+    ('LOAD2L M3L|EXEC SMP|EXEC WMEM|EXEC IMP|LOAD2L M3H|EXEC WMEM',
+     'EXEC SMP|EXEC WMEMW'),
+]]
+
+def widen_memory_ops(code):
+    """code with its word reads and writes done by RMEMW and WMEMW."""
+    result = []
+    i = 0
+    while i < len(code):
+        for pattern, replacement in WORD_MEMORY_OPS:
+            window = [(inst.cmd,) if inst.arg is None else (inst.cmd, inst.arg) for inst in code[i:i + len(pattern)]]
+            if window == pattern:
+                result += [PptInstruction(*op) for op in replacement]
+                i += len(pattern)
+                break
+        else:
+            result.append(code[i])
+            i += 1
+    return result
+
+def code_for_ext_pushw(inst_operands):
+    code = code_to_calc_address_if_needed(inst_operands, write_to_dst=False)
+    code += code_for_read_w(inst_operands[0], reg='1')
+    code += [PptInstruction('EXEC', 'PUSHW')]
+    return code
+
+def code_for_ext_popw(inst_operands):
+    code = code_to_calc_address_if_needed(inst_operands)
+    code += [PptInstruction('EXEC', 'POPW')]
+    code += code_for_write_w(inst_operands[0])
+    return code
+
+def code_for_ext_call(inst_operands):
+    dst = inst_operands[0]
+    if dst.type == 'IMM' and dst.immediate.label in builtin_commands_map:
+        return code_for_cmd_call(inst_operands)
+    code = code_to_calc_address_if_needed(inst_operands, write_to_dst=False)
+    code += code_for_read_w(dst, reg='1')
+    code += [PptInstruction('EXEC', 'CALLW')]
+    return code
+
+def code_for_ext_ret(inst_operands):
+    if inst_operands:
+        # RETW can't also release the arguments
+        return code_for_cmd_ret(inst_operands)
+    return [PptInstruction('EXEC', 'RETW')]
+
+def fuse_branch(compare, jump):
+    """A cmp or test line ending in the instruction compare, followed by the
+    code of a conditional jump, as a single compare-and-branch op (see
+    BRANCH_OPS) with the jump target in M3. Returns the code that replaces
+    compare and jump, or None if they can't be fused."""
+    if not jump or compare.cmd != 'EXEC' or compare.arg not in ['CMPB', 'CMPW', 'TESTB', 'TESTW']:
+        return None
+    ops = [(inst.cmd, inst.arg) for inst in jump]
+    negate = ops[1:2] == [('EXEC', 'NV')]
+    verdict, target = ops[0], ops[1 + negate:3 + negate]
+    if (verdict[0] != 'EXEC' or verdict[1][0] != 'V' or verdict[1][1:] not in cond_jmp_suffixes or
+            [cmd for cmd, arg in target] != ['CONSTH', 'CONSTL'] or
+            ops[3 + negate:] != [('LOAD1H', 'M3H'), ('LOAD1L', 'M3L'), ('EXEC', 'JV')]):
+        return None
+    code = [PptInstruction(cmd, arg) for cmd, arg in target]
+    code += [PptInstruction('EXEC', compare.arg + 'J' + 'N' * negate + verdict[1][1:])]
+    code[0].comment = jump[0].comment
+    return code
+
 builtin_commands_map = {
     'ppt_puts_': 'PUTS',
     'ppt_putint_': 'PUTINT',
@@ -1029,7 +1213,6 @@ builtin_commands_map = {
 #       PUSH, POP, CALL, RET
 
 #parse_masm('mytest.masm')
-assemble_gas('mytest.gas', 'mytest2.pptasm')
 #testline = 'cmpb $0x48,%al'
 #code = code_for_line(testline, 0)
 #print(code[0].arg.to_binary({}))
@@ -1037,9 +1220,21 @@ assemble_gas('mytest.gas', 'mytest2.pptasm')
 
 
 if __name__ == '__main__':
-    exit(0)
     parser = argparse.ArgumentParser(description='Convert .gas to .pptasm files')
     parser.add_argument('file', help='.gas file to assemble', type=str)
+    parser.add_argument('-o', '--output', help='file to write (default: file with .pptasm or .pptbin extension)', type=str)
+    parser.add_argument('--binary', help='write a binary image instead of text', action='store_true')
+    parser.add_argument('-O', '--optimize', help='optimize the micro-ops and report the savings', action='store_true')
+    parser.add_argument('--extended', help='use the extended ISA (EXEC PUSHW/POPW/CALLW/RETW/RMEMW/WMEMW and '
+                        'compare-and-branch ops), which only pptvm runs',
+                        action='store_true')
+    parser.add_argument('--isa-report', help='compare the cost of the code with and without the extended ISA',
+                        action='store_true')
     args = parser.parse_args()
-    args.file
-    assemble_gas(args.file, 'mytest3.pptasm')
+    if args.isa_report:
+        print(isa_report(isa_costs(args.file)))
+    output = args.output or os.path.splitext(args.file)[0] + ('.pptbin' if args.binary else '.pptasm')
+    sizes = assemble_gas(args.file, output, args.binary, args.optimize, args.extended)
+    if sizes is not None:
+        import pptopt
+        print(pptopt.report(sizes))
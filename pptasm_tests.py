@@ -0,0 +1,121 @@
+import unittest
+import tempfile
+import os
+import io
+import pptvm
+import pptasm
+import pptlockstep
+from ppttestutils import PRIMES_GAS
+
+# Sums fib(0) to fib(9), kept in a global array, through a function
+# pointer, then prints the sum and fib(9)
+MEMORY_GAS = '''.387
+.new_section _TEXT, "crx4"
+sum_:
+    pushw %bp
+    movw %sp,%bp
+    movw 0x4(%bp),%ax
+    addw total,%ax
+    movw %ax,total
+    popw %bp
+    ret
+main_:
+    movw $0x1,fibs+0x2
+    movw $0x4,%si
+L$1:
+    movw fibs-0x4(%si),%ax
+    addw fibs-0x2(%si),%ax
+    movw %ax,fibs(%si)
+    addw $0x2,%si
+    cmpw $0x14,%si
+    jl L$1
+    xorw %si,%si
+L$2:
+    pushw fibs(%si)
+    call *sumptr
+    popw %ax
+    addw $0x2,%si
+    cmpw $0x14,%si
+    jl L$2
+    pushw total
+    popw result
+    movw result,%ax
+    call ppt_putint_
+    movw fibs+0x12,%ax
+    call ppt_putint_
+    xorw %ax,%ax
+    ret
+.new_section _DATA, "drw2"
+fibs:
+    .word 0x0,0x0,0x0,0x0,0x0,0x0,0x0,0x0,0x0,0x0
+total:
+    .word 0x0
+result:
+    .word 0x0
+sumptr:
+    .word sum_
+'''
+
+class TestExtendedIsa(unittest.TestCase):
+    def test_assemble(self):
+        with tempfile.TemporaryDirectory() as d:
+            source = os.path.join(d, 'primes.gas')
+            with open(source, 'wt') as f:
+                f.write(PRIMES_GAS)
+            runs = []
+            for extended in [False, True]:
+                path = os.path.join(d, 'primes%d.pptasm' % extended)
+                pptasm.assemble_gas(source, path, extended=extended)
+                for jit in [False, True]:
+                    m = pptvm.load_file(path, io=pptvm.IOChannel(out=io.StringIO()), jit=jit)
+                    result = m.run()
+                    self.assertEqual(result.status, pptvm.HALTED)
+                    runs.append((m.io.out.getvalue(), len(m.instructions), result.steps))
+            self.assertEqual(runs[1], runs[0])
+            self.assertEqual(runs[3], runs[2])
+            self.assertEqual(runs[2][0], runs[0][0])
+            self.assertLess(runs[2][1], runs[0][1])
+            self.assertLess(runs[2][2], runs[0][2])
+            self.assertIn('EXEC    CALLW', open(path).read())
+            # cmpw $0x1e,%bx then jl L$6
+            self.assertIn('EXEC    CMPWJL', open(path).read())
+            if pptlockstep.np is not None:
+                machines = pptlockstep.LockstepMachines(pptvm.load_file(path), 2)
+                self.assertEqual([r.steps for r in machines.run()], [runs[2][2]] * 2)
+                self.assertEqual(machines.output(1), runs[0][0])
+
+            costs = pptasm.isa_costs(source)
+            self.assertEqual(costs['pushw'], (4, 52, 12))
+            self.assertEqual(costs['ret'], (2, 24, 2))
+            self.assertEqual(costs['jge'], (1, 7, 2))
+            self.assertEqual(costs['total'][1] - costs['total'][2], runs[0][1] - runs[2][1])
+            self.assertIn('popw', pptasm.isa_report(costs))
+
+    def test_word_memory(self):
+        with tempfile.TemporaryDirectory() as d:
+            source = os.path.join(d, 'fib.gas')
+            with open(source, 'wt') as f:
+                f.write(MEMORY_GAS)
+            runs = []
+            for extended in [False, True]:
+                path = os.path.join(d, 'fib%d.pptasm' % extended)
+                pptasm.assemble_gas(source, path, extended=extended)
+                for jit in [False, True]:
+                    m = pptvm.load_file(path, io=pptvm.IOChannel(out=io.StringIO()), jit=jit)
+                    result = m.run()
+                    self.assertEqual((result.status, m.io.out.getvalue()), (pptvm.HALTED, '8834'))
+                    runs.append((result.steps, set(i.args[0] for i in m.instructions if i.cmd == 'EXEC')))
+            self.assertLess(runs[2][0], runs[0][0])
+            self.assertEqual(runs[3][0], runs[2][0])
+            self.assertTrue({'RMEMW', 'WMEMW'} <= runs[2][1])
+            self.assertNotIn('RMEMW', runs[0][1])
+            if pptlockstep.np is not None:
+                machines = pptlockstep.LockstepMachines(pptvm.load_file(path), 2)
+                self.assertEqual([r.steps for r in machines.run()], [runs[2][0]] * 2)
+                self.assertEqual(machines.output(0), '8834')
+            movw = pptasm.isa_costs(source)['movw']
+            self.assertGreater(movw[1], movw[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
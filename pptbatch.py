@@ -0,0 +1,111 @@
+import io
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+import pptvm
+import pptasm
+import ppttrace
+
+PROGRAM_EXTENSIONS = ('.pptasm', '.pptbin', '.gas')
+
+LOAD_ERROR = 'load error'
+
+def find_programs(paths):
+    """The program files among paths, searching directories recursively."""
+    programs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                programs += [os.path.join(root, f) for f in sorted(files) if f.endswith(PROGRAM_EXTENSIONS)]
+        else:
+            programs.append(path)
+    return programs
+
+def stdin_for(program, default=''):
+    """Scripted stdin of a program: the file next to it with the extension
+    .in if there is one, otherwise default."""
+    path = os.path.splitext(program)[0] + '.in'
+    if not os.path.exists(path):
+        return default
+    with open(path, mode='rt') as file:
+        return file.read()
+
+def load_program(path, **kwargs):
+    """Loads a .pptasm or .pptbin file, assembling .gas files first."""
+    if not path.endswith('.gas'):
+        return pptvm.load_file(path, **kwargs)
+    with tempfile.TemporaryDirectory() as d:
+        output = os.path.join(d, 'program.pptbin')
+        pptasm.assemble_gas(path, output, binary=True)
+        return pptvm.load_file(output, **kwargs)
+
+def run_program(path, stdin='', max_steps=None, jit=False, seed=0, trace=0):
+    """Runs one program with stdin as its input. Returns a dict with the
+    program's stdout, how it stopped and how long it took, and if trace is
+    set and it faulted, the last trace steps before the fault."""
+    start = time.perf_counter()
+    stdout = io.StringIO()
+    channel = pptvm.IOChannel(out=stdout, inp=io.StringIO(stdin))
+    try:
+        vm = load_program(path, jit=jit, io=channel)
+    except Exception as e:
+        return { 'program': path, 'status': LOAD_ERROR, 'steps': 0, 'ip': None, 'error': repr(e),
+                 'trace': None, 'stdout': '', 'seconds': time.perf_counter() - start }
+    # trace goes from the number of steps to keep to the Trace keeping them
+    trace = ppttrace.Trace(vm, trace) if trace else None
+    vm.rng = random.Random(seed)
+    result = vm.run(max_steps)
+    return { 'program': path, 'status': result.status, 'steps': result.steps, 'ip': result.ip,
+             'error': None if result.error is None else repr(result.error),
+             'trace': trace.dump() if trace is not None and result.status == pptvm.FAULT else None,
+             'stdout': stdout.getvalue(), 'seconds': time.perf_counter() - start }
+
+def run_job(job):
+    return run_program(*job)
+
+def run_batch(programs, jobs=None, stdin='', max_steps=None, jit=False, seed=0, trace=0):
+    """Runs programs on a pool of jobs processes (one per core by default)
+    and yields their results in order. Each program reads its .in file, or
+    stdin if it has none."""
+    job_args = [(p, stdin_for(p, stdin), max_steps, jit, seed, trace) for p in programs]
+    if jobs == 1:
+        yield from map(run_job, job_args)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        yield from pool.imap(run_job, job_args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run many .pptasm, .pptbin or .gas programs in parallel')
+    parser.add_argument('paths', help='programs, or directories to search for them', type=str, nargs='+')
+    parser.add_argument('-j', '--jobs', help='number of worker processes (default: one per core)', type=int)
+    parser.add_argument('--stdin', help='input for programs without a .in file', type=str)
+    parser.add_argument('--max-steps', help='stop each program after this many micro-ops', type=int)
+    parser.add_argument('--jit', help='compile basic blocks to Python functions', action='store_true')
+    parser.add_argument('--seed', help='seed for RAND', type=int, default=0)
+    parser.add_argument('--trace', help='report the last N steps of programs that fault', type=int, default=0, metavar='N')
+    parser.add_argument('--json', help='write all results, including stdout, to this JSON file', type=str)
+    args = parser.parse_args()
+    stdin = ''
+    if args.stdin:
+        with open(args.stdin, mode='rt') as file:
+            stdin = file.read()
+    results = []
+    for r in run_batch(find_programs(args.paths), args.jobs, stdin, args.max_steps, args.jit, args.seed, args.trace):
+        results.append(r)
+        print('%-16s %12d %8.2fs  %s' % (r['status'], r['steps'], r['seconds'], r['program']))
+        if r['error'] is not None:
+            print('    %s at ip %s' % (r['error'], r['ip']))
+        if r['trace'] is not None:
+            print(r['trace'])
+    if args.json:
+        with open(args.json, mode='wt') as file:
+            json.dump(results, file, indent=1)
+    failed = [r for r in results if r['status'] in (pptvm.FAULT, LOAD_ERROR)]
+    print('%d programs, %d failed' % (len(results), len(failed)))
+    exit(1 if failed else 0)
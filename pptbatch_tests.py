@@ -0,0 +1,64 @@
+import unittest
+import tempfile
+import random
+import os
+import pptvm
+import pptbatch
+
+# Reads an int and prints it twice
+ECHO_PROGRAM = '''text:
+    0000000000000000    EXEC    GETINT
+    0000000000000001    EXEC    PUTINT
+    0000000000000010    EXEC    PUTINT
+    0000000000000011    EXEC    HLT
+
+data:
+
+const:
+'''
+
+class TestBatch(unittest.TestCase):
+    def test_run_batch(self):
+        with tempfile.TemporaryDirectory() as d:
+            for name in ['a', 'b', 'c']:
+                with open(os.path.join(d, name + '.pptasm'), 'wt') as f:
+                    f.write(ECHO_PROGRAM)
+            with open(os.path.join(d, 'a.in'), 'wt') as f:
+                f.write('-12\n')
+            with open(os.path.join(d, 'notes.txt'), 'wt') as f:
+                f.write('not a program')
+            programs = pptbatch.find_programs([d])
+            self.assertEqual([os.path.basename(p) for p in programs], ['a.pptasm', 'b.pptasm', 'c.pptasm'])
+            for jobs in [1, 2]:
+                results = list(pptbatch.run_batch(programs, jobs=jobs, stdin='7\n'))
+                self.assertEqual([r['stdout'] for r in results], ['-12-12', '77', '77'])
+                self.assertEqual([r['status'] for r in results], [pptvm.HALTED] * 3)
+                self.assertEqual(results[0]['steps'], 4)
+
+    def test_fault(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.pptasm')
+            with open(path, 'wt') as f:
+                f.write(ECHO_PROGRAM)
+            result = pptbatch.run_program(path, stdin='')
+            self.assertEqual((result['status'], result['ip']), (pptvm.FAULT, 0))
+            self.assertIn('EOFError', result['error'])
+            result = pptbatch.run_program(os.path.join(d, 'missing.pptasm'))
+            self.assertEqual(result['status'], pptbatch.LOAD_ERROR)
+
+    def test_seed(self):
+        # RAND follows the seed, without touching the caller's random state
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.pptasm')
+            with open(path, 'wt') as f:
+                f.write(ECHO_PROGRAM.replace('GETINT', 'RAND  '))
+            random.seed(5)
+            state = random.getstate()
+            outputs = [pptbatch.run_program(path, seed=seed)['stdout'] for seed in [1, 2, 1]]
+            self.assertEqual(random.getstate(), state)
+            self.assertEqual(outputs[0], outputs[2])
+            self.assertNotEqual(outputs[0], outputs[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import io
+import os
+import sys
+import json
+import random
+import argparse
+import collections
+import pptvm
+import pptbatch
+
+class Variant:
+    """Scripted input and RAND seed for one forked continuation."""
+    def __init__(self, stdin='', seed=0):
+        self.stdin = stdin
+        self.seed = seed
+
+def run_prefix(vm, until_ip=None, stdin=''):
+    """Runs vm with stdin as its input until ip becomes until_ip, or until
+    an input op finds no more input, leaving it on that op."""
+    wait = vm.io.wait
+    vm.io.wait = True
+    vm.io.feed(stdin)
+    try:
+        return vm.run(until_ip=until_ip)
+    finally:
+        vm.io.wait = wait
+
+def run_variant(vm, variant, max_steps):
+    stdout = io.StringIO()
+    vm.io = pptvm.IOChannel(out=stdout, inp=io.StringIO(variant.stdin))
+    random.seed(variant.seed)
+    result = vm.run(max_steps)
+    return { 'seed': variant.seed, 'status': result.status, 'steps': result.steps, 'ip': result.ip,
+             'error': None if result.error is None else repr(result.error), 'stdout': stdout.getvalue() }
+
+def fork_variant(vm, variant, max_steps):
+    """Forks a child that continues vm with variant and writes its result to
+    a pipe as JSON. Returns the child's pid and the pipe's read end."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            try:
+                result = run_variant(vm, variant, max_steps)
+            except BaseException as e:
+                result = { 'seed': variant.seed, 'status': pptvm.FAULT, 'steps': 0, 'ip': vm.ip,
+                           'error': repr(e), 'stdout': '' }
+            with os.fdopen(w, 'w') as pipe:
+                json.dump(result, pipe)
+        finally:
+            os._exit(0)
+    os.close(w)
+    return pid, r
+
+def collect(pid, r):
+    with os.fdopen(r, 'r') as pipe:
+        text = pipe.read()
+    os.waitpid(pid, 0)
+    if not text:
+        raise Exception('Fork %d exited without a result' % pid)
+    return json.loads(text)
+
+def run_forks(vm, variants, max_steps=None, jobs=None):
+    """Continues vm from its current state once per variant, each in a
+    copy-on-write child process, at most jobs (one per core by default) at a
+    time. vm itself is left as it was. Returns the results in order."""
+    jobs = jobs or os.cpu_count()
+    results = []
+    running = collections.deque()
+    for variant in variants:
+        if len(running) >= jobs:
+            results.append(collect(*running.popleft()))
+        running.append(fork_variant(vm, variant, max_steps))
+    while running:
+        results.append(collect(*running.popleft()))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a program to a common point, then fork a continuation per input and seed')
+    parser.add_argument('program', help='.pptasm, .pptbin or .gas program', type=str)
+    parser.add_argument('--until', help='stop the prefix at this label or ip (default: the first input it runs out of)', type=str)
+    parser.add_argument('--prefix-stdin', help='input for the prefix', type=str)
+    parser.add_argument('--stdin', help='input files for the continuations', type=str, nargs='*', default=[])
+    parser.add_argument('--seeds', help='run each input with RAND seeds 0 to N-1', type=int, default=1, metavar='N')
+    parser.add_argument('-j', '--jobs', help='number of children at once (default: one per core)', type=int)
+    parser.add_argument('--max-steps', help='stop each continuation after this many micro-ops', type=int)
+    parser.add_argument('--jit', help='compile basic blocks to Python functions', action='store_true')
+    parser.add_argument('--json', help='write all results, including stdout, to this JSON file', type=str)
+    args = parser.parse_args()
+    vm = pptbatch.load_program(args.program, jit=args.jit)
+    until_ip = None
+    if args.until is not None:
+        until_ip = vm.symbols[args.until] if args.until in vm.symbols else int(args.until, 0)
+    prefix_stdin = ''
+    if args.prefix_stdin:
+        with open(args.prefix_stdin, mode='rt') as file:
+            prefix_stdin = file.read()
+    result = run_prefix(vm, until_ip, prefix_stdin)
+    print('prefix: %s after %d steps at ip %d' % (result.status, result.steps, result.ip))
+    if result.status in (pptvm.FAULT, pptvm.HALTED):
+        exit(1)
+    inputs = []
+    for path in args.stdin or [None]:
+        if path is None:
+            inputs.append(('', ''))
+            continue
+        with open(path, mode='rt') as file:
+            inputs.append((path, file.read()))
+    variants = [Variant(stdin, seed) for path, stdin in inputs for seed in range(args.seeds)]
+    names = ['%s seed %d' % (path, seed) for path, stdin in inputs for seed in range(args.seeds)]
+    results = run_forks(vm, variants, args.max_steps, args.jobs)
+    for name, r in zip(names, results):
+        print('%-16s %12d  %s' % (r['status'], r['steps'], name.strip()))
+        if r['error'] is not None:
+            print('    %s at ip %s' % (r['error'], r['ip']))
+    if args.json:
+        with open(args.json, mode='wt') as file:
+            json.dump(results, file, indent=1)
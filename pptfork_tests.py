@@ -0,0 +1,49 @@
+import unittest
+import random
+import os
+import pptvm
+import pptfork
+from ppttestutils import make_machine
+
+# Echoes an int, then prints another int, a random number and the sum of the two ints
+PROGRAM = '''
+    EXEC GETINT
+    EXEC PUTINT
+    LOAD1H AH
+    LOAD1L AL
+    EXEC GETINT
+    EXEC PUTINT
+    LOAD2H AH
+    LOAD2L AL
+    EXEC RAND
+    EXEC PUTINT
+    EXEC ADDW
+    STOREH AH
+    STOREL AL
+    EXEC PUTINT
+    EXEC HLT
+'''
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+class TestFork(unittest.TestCase):
+    def test_run_forks(self):
+        for jit in [False, True]:
+            m = make_machine(PROGRAM, console=True, jit=jit)
+            result = pptfork.run_prefix(m, stdin='7\n')
+            self.assertEqual((result.status, m.ip), (pptvm.WAITING, 4))
+            self.assertEqual(m.io.out.getvalue(), '7')
+            variants = [pptfork.Variant('%d\n' % i, seed=i) for i in range(5)]
+            results = pptfork.run_forks(m, variants, jobs=2)
+            for i, r in enumerate(results):
+                random.seed(i)
+                rand = random.randint(0, 2 ** 15 - 1)
+                self.assertEqual((r['status'], r['stdout']), (pptvm.HALTED, '%d%d%d' % (i, rand, 7 + i)))
+            self.assertEqual(results[0]['steps'], 11)
+            self.assertEqual(m.ip, 4)
+            result = pptfork.run_forks(m, [pptfork.Variant('')])[0]
+            self.assertEqual((result['status'], result['ip']), (pptvm.FAULT, 4))
+            self.assertIn('EOFError', result['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,544 @@
+from pptvm import *
+
+# EXEC ops that end a block. The interpreter executes them and compilation
+# resumes at the next instruction. Other EXEC ops without a template below
+# are compiled as a call to the interpreter's handler.
+INTERPRETED_OPS = ['PUTS', 'PUTINT', 'PUTC', 'GETS', 'GETINT', 'RAND', 'HLT']
+
+# EXEC ops that end a block with a jump, compiled to return the next ip.
+# The compare-and-branch BRANCH_OPS do too.
+JUMP_OPS = ['JMP', 'JV', 'CALLW', 'RETW']
+
+MAX_BLOCK_LENGTH = 1000
+
+class BlockCompiler:
+    """Translates a run of micro-ops into the source of one Python function.
+
+    Every value computed in the block is held in a local that is assigned
+    exactly once, so a register move only renames a value and values known
+    at compile time are folded. Registers, flags and mp are read from the
+    machine on first use and written back when the block exits. Flags are
+    kept as unevaluated expressions until something reads them."""
+    def __init__(self, vm):
+        self.vm = vm
+        self.lines = []
+        self.args = {
+            'r': vm.regfile, 'flags': vm.flags,
+            'data': vm.data, 'const': vm.const, 'vm': vm,
+            'signed_divmod': signed_divmod}
+        self.count = 0
+        self.regs = {}
+        self.dirty_regs = set()
+        self.flags = {}
+        self.dirty_flags = set()
+        self.mp = None
+        self.mp_dirty = False
+        # (high, low) value pairs that set_word split off a word value
+        self.words = {}
+
+    def emit(self, line):
+        self.lines.append(line)
+
+    def fresh(self):
+        self.count += 1
+        return 'v%d' % self.count
+
+    def value(self, template, **operands):
+        """Evaluates template now if all operands are known, otherwise emits
+        it into a new local. Returns the value or the local's name."""
+        if not any(isinstance(v, str) for v in operands.values()):
+            try:
+                return eval(template.format(**{ k: repr(v) for k, v in operands.items() }))
+            except ArithmeticError:
+                # Leave it to fail when the block runs
+                pass
+        name = self.fresh()
+        self.emit('%s = %s' % (name, template.format(**operands)))
+        return name
+
+    def check(self, template, **operands):
+        """Emits an assert of template, or nothing if it is known to hold."""
+        if any(isinstance(v, str) for v in operands.values()):
+            self.emit('assert ' + template.format(**operands))
+        elif not self.value(template, **operands):
+            self.emit('assert False')
+
+    def reg(self, i):
+        if i not in self.regs:
+            name = self.fresh()
+            self.emit('%s = r[%d]' % (name, i))
+            self.regs[i] = name
+        return self.regs[i]
+
+    def set_reg(self, i, v):
+        self.regs[i] = v
+        self.dirty_regs.add(i)
+        if i == R_SPL and self.vm.checked:
+            self.check('not {sp} & 1', sp=v)
+
+    def word(self, hi):
+        h, l = self.reg(hi), self.reg(hi + 1)
+        if (h, l) in self.words:
+            return self.words[(h, l)]
+        w = self.value('{h} << 8 | {l}', h=h, l=l)
+        self.words[(h, l)] = w
+        return w
+
+    def set_word(self, hi, w):
+        h = self.value('{w} >> 8', w=w)
+        l = self.value('{w} & 255', w=w)
+        self.words[(h, l)] = w
+        self.set_reg(hi, h)
+        self.set_reg(hi + 1, l)
+
+    def flag(self, f):
+        if f not in self.flags:
+            name = self.fresh()
+            self.emit('%s = flags.%s' % (name, f))
+            self.flags[f] = name
+        elif isinstance(self.flags[f], tuple):
+            template, operands = self.flags[f]
+            self.flags[f] = self.value(template, **operands)
+        return self.flags[f]
+
+    def set_flag(self, f, template, **operands):
+        self.flags[f] = (template, operands)
+        self.dirty_flags.add(f)
+
+    def get_mp(self):
+        if self.mp is None:
+            self.mp = self.fresh()
+            self.emit('%s = vm.mp' % self.mp)
+        return self.mp
+
+    def set_mp(self, v):
+        self.mp = v
+        self.mp_dirty = True
+
+    def flush(self):
+        """Writes every changed register, flag and mp back to the machine."""
+        for i in sorted(self.dirty_regs):
+            self.emit('r[%d] = %s' % (i, self.regs[i]))
+        for f in FLAG_NAMES:
+            if f in self.dirty_flags:
+                self.emit('flags.%s = %s' % (f, self.flag(f)))
+        if self.mp_dirty:
+            self.emit('vm.mp = %s' % self.mp)
+        self.dirty_regs = set()
+        self.dirty_flags = set()
+        self.mp_dirty = False
+
+    def call(self, handler):
+        name = 'h%d' % len(self.args)
+        self.args[name] = handler
+        self.flush()
+        self.emit('%s()' % name)
+        self.regs = {}
+        self.flags = {}
+        self.mp = None
+
+    def probe(self, ip, fn, regs, next_ip=None):
+        """Emits a call of fn(ip, next_ip, mp, value) after the op at ip,
+        where value holds the registers regs, high byte first. next_ip is
+        ip + 1 unless given. Nothing is written back to the machine for it."""
+        name = 'p%d' % len(self.args)
+        self.args[name] = fn
+        value = 0
+        for i in regs:
+            value = self.value('{v} << 8 | {r}', v=value, r=self.reg(i))
+        if next_ip is None:
+            next_ip = ip + 1
+        self.emit('%s(%d, %s, %s, %s)' % (name, ip, next_ip, self.get_mp(), value))
+
+    def compile_move(self, inst):
+        """Compiles a non-EXEC instruction. Returns False if it is unknown."""
+        cmd = inst.cmd
+        if cmd in LOAD_DST:
+            self.set_reg(LOAD_DST[cmd], self.reg(REG_INDEX[inst.args[0]]))
+        elif cmd in STORE_SRC:
+            self.set_reg(REG_INDEX[inst.args[0]], self.reg(STORE_SRC[cmd]))
+        elif cmd in COPY_DST_SRC:
+            dst, src = COPY_DST_SRC[cmd]
+            self.set_reg(dst, self.reg(src))
+        elif cmd in CLEAR_DST:
+            self.set_reg(CLEAR_DST[cmd], 0)
+        elif cmd in CONST_DST:
+            self.set_reg(CONST_DST[cmd], byte_to_uint(inst.args[0]))
+        else:
+            return False
+        return True
+
+    def source(self, name, target):
+        params = ', '.join('%s=%s' % (k, k) for k in self.args)
+        self.flush()
+        body = self.lines + ['return %s' % target]
+        return 'def %s(%s):\n' % (name, params) + ''.join('    %s\n' % l for l in body)
+
+    # Arithmetic
+
+    def _add(self, width, with_carry, sub=False, store=True):
+        mask, top = 2**width - 1, 2**(width - 1)
+        a = self._operand(width)
+        b = self._operand(width, R_M2H)
+        carry = self.flag('carry') if with_carry else False
+        op = '-' if sub else '+'
+        if carry is False:
+            total = self.value('{a} %s {b}' % op, a=a, b=b)
+        else:
+            total = self.value('{a} %s {b} %s {c}' % (op, op), a=a, b=b, c=carry)
+        if sub:
+            self.set_flag('carry', '{t} < 0', t=total)
+        else:
+            self.set_flag('carry', '{t} > %d' % mask, t=total)
+        res = self.value('{t} & %d' % mask, t=total)
+        self.set_flag('overflow', 'bool({c})', c=carry)
+        self.set_flag('sign', '{x} >= %d' % top, x=res)
+        self.set_flag('zero', '{x} == 0', x=res)
+        if store:
+            self._store(width, res)
+
+    def _store(self, width, res):
+        if width == 8:
+            self.set_reg(R_M3L, res)
+        else:
+            self.set_word(R_M3H, res)
+
+    def _operand(self, width, hi=R_M1H):
+        if width == 8:
+            return self.reg(hi + 1)
+        return self.word(hi)
+
+    def op_addb(self): self._add(8, False)
+    def op_adcb(self): self._add(8, True)
+    def op_addw(self): self._add(16, False)
+    def op_adcw(self): self._add(16, True)
+    def op_subb(self): self._add(8, False, sub=True)
+    def op_sbbb(self): self._add(8, True, sub=True)
+    def op_subw(self): self._add(16, False, sub=True)
+    def op_sbbw(self): self._add(16, True, sub=True)
+    def op_cmpb(self): self._add(8, False, sub=True, store=False)
+    def op_cmpw(self): self._add(16, False, sub=True, store=False)
+
+    def _bitwise(self, width, op, store=True):
+        top = 2**(width - 1)
+        res = self.value('{a} %s {b}' % op, a=self._operand(width), b=self._operand(width, R_M2H))
+        self.set_flag('zero', '{x} == 0', x=res)
+        self.set_flag('sign', '{x} >= %d' % top, x=res)
+        if store:
+            self._store(width, res)
+
+    def op_andb(self): self._bitwise(8, '&')
+    def op_andw(self): self._bitwise(16, '&')
+    def op_orb(self): self._bitwise(8, '|')
+    def op_orw(self): self._bitwise(16, '|')
+    def op_xorb(self): self._bitwise(8, '^')
+    def op_xorw(self): self._bitwise(16, '^')
+    def op_testb(self): self._bitwise(8, '&', store=False)
+    def op_testw(self): self._bitwise(16, '&', store=False)
+
+    def _unary(self, width, template, carry):
+        sizes = { 'mask': 2**width - 1, 'top': 2**(width - 1) }
+        x = self._operand(width)
+        res = self.value(template % sizes, x=x)
+        self.set_flag('overflow', 'True')
+        self.set_flag('sign', '{x} >= %(top)d' % sizes, x=res)
+        self.set_flag('carry', carry % sizes, x=x)
+        self.set_flag('zero', '{x} == 0', x=res)
+        self._store(width, res)
+
+    def op_incb(self): self._unary(8, '({x} + 1) & %(mask)d', '{x} == %(mask)d')
+    def op_incw(self): self._unary(16, '({x} + 1) & %(mask)d', '{x} == %(mask)d')
+    def op_decb(self): self._unary(8, '({x} - 1) & %(mask)d', '{x} == 0')
+    def op_decw(self): self._unary(16, '({x} - 1) & %(mask)d', '{x} == 0')
+    def op_negb(self): self._unary(8, '-{x} & %(mask)d', '{x} == 0')
+    def op_negw(self): self._unary(16, '-{x} & %(mask)d', '{x} == 0')
+
+    def op_notb(self):
+        self._store(8, self.value('~{x} & 255', x=self._operand(8)))
+
+    def op_notw(self):
+        self._store(16, self.value('~{x} & 65535', x=self._operand(16)))
+
+    def _shift(self, width, template, carry, overflow):
+        sizes = { 'mask': 2**width - 1, 'top': 2**(width - 1) }
+        x = self._operand(width)
+        self.set_flag('carry', carry % sizes, x=x)
+        self.set_flag('overflow', overflow % sizes, x=x)
+        self._store(width, self.value(template % sizes, x=x))
+
+    def op_shlb(self): self._shift(8, '({x} << 1) & %(mask)d', '{x} >= %(top)d', '(({x} << 1) ^ {x}) & %(top)d != 0')
+    def op_shlw(self): self._shift(16, '({x} << 1) & %(mask)d', '{x} >= %(top)d', '(({x} << 1) ^ {x}) & %(top)d != 0')
+    def op_shrb(self): self._shift(8, '{x} >> 1', '{x} & 1 == 1', '{x} >= %(top)d')
+    def op_shrw(self): self._shift(16, '{x} >> 1', '{x} & 1 == 1', '{x} >= %(top)d')
+    def op_sarb(self): self._shift(8, '{x} >> 1 | {x} & %(top)d', '{x} & 1 == 1', 'False')
+    def op_sarw(self): self._shift(16, '{x} >> 1 | {x} & %(top)d', '{x} & 1 == 1', 'False')
+
+    def _signed(self, x, width):
+        top = 2**(width - 1)
+        return self.value('({x} ^ %d) - %d' % (top, top), x=x)
+
+    def _set_mul_flags(self, template, **operands):
+        self.set_flag('carry', template, **operands)
+        self.set_flag('overflow', template, **operands)
+
+    def op_mulb(self):
+        z = self.value('{x} * {y}', x=self.reg(R_AL), y=self.reg(R_M1L))
+        self.set_word(R_AH, z)
+        self._set_mul_flags('{z} > 255', z=z)
+
+    def op_mulw(self):
+        z = self.value('{x} * {y}', x=self.word(R_AH), y=self.word(R_M1H))
+        self.set_word(R_DH, self.value('{z} >> 16', z=z))
+        self.set_word(R_AH, self.value('{z} & 65535', z=z))
+        self._set_mul_flags('{z} > 65535', z=z)
+
+    def op_imulb(self):
+        z = self.value('{x} * {y}', x=self._signed(self.reg(R_AL), 8), y=self._signed(self.reg(R_M1L), 8))
+        self.set_word(R_AH, self.value('{z} & 65535', z=z))
+        self._set_mul_flags('((({z} & 255) ^ 128) - 128) != {z}', z=z)
+
+    def op_imulw(self):
+        z = self.value('{x} * {y}', x=self._signed(self.word(R_AH), 16), y=self._signed(self.word(R_M1H), 16))
+        self.set_word(R_DH, self.value('({z} >> 16) & 65535', z=z))
+        self.set_word(R_AH, self.value('{z} & 65535', z=z))
+        self._set_mul_flags('((({z} & 65535) ^ 32768) - 32768) != {z}', z=z)
+
+    def op_divb(self):
+        x = self.word(R_AH)
+        y = self.reg(R_M1L)
+        self.set_reg(R_AL, self.value('({x} // {y}) & 255', x=x, y=y))
+        self.set_reg(R_AH, self.value('({x} % {y}) & 255', x=x, y=y))
+
+    def op_divw(self):
+        x = self.value('{d} << 16 | {a}', d=self.word(R_DH), a=self.word(R_AH))
+        y = self.word(R_M1H)
+        self.set_word(R_AH, self.value('({x} // {y}) & 65535', x=x, y=y))
+        self.set_word(R_DH, self.value('({x} % {y}) & 65535', x=x, y=y))
+
+    def _idiv(self, x, y):
+        x = self.value('signed_divmod({x}, {y})', x=x, y=y)
+        return self.value('{x}[0]', x=x), self.value('{x}[1]', x=x)
+
+    def op_idivb(self):
+        z, w = self._idiv(self._signed(self.word(R_AH), 16), self._signed(self.reg(R_M1L), 8))
+        self.set_reg(R_AL, self.value('{z} & 255', z=z))
+        self.set_reg(R_AH, self.value('{w} & 255', w=w))
+
+    def op_idivw(self):
+        x = self._signed(self.value('{d} << 16 | {a}', d=self.word(R_DH), a=self.word(R_AH)), 32)
+        z, w = self._idiv(x, self._signed(self.word(R_M1H), 16))
+        self.set_word(R_AH, self.value('{z} & 65535', z=z))
+        self.set_word(R_DH, self.value('{w} & 65535', w=w))
+
+    def _address(self, template, **operands):
+        self.set_word(R_M3H, self.value(template, **operands))
+
+    def op_shiftaddr1(self): self._address('({x} << 1) & 65535', x=self.word(R_M1H))
+    def op_shiftaddr2(self): self._address('({x} << 2) & 65535', x=self.word(R_M1H))
+    def op_shiftaddr3(self): self._address('({x} << 3) & 65535', x=self.word(R_M1H))
+    def op_addaddr(self): self._address('({x} + {y}) & 65535', x=self.word(R_M1H), y=self.word(R_M2H))
+    def op_inc2w(self): self._address('({x} + 2) & 65535', x=self.word(R_M1H))
+    def op_dec2w(self): self._address('({x} - 2) & 65535', x=self.word(R_M1H))
+
+    def op_cbw(self):
+        self.set_reg(R_AH, self.value('255 if {x} & 128 else 0', x=self.reg(R_AL)))
+
+    def op_cwd(self):
+        fill = self.value('255 if {x} & 128 else 0', x=self.reg(R_AH))
+        self.set_reg(R_DH, fill)
+        self.set_reg(R_DL, fill)
+
+    # Flags and verdicts
+
+    def op_clc(self): self.set_flag('carry', 'False')
+    def op_stc(self): self.set_flag('carry', 'True')
+    def op_cmc(self): self.set_flag('carry', 'not {c}', c=self.flag('carry'))
+
+    def _verdict(self, template, *flags):
+        self.set_flag('verdict', template, **{ f: self.flag(f) for f in flags })
+
+    def op_va(self): self._verdict('not {carry} and not {zero}', 'carry', 'zero')
+    def op_vc(self): self._verdict('{carry}', 'carry')
+    def op_vz(self): self._verdict('{zero}', 'zero')
+    def op_vo(self): self._verdict('{overflow}', 'overflow')
+    def op_vs(self): self._verdict('{sign}', 'sign')
+    def op_vg(self): self._verdict('not {zero} and ({sign} == {overflow})', 'zero', 'sign', 'overflow')
+    def op_vl(self): self._verdict('{sign} != {overflow}', 'sign', 'overflow')
+    def op_nv(self): self._verdict('not {verdict}', 'verdict')
+
+    # Memory
+
+    def op_smp(self):
+        self.set_mp(self.word(R_M1H))
+
+    def op_imp(self):
+        self.set_mp(self.value('({x} + 1) & 65535', x=self.get_mp()))
+
+    def op_dmp(self):
+        self.set_mp(self.value('({x} - 1) & 65535', x=self.get_mp()))
+
+    def _read(self, addr):
+        if isinstance(addr, str):
+            x = self.fresh()
+            self.emit('%s = data[%s - %d] if %s >= %d else const[%s]' % (x, addr, DATA_BASE, addr, DATA_BASE, addr))
+        elif addr >= DATA_BASE:
+            x = self.fresh()
+            self.emit('%s = data[%d]' % (x, addr - DATA_BASE))
+        else:
+            x = self.vm.const[addr]
+        return x
+
+    def _write(self, addr, x):
+        self.check('{addr} >= %d' % DATA_BASE, addr=addr)
+        if isinstance(addr, str):
+            self.emit('data[%s - %d] = %s' % (addr, DATA_BASE, x))
+        elif addr >= DATA_BASE:
+            self.emit('data[%d] = %s' % (addr - DATA_BASE, x))
+
+    def op_rmem(self):
+        self.set_reg(R_M3L, self._read(self.get_mp()))
+
+    def op_wmem(self):
+        self._write(self.get_mp(), self.reg(R_M2L))
+
+    def op_rmemw(self):
+        mp = self.get_mp()
+        low = self._read(mp)
+        self.set_reg(R_M3H, self._read(self.value('({mp} + 1) & 65535', mp=mp)))
+        self.set_reg(R_M3L, low)
+
+    def op_wmemw(self):
+        mp = self.get_mp()
+        self._write(mp, self.reg(R_M3L))
+        self._write(self.value('({mp} + 1) & 65535', mp=mp), self.reg(R_M3H))
+
+    def _push(self, high, low):
+        sp = self.value('({x} - 2) & 65535', x=self.word(R_SPH))
+        self.check('{sp} != 65535', sp=sp)
+        self._write(sp, low)
+        self._write(self.value('({sp} + 1) & 65535', sp=sp), high)
+        self.set_word(R_SPH, sp)
+
+    def _pop(self):
+        sp = self.word(R_SPH)
+        low = self._read(sp)
+        high = self._read(self.value('({sp} + 1) & 65535', sp=sp))
+        self.set_word(R_SPH, self.value('({sp} + 2) & 65535', sp=sp))
+        return high, low
+
+    def op_pushw(self):
+        self._push(self.reg(R_M1H), self.reg(R_M1L))
+
+    def op_popw(self):
+        high, low = self._pop()
+        self.set_reg(R_M3H, high)
+        self.set_reg(R_M3L, low)
+
+    # Jumps. These return the ip that follows the block.
+
+    def op_jmp(self, next_ip):
+        target = self.word(R_M1H)
+        if self.vm.checked:
+            self.check('{x} & 128', x=self.reg(R_SPH))
+            self.check('{target} < %d' % len(self.vm.code), target=target)
+        return target
+
+    def op_callw(self, next_ip):
+        target = self.word(R_M1H)
+        if self.vm.checked:
+            self.check('{target} < %d' % len(self.vm.code), target=target)
+        self._push(next_ip >> 8, next_ip & 255)
+        return target
+
+    def op_retw(self, next_ip):
+        high, low = self._pop()
+        target = self.value('{h} << 8 | {l}', h=high, l=low)
+        if self.vm.checked:
+            self.check('{target} < %d' % len(self.vm.code), target=target)
+        return target
+
+    def _jump_if_verdict(self, hi, next_ip):
+        target, verdict = self.word(hi), self.flag('verdict')
+        if self.vm.checked:
+            self.check('not {verdict} or {target} < %d' % len(self.vm.code), verdict=verdict, target=target)
+        return self.value('{target} if {verdict} else {next_ip}',
+            target=target, verdict=verdict, next_ip=next_ip)
+
+    def op_jv(self, next_ip):
+        return self._jump_if_verdict(R_M1H, next_ip)
+
+    def op_branch(self, next_ip, compare, condition, negate):
+        """A compare-and-branch op (see BRANCH_OPS), which jumps to M3."""
+        getattr(self, 'op_' + compare.lower())()
+        getattr(self, 'op_v' + condition.lower())()
+        if negate:
+            self.op_nv()
+        return self._jump_if_verdict(R_M3H, next_ip)
+
+def compile_block(vm, ip, probes=None):
+    """Compiles the basic block starting at ip. Returns the compiled function
+    and the number of micro-ops in the block, or None if the instruction at
+    ip has to be interpreted. probes maps EXEC op names to (fn, regs) pairs
+    to call after each such op (see BlockCompiler.probe)."""
+    compiler = BlockCompiler(vm)
+    text = vm.instructions
+    i = ip
+    target = None
+    while i < len(text) and i - ip < MAX_BLOCK_LENGTH:
+        inst = text[i]
+        if inst.cmd == 'EXEC':
+            name = inst.args[0]
+            if name in JUMP_OPS or name in BRANCH_OPS:
+                if name in JUMP_OPS:
+                    target = getattr(compiler, 'op_' + name.lower())(i + 1)
+                else:
+                    target = compiler.op_branch(i + 1, *BRANCH_OPS[name])
+                if probes and name in probes:
+                    compiler.probe(i, *probes[name], next_ip=target)
+                i += 1
+                break
+            if name in INTERPRETED_OPS:
+                break
+            if hasattr(compiler, 'op_' + name.lower()):
+                getattr(compiler, 'op_' + name.lower())()
+            elif hasattr(vm, 'exec_' + name.lower()):
+                compiler.call(vm.code[i])
+            else:
+                break
+            if probes and name in probes:
+                compiler.probe(i, *probes[name])
+        elif not compiler.compile_move(inst):
+            break
+        i += 1
+    if i == ip:
+        return None
+    if target is None:
+        target = i
+    source = compiler.source('block_%d' % ip, target)
+    namespace = dict(compiler.args)
+    exec(compile(source, '<block %d>' % ip, 'exec'), namespace)
+    return namespace['block_%d' % ip], i - ip
+
+class Jit:
+    """Cache of compiled blocks for one machine, keyed by entry ip."""
+    def __init__(self, vm):
+        self.vm = vm
+        self.blocks = {}
+
+    def lookup(self, ip):
+        """Returns (fn, length) for the block at ip, compiling it on first use.
+        fn is None if the instruction at ip has to be interpreted."""
+        block = self.blocks.get(ip)
+        if block is None:
+            block = self.blocks[ip] = compile_block(self.vm, ip) or (None, 1)
+        return block
+
+    def run_block(self):
+        """Executes the block at vm.ip. Returns the number of micro-ops run."""
+        vm = self.vm
+        fn, length = self.lookup(vm.ip)
+        if fn is None:
+            vm.step()
+        else:
+            vm.ip = fn()
+        return length
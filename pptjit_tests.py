@@ -0,0 +1,113 @@
+import unittest
+import random
+import pptvm
+import pptjit
+from ppttestutils import make_machine, random_block
+
+# AX = 10 + 9 + ... + 1, leaving ip at the HLT
+SUM_PROGRAM = '''
+    CONSTH 10000000
+    STOREH SPH
+    CLEARH3
+    CONSTL 00001010
+    STOREH CH
+    STOREL CL
+    STOREH AH
+    CLEARL3
+    STOREL AL
+    LOAD1H AH
+    LOAD1L AL
+    LOAD2H CH
+    LOAD2L CL
+    EXEC ADDW
+    STOREH AH
+    STOREL AL
+    LOAD1H CH
+    LOAD1L CL
+    EXEC DECW
+    STOREH CH
+    STOREL CL
+    EXEC VZ
+    EXEC NV
+    CONSTH 00000000
+    CONSTL 00001001
+    LOAD1H M3H
+    LOAD1L M3L
+    EXEC JV
+    EXEC HLT
+'''
+
+class TestJit(unittest.TestCase):
+    def test_loop(self):
+        for jit in [False, True]:
+            m = make_machine(SUM_PROGRAM, jit=jit)
+            while m.ip != 28:
+                m.step_block()
+            self.assertEqual(m._read_reg('A'), 55)
+        self.assertEqual(m.jit.blocks[9][1], 19)
+
+    def test_run_budget(self):
+        for budget in range(0, 250, 7):
+            interpreted = make_machine(SUM_PROGRAM)
+            compiled = make_machine(SUM_PROGRAM, jit=True)
+            results = [m.run(max_steps=budget) for m in (interpreted, compiled)]
+            self.assertEqual(vars(results[0]), vars(results[1]))
+            self.assertEqual(interpreted.regfile, compiled.regfile)
+        self.assertEqual(results[1].status, pptvm.HALTED)
+        self.assertEqual(compiled._read_reg('A'), 55)
+        result = make_machine(SUM_PROGRAM, jit=True).run(until_ip=20)
+        self.assertEqual((result.status, result.steps, result.ip), (pptvm.REACHED_IP, 20, 20))
+
+    def test_interpreted_ops_end_blocks(self):
+        m = make_machine('''
+            CONSTL 01000001
+            STOREL AL
+            EXEC PUTC
+            EXEC HLT
+        ''', jit=True)
+        self.assertEqual(m.step_block(), 2)
+        self.assertIsNone(pptjit.compile_block(m, 2))
+
+    def test_matches_interpreter(self):
+        rng = random.Random(1234)
+        for i in range(300):
+            program = random_block(rng, 40)
+            data = bytes(rng.randrange(256) for i in range(64))
+            regs = bytearray(rng.randrange(256) for r in pptvm.REG_NAMES)
+            regs[pptvm.R_M1H] |= 0x80
+            regs[pptvm.R_SPL] &= 0xfe
+            mp = pptvm.DATA_BASE + rng.randrange(32)
+            checked = i % 3 != 2
+            machines = [
+                make_machine(program, data=data, const=data, checked=checked),
+                make_machine(program, data=data, const=data, lazy_flags=i % 2 == 1, checked=checked)]
+            for m in machines:
+                m.regfile[:] = regs
+                m.mp = mp
+            interpreted, compiled = machines
+            results = []
+            try:
+                while interpreted.ip < len(interpreted.code):
+                    interpreted.step()
+            except (AssertionError, ZeroDivisionError) as e:
+                results.append(type(e))
+            fn, length = pptjit.compile_block(compiled, 0)
+            self.assertEqual(length, 40)
+            try:
+                compiled.ip = fn()
+            except (AssertionError, ZeroDivisionError) as e:
+                results.append(type(e))
+            if results:
+                self.assertEqual(len(results), 2, program)
+                self.assertEqual(results[0], results[1], program)
+                continue
+            self.assertEqual(interpreted.regfile, compiled.regfile, program)
+            for f in pptjit.FLAG_NAMES:
+                self.assertEqual(getattr(interpreted.flags, f), getattr(compiled.flags, f), program)
+            self.assertEqual(interpreted.mp, compiled.mp, program)
+            self.assertEqual(interpreted.data, compiled.data, program)
+            self.assertEqual(compiled.ip, 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,614 @@
+import random
+import collections
+from pptvm import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Index of each flag in the rows of LockstepMachines.flags
+F_VERDICT, F_CARRY, F_ZERO, F_SIGN, F_OVERFLOW = range(len(FLAG_NAMES))
+
+# Ops that end a group's run through the code, handled by the run loop
+CONTROL_OPS = ['JMP', 'JV', 'CALLW', 'RETW', 'HLT']
+
+class Group:
+    """The machines in idx, which are all at the same ip, with their registers,
+    flags and mp gathered into arrays of their own (one column per machine).
+    Their data segments stay in LockstepMachines.data."""
+    def __init__(self, machines, idx):
+        self.idx = idx
+        self.regs = machines.regs[:, idx]
+        self.flags = machines.flags[:, idx]
+        self.mp = machines.mp[idx]
+
+    def __len__(self):
+        return len(self.idx)
+
+    def scatter(self, machines, keep=None):
+        """Writes back the state of the machines in keep (a mask), or all of them."""
+        idx, regs, flags, mp = self.idx, self.regs, self.flags, self.mp
+        if keep is not None:
+            idx, regs, flags, mp = idx[keep], regs[:, keep], flags[:, keep], mp[keep]
+        machines.regs[:, idx] = regs
+        machines.flags[:, idx] = flags
+        machines.mp[idx] = mp
+
+    def drop(self, mask):
+        keep = ~mask
+        self.idx = self.idx[keep]
+        self.regs = self.regs[:, keep]
+        self.flags = self.flags[:, keep]
+        self.mp = self.mp[keep]
+
+    def word(self, high):
+        return self.regs[high].astype(np.int64) << 8 | self.regs[high + 1]
+
+    def set_word(self, high, value):
+        self.regs[high] = value >> 8 & 0xff
+        self.regs[high + 1] = value & 0xff
+
+    def byte(self, index):
+        return self.regs[index].astype(np.int64)
+
+    def set_arith(self, total, res, top, overflow):
+        self.flags[F_CARRY] = total != res
+        self.flags[F_OVERFLOW] = overflow
+        self.flags[F_SIGN] = res >= top
+        self.flags[F_ZERO] = res == 0
+
+    def set_result(self, res, top):
+        self.flags[F_ZERO] = res == 0
+        self.flags[F_SIGN] = res >= top
+
+def sign_extend_array(x, bits):
+    return np.where(x >> (bits - 1) & 1, x - (1 << bits), x)
+
+def signed_divmod_array(x, y):
+    """signed_divmod on arrays. y must not contain 0."""
+    neg = x < 0
+    x = np.where(neg, -x, x)
+    y = np.where(neg, -y, y)
+    floor = y >= 0
+    z = np.where(floor, x // y, (x + y + 1) // y)
+    w = np.where(floor, x % y, x - z * y)
+    return z, w
+
+def move_vector_op(dst, src):
+    def op(g, m):
+        g.regs[dst] = g.regs[src]
+    return op
+
+def set_vector_op(dst, value):
+    def op(g, m):
+        g.regs[dst] = value
+    return op
+
+def unknown_vector_op(inst):
+    def op(g, m):
+        return np.ones(len(g), dtype=bool), Exception('Unknown instruction %s %s' % (inst.cmd, ' '.join(inst.args)))
+    return op
+
+def add_op(word, with_carry):
+    top, mask = (0x8000, 0xffff) if word else (0x80, 0xff)
+    def op(g, m):
+        carry = g.flags[F_CARRY].astype(np.int64) if with_carry else 0
+        if word:
+            total = g.word(R_M1H) + g.word(R_M2H) + carry
+        else:
+            total = g.byte(R_M1L) + g.byte(R_M2L) + carry
+        res = total & mask
+        if word:
+            g.set_word(R_M3H, res)
+        else:
+            g.regs[R_M3L] = res
+        g.set_arith(total, res, top, carry == 1)
+    return op
+
+def sub_op(word, with_borrow, keep_result=True):
+    top, mask = (0x8000, 0xffff) if word else (0x80, 0xff)
+    def op(g, m):
+        borrow = g.flags[F_CARRY].astype(np.int64) if with_borrow else 0
+        if word:
+            total = g.word(R_M1H) - g.word(R_M2H) - borrow
+        else:
+            total = g.byte(R_M1L) - g.byte(R_M2L) - borrow
+        res = total & mask
+        if keep_result:
+            if word:
+                g.set_word(R_M3H, res)
+            else:
+                g.regs[R_M3L] = res
+        g.set_arith(total, res, top, borrow == 1)
+    return op
+
+def bitwise_op(word, fn, keep_result=True):
+    def op(g, m):
+        if word:
+            res = fn(g.word(R_M1H), g.word(R_M2H))
+            if keep_result:
+                g.set_word(R_M3H, res)
+            g.set_result(res, 0x8000)
+        else:
+            res = fn(g.byte(R_M1L), g.byte(R_M2L))
+            if keep_result:
+                g.regs[R_M3L] = res
+            g.set_result(res, 0x80)
+    return op
+
+def unary_arith_op(word, fn):
+    """INC, DEC and NEG, which always set overflow."""
+    top, mask = (0x8000, 0xffff) if word else (0x80, 0xff)
+    def op(g, m):
+        total = fn(g.word(R_M1H) if word else g.byte(R_M1L), mask)
+        res = total & mask
+        if word:
+            g.set_word(R_M3H, res)
+        else:
+            g.regs[R_M3L] = res
+        g.set_arith(total, res, top, True)
+    return op
+
+def m3_op(fn):
+    """Word ops that only compute m3 from m1 and m2."""
+    def op(g, m):
+        g.set_word(R_M3H, fn(g.word(R_M1H), g.word(R_M2H)) & 0xffff)
+    return op
+
+def shift_op(word, kind):
+    top = 0x8000 if word else 0x80
+    mask = 2 * top - 1
+    def op(g, m):
+        x = g.word(R_M1H) if word else g.byte(R_M1L)
+        if kind == 'SHL':
+            res = x << 1 & mask
+            g.flags[F_CARRY] = x >= top
+            g.flags[F_OVERFLOW] = (res ^ x) >= top
+        else:
+            g.flags[F_CARRY] = x & 1 == 1
+            g.flags[F_OVERFLOW] = x >= top if kind == 'SHR' else False
+            res = x >> 1 if kind == 'SHR' else x >> 1 | x & top
+        if word:
+            g.set_word(R_M3H, res)
+        else:
+            g.regs[R_M3L] = res
+    return op
+
+def verdict_op(fn):
+    def op(g, m):
+        f = g.flags
+        g.flags[F_VERDICT] = fn(f[F_CARRY], f[F_ZERO], f[F_SIGN], f[F_OVERFLOW], f[F_VERDICT])
+    return op
+
+def exec_cbw(g, m):
+    g.regs[R_AH] = np.where(g.regs[R_AL] & 0x80, 0xff, 0)
+
+def exec_cwd(g, m):
+    g.regs[R_DH] = g.regs[R_DL] = np.where(g.regs[R_AH] & 0x80, 0xff, 0)
+
+def exec_clc(g, m):
+    g.flags[F_CARRY] = False
+
+def exec_stc(g, m):
+    g.flags[F_CARRY] = True
+
+def exec_cmc(g, m):
+    g.flags[F_CARRY] = ~g.flags[F_CARRY]
+
+def exec_divb(g, m):
+    y = g.byte(R_M1L)
+    if not y.all():
+        return y == 0, ZeroDivisionError('integer division or modulo by zero')
+    x = g.word(R_AH)
+    g.regs[R_AL] = x // y & 0xff
+    g.regs[R_AH] = x % y & 0xff
+
+def exec_divw(g, m):
+    y = g.word(R_M1H)
+    if not y.all():
+        return y == 0, ZeroDivisionError('integer division or modulo by zero')
+    x = g.word(R_DH) << 16 | g.word(R_AH)
+    g.set_word(R_AH, x // y & 0xffff)
+    g.set_word(R_DH, x % y & 0xffff)
+
+def exec_idivb(g, m):
+    y = sign_extend_array(g.byte(R_M1L), 8)
+    if not y.all():
+        return y == 0, ZeroDivisionError('integer division or modulo by zero')
+    z, w = signed_divmod_array(sign_extend_array(g.word(R_AH), 16), y)
+    g.regs[R_AL] = z & 0xff
+    g.regs[R_AH] = w & 0xff
+
+def exec_idivw(g, m):
+    y = sign_extend_array(g.word(R_M1H), 16)
+    if not y.all():
+        return y == 0, ZeroDivisionError('integer division or modulo by zero')
+    z, w = signed_divmod_array(sign_extend_array(g.word(R_DH) << 16 | g.word(R_AH), 32), y)
+    g.set_word(R_AH, z & 0xffff)
+    g.set_word(R_DH, w & 0xffff)
+
+def exec_mulb(g, m):
+    z = g.byte(R_AL) * g.byte(R_M1L)
+    g.set_word(R_AH, z)
+    g.flags[F_CARRY] = g.flags[F_OVERFLOW] = z >= 0x100
+
+def exec_mulw(g, m):
+    z = g.word(R_AH) * g.word(R_M1H)
+    g.set_word(R_DH, z >> 16)
+    g.set_word(R_AH, z & 0xffff)
+    g.flags[F_CARRY] = g.flags[F_OVERFLOW] = z >= 0x10000
+
+def exec_imulb(g, m):
+    z = sign_extend_array(g.byte(R_AL), 8) * sign_extend_array(g.byte(R_M1L), 8)
+    g.set_word(R_AH, z & 0xffff)
+    g.flags[F_CARRY] = g.flags[F_OVERFLOW] = sign_extend_array(z & 0xff, 8) != z
+
+def exec_imulw(g, m):
+    z = sign_extend_array(g.word(R_AH), 16) * sign_extend_array(g.word(R_M1H), 16)
+    g.set_word(R_DH, z >> 16 & 0xffff)
+    g.set_word(R_AH, z & 0xffff)
+    g.flags[F_CARRY] = g.flags[F_OVERFLOW] = sign_extend_array(z & 0xffff, 16) != z
+
+def read_bytes(g, m, addr):
+    """The byte at addr (an array) in each machine's memory."""
+    in_data = addr >= DATA_BASE
+    return np.where(in_data, m.data[g.idx, np.where(in_data, addr - DATA_BASE, 0)],
+                    m.const[np.where(in_data, 0, addr)])
+
+def exec_rmem(g, m):
+    g.regs[R_M3L] = read_bytes(g, m, g.mp)
+
+def exec_wmem(g, m):
+    if (g.mp < DATA_BASE).any():
+        return g.mp < DATA_BASE, AssertionError()
+    m.data[g.idx, g.mp - DATA_BASE] = g.regs[R_M2L]
+
+def exec_smp(g, m):
+    g.mp = g.word(R_M1H)
+
+def exec_imp(g, m):
+    g.mp = g.mp + 1 & 0xffff
+
+def exec_dmp(g, m):
+    g.mp = g.mp - 1 & 0xffff
+
+def exec_rmemw(g, m):
+    g.set_word(R_M3H, read_bytes(g, m, g.mp + 1 & 0xffff).astype(np.int64) << 8 | read_bytes(g, m, g.mp))
+
+def exec_wmemw(g, m):
+    if (g.mp < DATA_BASE).any():
+        return g.mp < DATA_BASE, AssertionError()
+    m.data[g.idx, g.mp - DATA_BASE] = g.regs[R_M3L]
+    high = g.mp + 1 & 0xffff
+    if (high < DATA_BASE).any():
+        return high < DATA_BASE, AssertionError()
+    m.data[g.idx, high - DATA_BASE] = g.regs[R_M3H]
+
+def push_word(g, m, high, low):
+    sp = g.word(R_SPH) - 2 & 0xffff
+    bad = (sp < DATA_BASE) | (sp == 0xffff)
+    if bad.any():
+        return bad, AssertionError()
+    m.data[g.idx, sp - DATA_BASE] = low
+    m.data[g.idx, sp - DATA_BASE + 1] = high
+    g.set_word(R_SPH, sp)
+
+def pop_word(g, m):
+    sp = g.word(R_SPH)
+    word = read_bytes(g, m, sp + 1 & 0xffff).astype(np.int64) << 8 | read_bytes(g, m, sp)
+    g.set_word(R_SPH, sp + 2 & 0xffff)
+    return word
+
+def exec_pushw(g, m):
+    return push_word(g, m, g.regs[R_M1H], g.regs[R_M1L])
+
+def exec_popw(g, m):
+    g.set_word(R_M3H, pop_word(g, m))
+
+def exec_notb(g, m):
+    g.regs[R_M3L] = ~g.regs[R_M1L]
+
+def exec_notw(g, m):
+    g.regs[R_M3H] = ~g.regs[R_M1H]
+    g.regs[R_M3L] = ~g.regs[R_M1L]
+
+def exec_putint(g, m):
+    for i, a in zip(g.idx, sign_extend_array(g.word(R_AH), 16)):
+        m.outputs[i].append(str(a))
+
+def exec_putc(g, m):
+    for i, a in zip(g.idx, g.regs[R_AL]):
+        m.outputs[i].append(chr(a))
+
+def exec_puts(g, m):
+    addr = g.word(R_AH)
+    g.regs[R_M1H] = g.regs[R_AH]
+    g.regs[R_M1L] = g.regs[R_AL]
+    for j, i in enumerate(g.idx):
+        mp = int(addr[j])
+        chars = []
+        while True:
+            c = m.data[i, mp - DATA_BASE] if mp >= DATA_BASE else m.const[mp]
+            if c == 0:
+                break
+            chars.append(chr(c))
+            mp = mp + 1 & 0xffff
+        m.outputs[i].append(''.join(chars))
+        g.mp[j] = mp
+
+def exec_gets(g, m):
+    eof = np.array([not m.inputs[i] for i in g.idx], dtype=bool)
+    if eof.any():
+        return eof, EOFError('No more input')
+    addr = g.word(R_AH)
+    g.regs[R_M1H] = g.regs[R_AH]
+    g.regs[R_M1L] = g.regs[R_AL]
+    for j, i in enumerate(g.idx):
+        line = m.inputs[i][0]
+        if DATA_BASE <= addr[j] and addr[j] + len(line) < 2**16:
+            continue
+        # Write byte by byte like the interpreter, up to the write that faults
+        m.inputs[i].popleft()
+        mp = int(addr[j])
+        for b in [ord(c) & 0xff for c in line] + [0]:
+            g.regs[R_M2L, j] = b
+            if mp < DATA_BASE:
+                break
+            m.data[i, mp - DATA_BASE] = b
+            mp = mp + 1 & 0xffff
+        g.mp[j] = mp
+        return np.arange(len(g)) == j, AssertionError()
+    for j, i in enumerate(g.idx):
+        line = m.inputs[i].popleft()
+        offset = int(addr[j]) - DATA_BASE
+        m.data[i, offset:offset + len(line) + 1] = [ord(c) & 0xff for c in line] + [0]
+        g.mp[j] = addr[j] + len(line)
+
+def exec_getint(g, m):
+    eof = np.array([not m.inputs[i] for i in g.idx], dtype=bool)
+    if eof.any():
+        return eof, EOFError('No more input')
+    values = []
+    for j, i in enumerate(g.idx):
+        try:
+            values.append(int(m.inputs[i][0]) & 0xffff)
+        except ValueError as e:
+            m.inputs[i].popleft()
+            return np.arange(len(g)) == j, e
+    for i in g.idx:
+        m.inputs[i].popleft()
+    g.set_word(R_AH, np.array(values, dtype=np.int64))
+
+def exec_rand(g, m):
+    g.set_word(R_AH, np.array([m.rngs[i].randint(0, 2 ** 15 - 1) for i in g.idx], dtype=np.int64))
+
+def decode_exec(name):
+    word = name.endswith('W')
+    base = name[:-1]
+    if base in ('ADD', 'ADC'):
+        return add_op(word, base == 'ADC')
+    if base in ('SUB', 'SBB', 'CMP'):
+        return sub_op(word, base == 'SBB', base != 'CMP')
+    if base in ('AND', 'OR', 'XOR', 'TEST'):
+        fn = {'AND': np.bitwise_and, 'TEST': np.bitwise_and, 'OR': np.bitwise_or, 'XOR': np.bitwise_xor}[base]
+        return bitwise_op(word, fn, base != 'TEST')
+    if base in ('INC', 'DEC', 'NEG'):
+        fn = {
+            'INC': lambda x, mask: x + 1,
+            'DEC': lambda x, mask: x - 1,
+            'NEG': lambda x, mask: (~x & mask) + 1}[base]
+        return unary_arith_op(word, fn)
+    if base in ('SHL', 'SHR', 'SAR'):
+        return shift_op(word, base)
+    if name.startswith('SHIFTADDR'):
+        n = int(name[-1])
+        return m3_op(lambda a, b: a << n)
+    m3_ops = {
+        'ADDADDR': lambda a, b: a + b,
+        'INC2W': lambda a, b: a + 2,
+        'DEC2W': lambda a, b: a - 2}
+    if name in m3_ops:
+        return m3_op(m3_ops[name])
+    if name in VERDICTS:
+        return verdict_op(VERDICTS[name])
+    return globals().get('exec_' + name.lower())
+
+VERDICTS = {
+    'VA': lambda c, z, s, o, v: ~c & ~z,
+    'VC': lambda c, z, s, o, v: c,
+    'VZ': lambda c, z, s, o, v: z,
+    'VO': lambda c, z, s, o, v: o,
+    'VS': lambda c, z, s, o, v: s,
+    'VG': lambda c, z, s, o, v: ~z & (s == o),
+    'VL': lambda c, z, s, o, v: s != o,
+    'NV': lambda c, z, s, o, v: ~v}
+
+# A compare-and-branch op (see BRANCH_OPS) as its compare and the op that
+# sets the verdict it jumps to M3 on, handled by the run loop like JV
+Branch = collections.namedtuple('Branch', ['compare', 'verdict'])
+
+def decode_branch(name):
+    compare, condition, negate = BRANCH_OPS[name]
+    fn = VERDICTS['V' + condition]
+    if negate:
+        return Branch(decode_exec(compare), verdict_op(lambda c, z, s, o, v: ~fn(c, z, s, o, v)))
+    return Branch(decode_exec(compare), verdict_op(fn))
+
+class LockstepMachines:
+    """n copies of one program, run together, with the checks of a checked
+    MachineState. Registers, flags and mp are
+    arrays with a column per machine and the data segments are an n x 32 KiB
+    array, so each micro-op is executed once for all of the machines that
+    are at its ip. Machines part ways at jumps and are regrouped by ip.
+
+    Each machine has its own RNG for RAND, seeded like the interpreter's
+    random.seed(seed), its own queue of input lines and its own output."""
+    def __init__(self, vm, n, seeds=None, inputs=None):
+        if np is None:
+            raise Exception('pptlockstep needs NumPy')
+        self.instructions = vm.instructions
+        self.n = n
+        self.regs = np.repeat(np.frombuffer(bytes(vm.regfile), dtype=np.uint8)[:, None], n, axis=1)
+        self.flags = np.array([[getattr(vm.flags, f)] * n for f in FLAG_NAMES], dtype=bool)
+        self.mp = np.full(n, vm.mp, dtype=np.int64)
+        self.ip = np.full(n, vm.ip, dtype=np.int64)
+        self.steps = np.zeros(n, dtype=np.int64)
+        self.data = np.repeat(np.frombuffer(bytes(vm.data), dtype=np.uint8)[None, :], n, axis=0)
+        self.const = np.frombuffer(bytes(vm.const), dtype=np.uint8)
+        self.results = [RunResult(HALTED, 0, vm.ip) if vm.halted else None for i in range(n)]
+        self.rngs = [random.Random(seed) for seed in (seeds if seeds is not None else range(n))]
+        self.inputs = [collections.deque((inputs[i] if inputs else '').splitlines()) for i in range(n)]
+        self.outputs = [[] for i in range(n)]
+        self.code = [self.decode(inst) for inst in vm.instructions]
+        # The interpreter checks SPL before every step. It can only go odd
+        # through a STOREL SPL, so it is checked where a group starts and
+        # after those.
+        self.check_sp = [False] + [inst.cmd == 'STOREL' and inst.args == ['SPL'] for inst in vm.instructions]
+
+    def decode(self, inst):
+        cmd = inst.cmd
+        if cmd in LOAD_DST:
+            return move_vector_op(LOAD_DST[cmd], REG_INDEX[inst.args[0]])
+        if cmd in STORE_SRC:
+            return move_vector_op(REG_INDEX[inst.args[0]], STORE_SRC[cmd])
+        if cmd in COPY_DST_SRC:
+            return move_vector_op(*COPY_DST_SRC[cmd])
+        if cmd in CLEAR_DST:
+            return set_vector_op(CLEAR_DST[cmd], 0)
+        if cmd in CONST_DST:
+            return set_vector_op(CONST_DST[cmd], byte_to_uint(inst.args[0]))
+        if cmd == 'EXEC':
+            if inst.args[0] in CONTROL_OPS:
+                return inst.args[0]
+            if inst.args[0] in BRANCH_OPS:
+                return decode_branch(inst.args[0])
+            op = decode_exec(inst.args[0])
+            if op is not None:
+                return op
+        return unknown_vector_op(inst)
+
+    def output(self, i):
+        return ''.join(self.outputs[i])
+
+    def run(self, max_steps=None):
+        """Runs every machine until it halts, faults or has run max_steps
+        micro-ops. Returns a RunResult per machine. Machines that ran out of
+        budget in an earlier call carry on."""
+        self.start = self.steps.copy()
+        self.limit = self.steps + (2**62 if max_steps is None else max_steps)
+        for i in range(self.n):
+            if self.results[i] is None or self.results[i].status == BUDGET_EXHAUSTED:
+                self.results[i] = None
+                if self.steps[i] >= self.limit[i]:
+                    self.results[i] = RunResult(BUDGET_EXHAUSTED, 0, int(self.ip[i]))
+        while True:
+            running = np.array([r is None for r in self.results], dtype=bool)
+            if not running.any():
+                return self.results
+            running = np.flatnonzero(running)
+            ips, counts = np.unique(self.ip[running], return_counts=True)
+            ip = int(ips[counts.argmax()])
+            idx = running[self.ip[running] == ip]
+            self.run_group(Group(self, idx), ip)
+
+    def fault(self, g, mask, ip, n, error, next_ip):
+        """Takes the machines in mask out of g after n micro-ops, with a fault at ip."""
+        g.scatter(self, mask)
+        for i in g.idx[mask]:
+            self.steps[i] += n
+            self.ip[i] = next_ip
+            self.results[i] = RunResult(FAULT, self.run_steps(i), ip, error)
+        g.drop(mask)
+
+    def run_steps(self, i):
+        """Micro-ops machine i has run in the current call to run."""
+        return int(self.steps[i] - self.start[i])
+
+    def run_group(self, g, ip):
+        """Runs the machines of g from ip until they leave straight-line code
+        or one of them runs out of budget."""
+        code = self.code
+        room = (self.limit[g.idx] - self.steps[g.idx]).min()
+        n = 0
+        next_ip = None
+        while n < room:
+            if ip >= len(code):
+                self.fault(g, np.ones(len(g), dtype=bool), ip, n, Exception('ip out of range'), ip)
+                return
+            if n == 0 or self.check_sp[ip]:
+                odd = (g.regs[R_SPL] & 1).astype(bool)
+                if odd.any():
+                    self.fault(g, odd, ip, n, AssertionError(), ip)
+                    if not len(g):
+                        return
+            op = code[ip]
+            if op == 'HLT':
+                g.scatter(self)
+                self.ip[g.idx] = ip
+                self.steps[g.idx] += n + 1
+                for i in g.idx:
+                    self.results[i] = RunResult(HALTED, self.run_steps(i), ip)
+                return
+            if op == 'JMP':
+                bad = (g.regs[R_SPH] & 0x80) == 0
+                if bad.any():
+                    self.fault(g, bad, ip, n, AssertionError(), ip + 1)
+                    if not len(g):
+                        return
+                bad = g.word(R_M1H) >= len(code)
+                if bad.any():
+                    self.fault(g, bad, ip, n, AssertionError(), ip + 1)
+                    if not len(g):
+                        return
+                next_ip = g.word(R_M1H)
+            elif op == 'CALLW':
+                bad = g.word(R_M1H) >= len(code)
+                if bad.any():
+                    self.fault(g, bad, ip, n, AssertionError(), ip + 1)
+                    if not len(g):
+                        return
+                faulted = push_word(g, self, (ip + 1) >> 8, (ip + 1) & 0xff)
+                while faulted is not None:
+                    self.fault(g, faulted[0], ip, n, faulted[1], ip + 1)
+                    if not len(g):
+                        return
+                    faulted = push_word(g, self, (ip + 1) >> 8, (ip + 1) & 0xff)
+                next_ip = g.word(R_M1H)
+            elif op == 'RETW':
+                next_ip = pop_word(g, self)
+                bad = next_ip >= len(code)
+                if bad.any():
+                    self.fault(g, bad, ip, n, AssertionError(), ip + 1)
+                    if not len(g):
+                        return
+                    next_ip = next_ip[~bad]
+            elif op == 'JV' or isinstance(op, Branch):
+                high = R_M1H
+                if isinstance(op, Branch):
+                    op.compare(g, self)
+                    op.verdict(g, self)
+                    high = R_M3H
+                bad = g.flags[F_VERDICT] & (g.word(high) >= len(code))
+                if bad.any():
+                    self.fault(g, bad, ip, n, AssertionError(), ip + 1)
+                    if not len(g):
+                        return
+                next_ip = np.where(g.flags[F_VERDICT], g.word(high), ip + 1)
+            else:
+                faulted = op(g, self)
+                while faulted is not None:
+                    self.fault(g, faulted[0], ip, n, faulted[1], ip + 1)
+                    if not len(g):
+                        return
+                    faulted = op(g, self)
+            n += 1
+            ip += 1
+            if next_ip is not None:
+                break
+        g.scatter(self)
+        self.ip[g.idx] = ip if next_ip is None else next_ip
+        self.steps[g.idx] += n
+        for i in g.idx:
+            if self.steps[i] >= self.limit[i]:
+                self.results[i] = RunResult(BUDGET_EXHAUSTED, self.run_steps(i), int(self.ip[i]))
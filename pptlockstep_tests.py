@@ -0,0 +1,140 @@
+import unittest
+import random
+import io
+import pptvm
+import pptlockstep
+from ppttestutils import make_machine, random_block
+
+# Reads n, then prints H or T for each of n coin flips
+COINS_PROGRAM = '''
+    CONSTH 10000000
+    STOREH SPH
+    EXEC GETINT
+    LOAD1H AH
+    LOAD1L AL
+    COPYH
+    COPYL
+    STOREH CH
+    STOREL CL
+    EXEC RAND
+    LOAD1L AL
+    CONSTL 00000001
+    LOAD2L M3L
+    EXEC TESTB
+    EXEC VZ
+    CONSTH 00000000
+    CONSTL 00011000
+    LOAD1H M3H
+    LOAD1L M3L
+    CONSTL 01001000
+    STOREL AL
+    EXEC JV
+    CONSTL 01010100
+    STOREL AL
+    EXEC PUTC
+    LOAD1H CH
+    LOAD1L CL
+    EXEC DECW
+    STOREH CH
+    STOREL CL
+    EXEC VZ
+    EXEC NV
+    CONSTH 00000000
+    CONSTL 00001001
+    LOAD1H M3H
+    LOAD1L M3L
+    EXEC JV
+    EXEC HLT
+'''
+
+def result_tuple(r):
+    return (r.status, r.steps, r.ip, type(r.error))
+
+@unittest.skipIf(pptlockstep.np is None, 'NumPy is not installed')
+class TestLockstep(unittest.TestCase):
+    def test_matches_interpreter(self):
+        n = 50
+        inputs = ['%d\n' % (i % 7 + 1) for i in range(n)]
+        inputs[3] = ''
+        vm = make_machine(COINS_PROGRAM)
+        machines = pptlockstep.LockstepMachines(vm, n, seeds=range(100, 100 + n), inputs=inputs)
+        results = machines.run()
+        outputs = set()
+        for i in range(n):
+            out = io.StringIO()
+            m = make_machine(COINS_PROGRAM, io=pptvm.IOChannel(out=out, inp=io.StringIO(inputs[i])))
+            random.seed(100 + i)
+            self.assertEqual(result_tuple(results[i]), result_tuple(m.run()))
+            self.assertEqual(machines.output(i), out.getvalue())
+            self.assertEqual(bytes(machines.regs[:, i]), bytes(m.regfile))
+            outputs.add(out.getvalue())
+        self.assertEqual(results[3].status, pptvm.FAULT)
+        self.assertGreater(len(outputs), n // 2)
+
+    def test_budget(self):
+        vm = make_machine(COINS_PROGRAM)
+        machines = pptlockstep.LockstepMachines(vm, 4, inputs=['9'] * 4)
+        results = machines.run(max_steps=100)
+        self.assertEqual([r.status for r in results], [pptvm.BUDGET_EXHAUSTED] * 4)
+        self.assertEqual([r.steps for r in results], [100] * 4)
+        results = machines.run()
+        self.assertEqual([r.status for r in results], [pptvm.HALTED] * 4)
+
+    def test_stack_top(self):
+        # Pops and pushes at the top of memory, with one machine's SP odd,
+        # fault only the machines whose stack leaves the data segment
+        program = '''
+            EXEC POPW
+            EXEC PUSHW
+            EXEC HLT
+        '''
+        sps = [0xfffe, 0xffff, 0x0000]
+        vm = make_machine(program, const=b'\x12\x34')
+        machines = pptlockstep.LockstepMachines(vm, len(sps))
+        for i, sp in enumerate(sps):
+            machines.regs[pptvm.R_SPH, i] = sp >> 8
+            machines.regs[pptvm.R_SPL, i] = sp & 0xff
+        results = machines.run()
+        for i, sp in enumerate(sps):
+            m = make_machine(program, const=b'\x12\x34')
+            m._assign_reg('SP', sp)
+            self.assertEqual(result_tuple(results[i]), result_tuple(m.run()))
+            self.assertEqual(bytes(machines.regs[:, i]), bytes(m.regfile))
+            self.assertEqual(bytes(machines.data[i]), bytes(m.data))
+        self.assertEqual([r.status for r in results], [pptvm.HALTED, pptvm.FAULT, pptvm.FAULT])
+
+    def test_random_blocks(self):
+        rng = random.Random(99)
+        n = 20
+        for k in range(60):
+            program = random_block(rng, 40) + '\nEXEC HLT'
+            data = bytes(rng.randrange(256) for i in range(64))
+            vm = make_machine(program, data=data, const=data)
+            machines = pptlockstep.LockstepMachines(vm, n)
+            starts = []
+            for i in range(n):
+                regs = bytearray(rng.randrange(256) for r in pptvm.REG_NAMES)
+                regs[pptvm.R_M1H] |= 0x80
+                regs[pptvm.R_SPL] &= 0xfe
+                mp = pptvm.DATA_BASE + rng.randrange(32)
+                flags = [rng.random() < 0.5 for f in pptvm.FLAG_NAMES]
+                machines.regs[:, i] = list(regs)
+                machines.mp[i] = mp
+                machines.flags[:, i] = flags
+                starts.append((regs, mp, flags))
+            results = machines.run()
+            for i, (regs, mp, flags) in enumerate(starts):
+                m = make_machine(program, data=data, const=data)
+                m.regfile[:] = regs
+                m.mp = mp
+                for f, value in zip(pptvm.FLAG_NAMES, flags):
+                    setattr(m.flags, f, value)
+                self.assertEqual(result_tuple(results[i]), result_tuple(m.run()), program)
+                self.assertEqual(bytes(machines.regs[:, i]), bytes(m.regfile), program)
+                self.assertEqual(list(machines.flags[:, i]), [getattr(m.flags, f) for f in pptvm.FLAG_NAMES], program)
+                self.assertEqual(machines.mp[i], m.mp, program)
+                self.assertEqual(bytes(machines.data[i]), bytes(m.data), program)
+
+
+if __name__ == '__main__':
+    unittest.main()
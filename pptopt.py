@@ -0,0 +1,335 @@
+import itertools
+import collections
+from pptutils import BRANCH_OPS, LOCAL_LABEL_PREFIXES, STARTUP
+from pptasm import PptInstruction
+
+# Registers that only hold values within the expansion of one x86 line,
+# plus mp and the verdict flag. Every line is expanded on its own, so none
+# of them is live at a label.
+SCRATCH = {'M1H', 'M1L', 'M2H', 'M2L', 'M3H', 'M3L', 'M4H', 'M4L', 'M5H', 'M5L', 'MP', 'VERDICT'}
+
+M1 = {'M1H', 'M1L'}
+M2 = {'M2H', 'M2L'}
+M3 = {'M3H', 'M3L'}
+
+# (reads, writes) of the EXEC ops the passes know about. Other EXEC ops are
+# assumed to read all of M1-M3 and to write nothing.
+EXEC_EFFECTS = {
+    'SMP': (M1, {'MP'}),
+    'IMP': ({'MP'}, {'MP'}),
+    'DMP': ({'MP'}, {'MP'}),
+    'RMEM': ({'MP'}, {'M3L'}),
+    'WMEM': ({'MP', 'M2L'}, set()),
+    'DEC2W': (M1, M3),
+    'INC2W': (M1, M3),
+    'SHIFTADDR1': (M1, M3),
+    'SHIFTADDR2': (M1, M3),
+    'SHIFTADDR3': (M1, M3),
+    'ADDADDR': (M1 | M2, M3),
+    'JMP': (M1, set()),
+    'JV': (M1 | {'VERDICT'}, set()),
+    'RMEMW': ({'MP'}, M3),
+    'WMEMW': ({'MP'} | M3, set()),
+    'PUSHW': (M1, set()),
+    'POPW': (set(), M3),
+    'CALLW': (M1, set()),
+    'RETW': (set(), set()),
+    'NV': ({'VERDICT'}, {'VERDICT'}),
+    'HLT': (set(), set()),
+}
+for cond in ['A', 'C', 'Z', 'O', 'S', 'G', 'L']:
+    EXEC_EFFECTS['V' + cond] = (set(), {'VERDICT'})
+for name in BRANCH_OPS:
+    EXEC_EFFECTS[name] = (M1 | M2 | M3, {'VERDICT'})
+DEFAULT_EXEC_EFFECTS = (M1 | M2 | M3, set())
+
+# EXEC ops that can be dropped when all they write is dead
+PURE_EXEC = set(EXEC_EFFECTS) - {'WMEM', 'WMEMW', 'JMP', 'JV', 'HLT', 'PUSHW', 'POPW', 'CALLW', 'RETW'} - set(BRANCH_OPS)
+
+# EXEC ops after which nothing is live, since the line that follows is only
+# reached by a jump if at all
+JUMP_EXEC = ['JMP', 'HLT', 'CALLW', 'RETW']
+
+def effects(inst):
+    """(reads, writes) of inst on the scratch registers."""
+    cmd = inst.cmd
+    if cmd == 'EXEC':
+        return EXEC_EFFECTS.get(inst.arg, DEFAULT_EXEC_EFFECTS)
+    if cmd.startswith('LOAD'):
+        return {inst.arg} & SCRATCH, {'M' + cmd[4] + cmd[5]}
+    if cmd.startswith('STORE'):
+        return {'M3' + cmd[5]}, {inst.arg} & SCRATCH
+    if cmd.startswith('COPY'):
+        return {'M1' + cmd[4]}, {'M3' + cmd[4]}
+    if cmd.startswith('CLEAR'):
+        return set(), {'M' + cmd[6] + cmd[5]}
+    if cmd.startswith('CONST'):
+        return set(), {'M3' + cmd[5]}
+    return set(), set()
+
+def is_pure(inst):
+    """Whether inst does nothing but write scratch registers."""
+    if inst.cmd == 'EXEC':
+        return inst.arg in PURE_EXEC
+    if inst.cmd.startswith('STORE'):
+        return inst.arg in SCRATCH
+    return inst.cmd != 'LABEL'
+
+def live_after(code):
+    """The scratch registers live after each instruction of code."""
+    live = set()
+    result = [None] * len(code)
+    for i in range(len(code) - 1, -1, -1):
+        inst = code[i]
+        if inst.cmd == 'LABEL':
+            result[i] = live
+            live = set()
+            continue
+        if inst.cmd == 'EXEC' and inst.arg in JUMP_EXEC:
+            live = set()
+        result[i] = live
+        reads, writes = effects(inst)
+        live = (live - writes) | reads
+    return result
+
+def parse_pattern(text):
+    """'CMD ARG | CMD | ...' as a list of (cmd, arg) pairs."""
+    pattern = []
+    for part in text.split('|'):
+        words = part.split()
+        pattern.append((words[0], words[1] if len(words) > 1 else None))
+    return pattern
+
+def is_immediate(arg):
+    # Not isinstance, since run as a script pptasm's are __main__.Immediate
+    return hasattr(arg, 'to_binary')
+
+def arg_key(arg):
+    """Value of an argument for comparisons, under which a label's name
+    matches an Immediate of that label."""
+    if is_immediate(arg):
+        return ('IMM', arg.label, arg.offset)
+    return arg
+
+class PeepholeRule:
+    """Replaces a run of instructions matching pattern with replacement.
+    Arguments written $name match anything, but the same thing each time.
+    The replacement may leave the scratch registers in clobbers holding
+    different values, so the rule only applies where they are dead."""
+    def __init__(self, name, pattern, replacement, clobbers=()):
+        self.name = name
+        self.pattern = parse_pattern(pattern)
+        self.replacement = parse_pattern(replacement) if replacement else []
+        self.clobbers = set(clobbers)
+
+    def match(self, code, i):
+        """The bindings of the pattern's variables if it matches code at i."""
+        if i + len(self.pattern) > len(code):
+            return None
+        bindings = {}
+        for (cmd, arg), inst in zip(self.pattern, code[i:]):
+            if cmd != inst.cmd:
+                return None
+            if arg is not None and arg.startswith('$'):
+                key = arg_key(inst.arg)
+                if inst.cmd == 'LABEL':
+                    key = ('IMM', inst.arg, 0)
+                if bindings.setdefault(arg, (key, inst.arg))[0] != key:
+                    return None
+            elif arg != inst.arg:
+                return None
+        return bindings
+
+    def apply(self, bindings):
+        code = []
+        for cmd, arg in self.replacement:
+            if arg is not None and arg.startswith('$'):
+                key, arg = bindings[arg]
+                if cmd == 'LABEL':
+                    arg = key[1]
+            code.append(PptInstruction(cmd, arg))
+        return code
+
+PEEPHOLE_RULES = [
+    # Pushes: set mp from the old SP in M1 and step down to the new SP, so
+    # that the high byte is written first and SP needn't be loaded again.
+    PeepholeRule('push',
+        'EXEC DEC2W | STOREH SPH | STOREL SPL | LOAD1H SPH | LOAD1L SPL | EXEC SMP | '
+        'LOAD2L $l | EXEC WMEM | EXEC IMP | LOAD2L $h | EXEC WMEM',
+        'EXEC DEC2W | STOREH SPH | STOREL SPL | EXEC SMP | EXEC DMP | '
+        'LOAD2L $h | EXEC WMEM | EXEC DMP | LOAD2L $l | EXEC WMEM',
+        clobbers=['M1H', 'M1L', 'M2L', 'MP']),
+    PeepholeRule('push constant',
+        'EXEC DEC2W | STOREH SPH | STOREL SPL | LOAD1H SPH | LOAD1L SPL | EXEC SMP | '
+        'CONSTH $c | CONSTL $d | LOAD2L $l | EXEC WMEM | EXEC IMP | LOAD2L $h | EXEC WMEM',
+        'EXEC DEC2W | STOREH SPH | STOREL SPL | EXEC SMP | EXEC DMP | '
+        'CONSTH $c | CONSTL $d | LOAD2L $h | EXEC WMEM | EXEC DMP | LOAD2L $l | EXEC WMEM',
+        clobbers=['M1H', 'M1L', 'M2L', 'MP']),
+    # A register moved to itself
+    PeepholeRule('store back word',
+        'LOAD1H $h | LOAD1L $l | COPYH | COPYL | STOREH $h | STOREL $l',
+        'LOAD1H $h | LOAD1L $l | COPYH | COPYL'),
+    PeepholeRule('store back byte',
+        'LOAD1L $l | COPYL | STOREL $l',
+        'LOAD1L $l | COPYL'),
+    # M1 still holds the value moved, so loading either end of the move
+    # into it again does nothing
+    PeepholeRule('reload source',
+        'LOAD1H $h | LOAD1L $l | COPYH | COPYL | STOREH $a | STOREL $b | LOAD1H $h | LOAD1L $l',
+        'LOAD1H $h | LOAD1L $l | COPYH | COPYL | STOREH $a | STOREL $b'),
+    PeepholeRule('reload destination',
+        'LOAD1H $h | LOAD1L $l | COPYH | COPYL | STOREH $a | STOREL $b | LOAD1H $a | LOAD1L $b',
+        'LOAD1H $h | LOAD1L $l | COPYH | COPYL | STOREH $a | STOREL $b'),
+    # Jumps to the next instruction
+    PeepholeRule('jump to next',
+        'CONSTH $t | CONSTL $t | LOAD1H M3H | LOAD1L M3L | EXEC JMP | LABEL $t',
+        'LABEL $t'),
+    PeepholeRule('branch to next',
+        'CONSTH $t | CONSTL $t | LOAD1H M3H | LOAD1L M3L | EXEC JV | LABEL $t',
+        'LABEL $t'),
+]
+
+def peephole(code, rules=PEEPHOLE_RULES):
+    """Rewrites code, a list of PptInstructions with LABEL pseudo-instructions,
+    with rules and drops instructions that only write dead scratch registers,
+    until neither changes anything. The source comment of a removed
+    instruction moves to the next one kept, unless a label comes first."""
+    changed = True
+    while changed:
+        changed = False
+        live = live_after(code)
+        result = []
+        comments = []
+        i = 0
+        while i < len(code):
+            window = code[i:i + 1]
+            new_code = window
+            for rule in rules:
+                bindings = rule.match(code, i)
+                if bindings is not None and not rule.clobbers & live[i + len(rule.pattern) - 1]:
+                    window = code[i:i + len(rule.pattern)]
+                    new_code = rule.apply(bindings)
+                    break
+            else:
+                if is_pure(code[i]) and not effects(code[i])[1] & live[i]:
+                    new_code = []
+            i += len(window)
+            removed = []
+            if new_code is not window:
+                changed = True
+                labels = [inst for inst in new_code if inst.cmd == 'LABEL']
+                if new_code and not labels and window[0].comment is not None:
+                    new_code[0].comment = window[0].comment
+                    window = window[1:]
+                if not labels:
+                    removed = [inst.comment for inst in window if inst.comment is not None]
+            for inst in new_code:
+                comments = keep(result, inst, comments)
+            comments += removed
+        code = result
+    return code
+
+def keep(result, inst, comments):
+    """Appends inst to result with the comments of the instructions removed
+    before it. Returns the comments still waiting for an instruction."""
+    if inst.cmd == 'LABEL':
+        comments = []
+    elif comments:
+        inst.comment = '; '.join(comments + [inst.comment] if inst.comment else comments)
+        comments = []
+    result.append(inst)
+    return comments
+
+# EXEC ops whose only register writes are to M3, and ones that write none
+M3_EXEC = {
+    'ADDB', 'ADDW', 'ADCB', 'ADCW', 'SUBB', 'SUBW', 'SBBB', 'SBBW',
+    'ANDB', 'ANDW', 'ORB', 'ORW', 'XORB', 'XORW', 'INCB', 'INCW', 'DECB', 'DECW',
+    'NEGB', 'NEGW', 'NOTB', 'NOTW', 'SARB', 'SARW', 'SHLB', 'SHLW', 'SHRB', 'SHRW',
+    'INC2W', 'DEC2W', 'ADDADDR', 'SHIFTADDR1', 'SHIFTADDR2', 'SHIFTADDR3', 'RMEM', 'RMEMW'}
+NO_REGS_EXEC = {
+    'SMP', 'IMP', 'DMP', 'WMEM', 'WMEMW', 'CMPB', 'CMPW', 'TESTB', 'TESTW',
+    'VA', 'VC', 'VZ', 'VO', 'VS', 'VG', 'VL', 'NV', 'CLC', 'STC', 'CMC'}
+
+def const_value(inst):
+    """The byte that a CONSTH or CONSTL puts in M3, or a key standing for it
+    if it depends on a label."""
+    arg = inst.arg
+    if is_immediate(arg):
+        if arg.label is not None:
+            return ('CONST', inst.cmd, arg.label, arg.offset, arg.size)
+        bits = arg.to_binary({})
+        arg = bits[:8] if inst.cmd == 'CONSTH' else bits[-8:]
+    return ('CONST', arg)
+
+def track_values(code):
+    """Drops the moves in code that put a value in a register that already
+    holds it, knowing which register or constant each register was last set
+    from. What is known is forgotten at labels and after EXEC ops that may
+    write registers other than M3, such as jumps, calls to builtins and
+    multiplication."""
+    result = []
+    comments = []
+    values = {}
+    fresh = itertools.count()
+    def value(reg):
+        if reg not in values:
+            values[reg] = ('UNKNOWN', next(fresh))
+        return values[reg]
+    for inst in code:
+        cmd = inst.cmd
+        dst = None
+        if cmd.startswith('LOAD'):
+            dst, new_value = 'M' + cmd[4] + cmd[5], value(inst.arg)
+        elif cmd.startswith('STORE'):
+            dst, new_value = inst.arg, value('M3' + cmd[5])
+        elif cmd.startswith('COPY'):
+            dst, new_value = 'M3' + cmd[4], value('M1' + cmd[4])
+        elif cmd.startswith('CLEAR'):
+            dst, new_value = 'M' + cmd[6] + cmd[5], ('CONST', '00000000')
+        elif cmd.startswith('CONST'):
+            dst, new_value = 'M3' + cmd[5], const_value(inst)
+        elif cmd == 'EXEC' and inst.arg in M3_EXEC:
+            values['M3H'] = ('UNKNOWN', next(fresh))
+            values['M3L'] = ('UNKNOWN', next(fresh))
+        elif cmd != 'EXEC' or inst.arg not in NO_REGS_EXEC:
+            values = {}
+        if dst is not None:
+            if value(dst) == new_value:
+                if inst.comment is not None:
+                    comments.append(inst.comment)
+                continue
+            values[dst] = new_value
+        comments = keep(result, inst, comments)
+    return result
+
+def function_sizes(code):
+    """Number of instructions in each function of code."""
+    sizes = collections.Counter()
+    function = STARTUP
+    for inst in code:
+        if inst.cmd != 'LABEL':
+            sizes[function] += 1
+        elif not inst.arg.startswith(LOCAL_LABEL_PREFIXES):
+            function = inst.arg
+    return sizes
+
+def optimize(code):
+    """Runs the optimization passes over code. Returns the new code and the
+    size of each function as {name: (before, after)}."""
+    before = function_sizes(code)
+    size = None
+    while len(code) != size:
+        size = len(code)
+        code = peephole(track_values(code))
+    after = function_sizes(code)
+    return code, { f: (n, after[f]) for f, n in before.items() }
+
+def report(sizes):
+    """The micro-ops removed from each function, as text."""
+    lines = ['%-24s %8s %8s %8s' % ('function', 'before', 'after', 'removed')]
+    for f, (before, after) in sizes.items():
+        lines.append('%-24s %8d %8d %8d' % (f, before, after, before - after))
+    before = sum(b for b, a in sizes.values())
+    after = sum(a for b, a in sizes.values())
+    lines.append('%-24s %8d %8d %8d' % ('total', before, after, before - after))
+    return '\n'.join(lines)
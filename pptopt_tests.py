@@ -0,0 +1,167 @@
+import unittest
+import tempfile
+import os
+import io
+import pptvm
+import pptasm
+import pptopt
+from pptasm import PptInstruction
+from ppttestutils import PRIMES_GAS
+
+def parse_code(text):
+    code = []
+    for line in text.strip().split('\n'):
+        line, _, comment = line.partition('#')
+        parts = line.split()
+        code.append(PptInstruction(parts[0], parts[1] if len(parts) > 1 else None))
+        code[-1].comment = comment.strip() or None
+    return code
+
+def code_text(code):
+    return [(inst.cmd, str(inst.arg) if inst.arg is not None else None, inst.comment) for inst in code]
+
+class TestPeephole(unittest.TestCase):
+    def test_push(self):
+        code = pptasm.code_for_line('pushw %bx', 0) + [PptInstruction('LABEL', 'L$1')]
+        optimized = pptopt.peephole(code)
+        self.assertEqual(len(optimized), len(code) - 1)
+        self.assertEqual([i.cmd + ' ' + str(i.arg) for i in optimized[-5:-1]],
+                         ['EXEC WMEM', 'EXEC DMP', 'LOAD2L BL', 'EXEC WMEM'])
+
+    def test_live_scratch_is_kept(self):
+        # M1 is read by the JMP, so the loads of SP must stay
+        code = parse_code('''
+            EXEC DEC2W
+            STOREH SPH
+            STOREL SPL
+            LOAD1H SPH
+            LOAD1L SPL
+            EXEC SMP
+            LOAD2L BL
+            EXEC WMEM
+            EXEC IMP
+            LOAD2L BH
+            EXEC WMEM
+            EXEC JMP
+        ''')
+        self.assertEqual(code_text(pptopt.peephole(code)), code_text(code))
+
+    def test_comments(self):
+        code = parse_code('''
+            LOAD1H BH  # movw %bx,%ax
+            LOAD1L BL
+            COPYH
+            COPYL
+            STOREH AH
+            STOREL AL
+            LOAD1H AH  # imulw %ax
+            LOAD1L AL
+            EXEC IMULW
+            CONSTH L$1  # jmp L$1
+            CONSTL L$1
+            LOAD1H M3H
+            LOAD1L M3L
+            EXEC JMP
+            LABEL L$1
+            LOAD1H CH  # movw %cx,%cx
+            LOAD1L CL
+            COPYH
+            COPYL
+            STOREH CH
+            STOREL CL
+            EXEC HLT  # hlt
+        ''')
+        for inst in code:
+            if inst.cmd.startswith('CONST'):
+                inst.arg = pptasm.Immediate(0, 'w', 'L$1')
+        self.assertEqual(code_text(pptopt.peephole(code)), [
+            ('LOAD1H', 'BH', 'movw %bx,%ax'),
+            ('LOAD1L', 'BL', None),
+            ('COPYH', None, None),
+            ('COPYL', None, None),
+            ('STOREH', 'AH', None),
+            ('STOREL', 'AL', None),
+            ('EXEC', 'IMULW', 'imulw %ax'),
+            ('LABEL', 'L$1', None),
+            ('EXEC', 'HLT', 'movw %cx,%cx; hlt')])
+
+    def test_track_values(self):
+        # CX, M1 and M2H already hold what is loaded into them, until IMULW
+        # writes AX and DX and the label is reached
+        code = parse_code('''
+            LOAD1H AH  # movw %ax,%cx
+            LOAD1L AL
+            COPYH
+            COPYL
+            STOREH CH
+            STOREL CL
+            CONSTH 00000000  # cmpw $0x2,%ax
+            CONSTL 00000010
+            LOAD2H M3H
+            LOAD2L M3L
+            LOAD1H AH
+            LOAD1L AL
+            EXEC CMPW
+            CONSTH 00000000  # addw $0x5,%cx
+            CONSTL 00000101
+            LOAD2H M3H
+            LOAD2L M3L
+            LOAD1H CH
+            LOAD1L CL
+            EXEC ADDW
+            STOREH CH
+            STOREL CL
+            LOAD1H AH  # imulw %ax
+            LOAD1L AL
+            EXEC IMULW
+            LOAD1H AH
+            LABEL L$1
+            LOAD1H AH
+        ''')
+        self.assertEqual(code_text(pptopt.track_values(code)), [
+            ('LOAD1H', 'AH', 'movw %ax,%cx'),
+            ('LOAD1L', 'AL', None),
+            ('COPYH', None, None),
+            ('COPYL', None, None),
+            ('STOREH', 'CH', None),
+            ('STOREL', 'CL', None),
+            ('CONSTH', '00000000', 'cmpw $0x2,%ax'),
+            ('CONSTL', '00000010', None),
+            ('LOAD2H', 'M3H', None),
+            ('LOAD2L', 'M3L', None),
+            ('EXEC', 'CMPW', None),
+            ('CONSTL', '00000101', 'addw $0x5,%cx'),
+            ('LOAD2L', 'M3L', None),
+            ('EXEC', 'ADDW', None),
+            ('STOREH', 'CH', None),
+            ('STOREL', 'CL', None),
+            ('EXEC', 'IMULW', 'imulw %ax'),
+            ('LOAD1H', 'AH', None),
+            ('LABEL', 'L$1', None),
+            ('LOAD1H', 'AH', None)])
+
+    def test_assemble(self):
+        with tempfile.TemporaryDirectory() as d:
+            source = os.path.join(d, 'primes.gas')
+            with open(source, 'wt') as f:
+                f.write(PRIMES_GAS)
+            outputs = []
+            for optimize in [False, True]:
+                path = os.path.join(d, 'primes%d.pptasm' % optimize)
+                sizes = pptasm.assemble_gas(source, path, optimize=optimize)
+                m = pptvm.load_file(path, io=pptvm.IOChannel(out=io.StringIO()))
+                result = m.run()
+                self.assertEqual(result.status, pptvm.HALTED)
+                outputs.append((m.io.out.getvalue(), len(m.instructions), result.steps))
+            self.assertIsNone(pptasm.assemble_gas(source, path))
+            self.assertEqual(outputs[0][0], '2 is prime!\n3 is prime!\n5 is prime!\n7 is prime!\n11 is prime!\n'
+                             '13 is prime!\n17 is prime!\n19 is prime!\n23 is prime!\n29 is prime!\n')
+            self.assertEqual(outputs[1][0], outputs[0][0])
+            self.assertLess(outputs[1][2], outputs[0][2])
+            self.assertEqual(sum(before - after for before, after in sizes.values()), outputs[0][1] - outputs[1][1])
+            self.assertGreater(sizes['isprime_'][0], sizes['isprime_'][1])
+            self.assertIn('isprime_', pptopt.report(sizes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import json
+from collections import Counter
+from pptvm import *
+
+def counted_op(counts, ip, op):
+    def op_and_count():
+        counts[ip] += 1
+        op()
+    return op_and_count
+
+class Profiler:
+    """Counts how many times each instruction of a machine runs, by swapping
+    vm.code for a copy whose ops also bump counts[ip]. The interpreter pays
+    for this only while the profiler is attached. JIT blocks do not go
+    through vm.code, so the machine has to run without the JIT."""
+    def __init__(self, vm):
+        if vm.jit is not None:
+            raise Exception('Cannot profile a machine that uses the JIT')
+        self.vm = vm
+        self.counts = [0] * len(vm.code)
+        self.code = vm.code
+        vm.code = [counted_op(self.counts, ip, op) for ip, op in enumerate(vm.code)]
+
+    def detach(self):
+        self.vm.code = self.code
+
+    def total(self):
+        return sum(self.counts)
+
+    def line_counts(self):
+        """[ip, x86 line, times run, micro-ops run] for each x86 instruction.
+        pptasm puts the x86 line in the comment of the first micro-op of its
+        expansion; micro-ops before the first comment are the startup code."""
+        lines = []
+        for ip, inst in enumerate(self.vm.instructions):
+            if inst.comment is not None or not lines:
+                lines.append([ip, inst.comment or STARTUP, self.counts[ip], 0])
+            lines[-1][3] += self.counts[ip]
+        return lines
+
+    def function_counts(self):
+        """Micro-ops run under each function label."""
+        starts = sorted((ip, name) for name, ip in self.vm.symbols.items()
+                        if not name.startswith(LOCAL_LABEL_PREFIXES))
+        functions = Counter()
+        name = STARTUP
+        j = 0
+        for ip, count in enumerate(self.counts):
+            while j < len(starts) and starts[j][0] <= ip:
+                name = starts[j][1]
+                j += 1
+            if count:
+                functions[name] += count
+        return functions
+
+    def exec_counts(self):
+        ops = Counter()
+        for inst, count in zip(self.vm.instructions, self.counts):
+            if inst.cmd == 'EXEC' and count:
+                ops[inst.args[0]] += count
+        return ops
+
+    def to_json(self):
+        return {
+            'total': self.total(),
+            'ips': { ip: count for ip, count in enumerate(self.counts) if count },
+            'lines': [
+                { 'ip': ip, 'line': line, 'runs': runs, 'micro_ops': ops }
+                for ip, line, runs, ops in self.line_counts() if ops],
+            'functions': dict(self.function_counts()),
+            'exec_ops': dict(self.exec_counts()),
+        }
+
+    def dump(self, path):
+        with open(path, mode='wt') as file:
+            json.dump(self.to_json(), file, indent=1)
+
+    def report(self, top=20):
+        """Hot spots as text: the top functions, x86 lines and EXEC ops."""
+        total = max(self.total(), 1)
+        out = ['%d micro-ops' % self.total(), '', 'Functions:']
+        for name, count in self.function_counts().most_common(top):
+            out.append('  %6.2f%%  %10d  %s' % (100 * count / total, count, name))
+        out += ['', 'x86 lines:']
+        lines = sorted(self.line_counts(), key=lambda l: -l[3])[:top]
+        for ip, line, runs, ops in lines:
+            if ops:
+                out.append('  %6.2f%%  %10d  %04x  %-30s (%d runs)' % (
+                    100 * ops / total, ops, ip, line, runs))
+        out += ['', 'EXEC ops:']
+        for name, count in self.exec_counts().most_common(top):
+            out.append('  %6.2f%%  %10d  %s' % (100 * count / total, count, name))
+        return '\n'.join(out)
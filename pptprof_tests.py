@@ -0,0 +1,33 @@
+import unittest
+import pptvm
+import pptprof
+from ppttestutils import make_machine, COUNTDOWN_PROGRAM
+
+class TestProfiler(unittest.TestCase):
+    def test_counts(self):
+        m = make_machine(COUNTDOWN_PROGRAM)
+        m.symbols = {'main_': 0, 'L$1': 2, 'R$3': 7}
+        profiler = pptprof.Profiler(m)
+        self.assertEqual(m.run().status, pptvm.HALTED)
+        self.assertEqual(profiler.counts[:3], [1, 1, 3])
+        self.assertEqual(profiler.total(), 2 + 3 * 5 + 3 * 7 + 1)
+        self.assertEqual(profiler.line_counts(), [
+            [0, 'movw $3,%cx', 1, 2],
+            [2, 'decw %cx', 3, 15],
+            [7, 'jne L$1', 3, 21],
+            [14, 'hlt', 1, 1]])
+        self.assertEqual(profiler.function_counts(), {'main_': 39})
+        self.assertEqual(profiler.exec_counts()['JV'], 3)
+        self.assertIn('decw %cx', profiler.report())
+        self.assertEqual(profiler.to_json()['ips'][7], 3)
+        profiler.detach()
+        self.assertIs(m.code, profiler.code)
+
+    def test_rejects_jit(self):
+        m = pptvm.MachineState([], jit=True)
+        with self.assertRaises(Exception):
+            pptprof.Profiler(m)
+
+
+if __name__ == '__main__':
+    unittest.main()
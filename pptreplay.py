@@ -0,0 +1,169 @@
+import zlib
+import struct
+from pptvm import *
+
+# RAND, GETS and GETINT are the only ops whose results don't follow from the
+# machine's state. A log holds one event per execution of them: RAND_EVENT
+# and the value put in A, or LINE_EVENT, the line's length and the line as
+# UTF-8. CHECKPOINT_EVENT, a length and a Snapshot's state compressed with
+# zlib mark a checkpoint, which a replay can resume from. The state is mostly
+# the 32 KiB data segment, which compresses to a few hundred bytes for
+# typical programs.
+RAND_EVENT = b'R'
+LINE_EVENT = b'L'
+CHECKPOINT_EVENT = b'C'
+RAND_VALUE = struct.Struct('<H')
+LINE_LENGTH = struct.Struct('<I')
+
+INPUT_OPS = ['GETS', 'GETINT']
+
+class Checkpoint:
+    """Snapshot of a recorded machine, and how many bytes of the log it had
+    written when the snapshot was taken."""
+    def __init__(self, snapshot, position):
+        self.snapshot = snapshot
+        self.position = position
+
+def read_checkpoints(vm, log):
+    """The checkpoints saved in log, in order, as snapshots of vm's program."""
+    checkpoints = []
+    pos = 0
+    while pos < len(log):
+        tag = log[pos:pos + 1]
+        pos += 1
+        if tag == RAND_EVENT:
+            pos += RAND_VALUE.size
+            continue
+        if tag not in (LINE_EVENT, CHECKPOINT_EVENT):
+            raise Exception('Replay log has an unknown %s event' % tag.decode('latin-1'))
+        length, = LINE_LENGTH.unpack_from(log, pos)
+        pos += LINE_LENGTH.size + length
+        if tag == CHECKPOINT_EVENT:
+            state = zlib.decompress(log[pos - length:pos])
+            snapshot = Snapshot(vm.instructions, vm.const, state, vm.symbols)
+            checkpoints.append(Checkpoint(snapshot, pos))
+    return checkpoints
+
+def wrap_ops(vm, wrap_rand, wrap_input):
+    """Swaps vm.code for a copy with the RAND and input ops wrapped. Returns
+    the original list."""
+    code = vm.code
+    vm.code = list(code)
+    for ip, inst in enumerate(vm.instructions):
+        if inst.cmd == 'EXEC' and inst.args[0] == 'RAND':
+            vm.code[ip] = wrap_rand(code[ip])
+        elif inst.cmd == 'EXEC' and inst.args[0] in INPUT_OPS:
+            vm.code[ip] = wrap_input(code[ip])
+    return code
+
+class Recorder:
+    """Logs the results of the nondeterministic ops as vm runs."""
+    def __init__(self, vm):
+        self.vm = vm
+        self.log = bytearray()
+        self.code = wrap_ops(vm, self.recorded_rand, self.recorded_input)
+
+    def recorded_rand(self, op):
+        vm = self.vm
+        log = self.log
+        def rand_and_record():
+            op()
+            log.extend(RAND_EVENT + RAND_VALUE.pack(vm._read_reg('A')))
+        return rand_and_record
+
+    def recorded_input(self, op):
+        vm = self.vm
+        log = self.log
+        def input_and_record():
+            # Read the line here, then put it back for op to read
+            line = vm.io.readline()
+            data = line.encode('utf-8')
+            log.extend(LINE_EVENT + LINE_LENGTH.pack(len(data)) + data)
+            vm.io.lines.appendleft(line)
+            op()
+        return input_and_record
+
+    def checkpoint(self):
+        """Saves the machine's state in the log, and returns it."""
+        snapshot = self.vm.snapshot()
+        state = zlib.compress(snapshot.state, 1)
+        self.log.extend(CHECKPOINT_EVENT + LINE_LENGTH.pack(len(state)) + state)
+        return Checkpoint(snapshot, len(self.log))
+
+    def save(self, path):
+        with open(path, mode='wb') as file:
+            file.write(self.log)
+
+    def detach(self):
+        self.vm.code = self.code
+
+class Replayer:
+    """Feeds the events in log back to vm in place of RAND and its input.
+    Given a checkpoint, vm is restored to it and the replay starts at the
+    checkpoint's place in the log, skipping everything before it. Other
+    checkpoints in the log are passed over."""
+    def __init__(self, vm, log, checkpoint=None):
+        self.vm = vm
+        self.log = bytes(log)
+        self.position = 0
+        if checkpoint is not None:
+            vm.restore(checkpoint.snapshot)
+            self.position = checkpoint.position
+        self.code = wrap_ops(vm, self.replayed_rand, self.replayed_input)
+
+    @classmethod
+    def load(cls, vm, path, checkpoint=None):
+        """A replay of the log saved at path, resuming from its checkpoint
+        with index checkpoint if that is given."""
+        with open(path, mode='rb') as file:
+            log = file.read()
+        if checkpoint is not None:
+            checkpoints = read_checkpoints(vm, log)
+            if not -len(checkpoints) <= checkpoint < len(checkpoints):
+                raise Exception('Replay log has %d checkpoints' % len(checkpoints))
+            checkpoint = checkpoints[checkpoint]
+        return cls(vm, log, checkpoint)
+
+    def skip_checkpoints(self):
+        while self.log[self.position:self.position + 1] == CHECKPOINT_EVENT:
+            length, = LINE_LENGTH.unpack_from(self.log, self.position + 1)
+            self.position += 1 + LINE_LENGTH.size + length
+
+    def next_event(self, tag):
+        """The payload of the next event, which must be a tag event."""
+        self.skip_checkpoints()
+        pos = self.position
+        if pos >= len(self.log):
+            raise Exception('Replay log is exhausted')
+        if self.log[pos:pos + 1] != tag:
+            raise Exception('Replay log has a %s event where %s was expected' % (
+                self.log[pos:pos + 1].decode('latin-1'), tag.decode('latin-1')))
+        pos += 1
+        if tag == RAND_EVENT:
+            value, = RAND_VALUE.unpack_from(self.log, pos)
+            self.position = pos + RAND_VALUE.size
+            return value
+        length, = LINE_LENGTH.unpack_from(self.log, pos)
+        pos += LINE_LENGTH.size
+        self.position = pos + length
+        return self.log[pos:pos + length].decode('utf-8')
+
+    def replayed_rand(self, op):
+        vm = self.vm
+        def rand_from_log():
+            vm._assign_reg('A', self.next_event(RAND_EVENT))
+        return rand_from_log
+
+    def replayed_input(self, op):
+        vm = self.vm
+        def input_from_log():
+            vm.io.lines.appendleft(self.next_event(LINE_EVENT))
+            op()
+        return input_from_log
+
+    def finished(self):
+        self.skip_checkpoints()
+        return self.position == len(self.log)
+
+    def detach(self):
+        self.vm.code = self.code
@@ -0,0 +1,92 @@
+import unittest
+import random
+import tempfile
+import os
+import io
+import pptvm
+import pptreplay
+from ppttestutils import make_machine
+
+# Echoes a line, a random number, an int and another random number
+PROGRAM = '''
+    EXEC GETS
+    EXEC PUTS
+    EXEC RAND
+    EXEC PUTINT
+    EXEC GETINT
+    EXEC PUTINT
+    EXEC RAND
+    EXEC PUTINT
+    EXEC HLT
+'''
+
+# GETS stores the line at AX, which has to be in the data segment
+REGS = {'AH': 0x80}
+
+class TestReplay(unittest.TestCase):
+    def test_record_and_replay(self):
+        for jit in [False, True]:
+            m = make_machine(PROGRAM, console=True, regs=REGS, jit=jit)
+            m.io.feed('hello\n-7\n')
+            recorder = pptreplay.Recorder(m)
+            random.seed(1)
+            m.run(max_steps=4)
+            checkpoint = recorder.checkpoint()
+            self.assertEqual(m.run().status, pptvm.HALTED)
+            recorder.detach()
+            recorded = m.io.out.getvalue()
+            self.assertTrue(recorded.startswith('hello'))
+
+            random.seed(2)
+            m = make_machine(PROGRAM, console=True, regs=REGS, jit=jit)
+            replayer = pptreplay.Replayer(m, recorder.log)
+            self.assertEqual(m.run().status, pptvm.HALTED)
+            self.assertEqual(m.io.out.getvalue(), recorded)
+            self.assertTrue(replayer.finished())
+
+            m = pptvm.MachineState.from_snapshot(checkpoint.snapshot, io=pptvm.IOChannel(out=io.StringIO()))
+            replayer = pptreplay.Replayer(m, recorder.log, checkpoint)
+            self.assertEqual(m.run().status, pptvm.HALTED)
+            self.assertTrue(recorded.endswith(m.io.out.getvalue()))
+            self.assertEqual(m.io.out.getvalue()[:2], '-7')
+
+    def test_saved_checkpoints(self):
+        # A replay in a new machine resumes from a checkpoint read back from
+        # the saved log, and a full replay passes over the checkpoints
+        m = make_machine(PROGRAM, console=True, regs=REGS)
+        m.io.feed('hello\n-7\n')
+        recorder = pptreplay.Recorder(m)
+        for steps in [2, 2, 2]:
+            m.run(max_steps=steps)
+            recorder.checkpoint()
+        m.run()
+        recorded = m.io.out.getvalue()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'program.log')
+            recorder.save(path)
+            self.assertEqual(len(pptreplay.read_checkpoints(m, recorder.log)), 3)
+            # The checkpoints' data segments are compressed
+            self.assertLess(len(recorder.log), pptvm.SEGMENT_SIZE)
+            rest = recorded[recorded.index('-7'):]
+            for checkpoint, output in [(None, recorded), (1, rest), (-1, rest[2:])]:
+                m = make_machine(PROGRAM, console=True, regs=REGS)
+                replayer = pptreplay.Replayer.load(m, path, checkpoint)
+                self.assertEqual(m.run().status, pptvm.HALTED)
+                self.assertTrue(replayer.finished())
+                self.assertEqual(m.io.out.getvalue(), output)
+            with self.assertRaises(Exception):
+                pptreplay.Replayer.load(m, path, 3)
+
+    def test_mismatched_log(self):
+        recorder_vm = make_machine('EXEC RAND')
+        recorder = pptreplay.Recorder(recorder_vm)
+        recorder_vm.run()
+        m = make_machine(PROGRAM, console=True, regs=REGS)
+        pptreplay.Replayer(m, recorder.log)
+        result = m.run()
+        self.assertEqual((result.status, result.ip), (pptvm.FAULT, 0))
+        self.assertIn('where L was expected', str(result.error))
+
+
+if __name__ == '__main__':
+    unittest.main()
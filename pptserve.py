@@ -0,0 +1,110 @@
+import sys
+import asyncio
+import argparse
+import pptvm
+import pptbatch
+
+SLICE_STEPS = 10000
+
+class StreamOut:
+    """File-like adapter that IOChannel flushes a session's output to."""
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, s):
+        self.writer.write(s.encode('utf-8'))
+
+    def flush(self):
+        pass
+
+class Host:
+    """Runs a session of the program saved in snapshot for each client that
+    connects, all on one event loop. The program is decoded (and its blocks
+    compiled) once, into a machine that the sessions take turns on, each
+    for a slice of slice_steps micro-ops, giving way to the others in
+    between. The machine holds the state of the session that ran last; the
+    others keep theirs as Snapshots, and only swap when a different session
+    takes a turn. A session waiting for input is suspended until its client
+    sends a line."""
+    def __init__(self, snapshot, slice_steps=SLICE_STEPS, jit=False):
+        self.snapshot = snapshot
+        self.slice_steps = slice_steps
+        self.vm = pptvm.MachineState.from_snapshot(snapshot, jit=jit)
+        self.sessions = 0
+        # Sessions are known by their IOChannel. owner's state is the
+        # machine's, and states holds the others'.
+        self.owner = None
+        self.states = {}
+
+    def take(self, channel):
+        """Puts the state of the session with channel on the machine, saving
+        the state of the session that had it."""
+        if self.owner is channel:
+            return
+        vm = self.vm
+        if self.owner is not None:
+            self.states[self.owner] = vm.snapshot()
+        vm.restore(self.states.pop(channel))
+        vm.io = channel
+        self.owner = channel
+
+    async def run_session(self, reader, writer):
+        self.sessions += 1
+        channel = pptvm.IOChannel(out=StreamOut(writer), wait=True)
+        vm = self.vm
+        self.states[channel] = self.snapshot
+        try:
+            while True:
+                self.take(channel)
+                result = vm.run(max_steps=self.slice_steps)
+                await writer.drain()
+                if result.status == pptvm.WAITING:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    channel.feed(line.decode('utf-8', errors='replace'))
+                elif result.status == pptvm.BUDGET_EXHAUSTED:
+                    await asyncio.sleep(0)
+                else:
+                    if result.status == pptvm.FAULT:
+                        print('Session faulted at line %s: %r' % (pptvm.uint_to_word(result.ip), result.error),
+                              file=sys.stderr)
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            if self.owner is channel:
+                self.owner = None
+            self.states.pop(channel, None)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def start(self, host=None, port=None, path=None):
+        """Listens on the Unix socket path if it is given, otherwise on
+        host:port. Returns the asyncio server."""
+        if path is not None:
+            return await asyncio.start_unix_server(self.run_session, path)
+        return await asyncio.start_server(self.run_session, host, port)
+
+async def serve(program, host=None, port=None, path=None, slice_steps=SLICE_STEPS, jit=False):
+    snapshot = pptbatch.load_program(program).snapshot()
+    server = await Host(snapshot, slice_steps, jit).start(host, port, path)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve an interactive .pptasm, .pptbin or .gas program over a socket')
+    parser.add_argument('program', help='program to run for each connection', type=str)
+    parser.add_argument('--host', help='address to listen on (default: localhost)', type=str, default='localhost')
+    parser.add_argument('--port', help='TCP port to listen on', type=int, default=8023)
+    parser.add_argument('--unix', help='listen on this Unix socket instead of TCP', type=str)
+    parser.add_argument('--slice', help='micro-ops a session runs before the others get a turn',
+                        type=int, default=SLICE_STEPS)
+    parser.add_argument('--jit', help='compile basic blocks to Python functions', action='store_true')
+    args = parser.parse_args()
+    asyncio.run(serve(args.program, args.host, args.port, args.unix, args.slice, args.jit))
@@ -0,0 +1,103 @@
+import unittest
+import asyncio
+import pptvm
+import pptserve
+from ppttestutils import make_machine
+
+# Reads ints and echoes each one until it reads 0
+ECHO_PROGRAM = '''
+    EXEC GETINT
+    EXEC PUTINT
+    LOAD1H AH
+    LOAD1L AL
+    LOAD2H AH
+    LOAD2L AL
+    EXEC TESTW
+    EXEC VZ
+    EXEC NV
+    CONSTH 00000000
+    CONSTL 00000000
+    LOAD1H M3H
+    LOAD1L M3L
+    EXEC JV
+    EXEC HLT
+'''
+
+# Spins forever
+SPIN_PROGRAM = '''
+    CONSTH 00000000
+    CONSTL 00000000
+    LOAD1H M3H
+    LOAD1L M3L
+    EXEC JMP
+'''
+
+class TestServe(unittest.TestCase):
+    def test_sessions(self):
+        async def client(port, numbers):
+            reader, writer = await asyncio.open_connection('localhost', port)
+            replies = []
+            for n in numbers:
+                writer.write(b'%d\n' % n)
+                await writer.drain()
+                replies.append(await reader.read(100))
+            writer.close()
+            return replies
+
+        async def main(jit):
+            # The echo sessions take turns on the host's one machine, and
+            # with jit set share its compiled blocks
+            echo = pptserve.Host(make_machine(ECHO_PROGRAM).snapshot(), slice_steps=5, jit=jit)
+            spin = make_machine(SPIN_PROGRAM)
+            spin.regfile[pptvm.R_SPH] = 0x80
+            spinner = pptserve.Host(spin.snapshot(), slice_steps=100)
+            echo_server = await echo.start('localhost', 0)
+            spin_server = await spinner.start('localhost', 0)
+            port = echo_server.sockets[0].getsockname()[1]
+            # A session that never waits for input must not hold up the others
+            spin_reader, spin_writer = await asyncio.open_connection('localhost', spin_server.sockets[0].getsockname()[1])
+            replies = await asyncio.wait_for(asyncio.gather(
+                client(port, [1, 2, 0]), client(port, [-3, 0])), timeout=10)
+            self.assertEqual(spinner.sessions, 1)
+            if jit:
+                self.assertTrue(echo.vm.jit.blocks)
+            spin_writer.close()
+            echo_server.close()
+            spin_server.close()
+            return replies
+
+        for jit in [False, True]:
+            self.assertEqual(asyncio.run(main(jit)), [[b'1', b'2', b'0'], [b'-3', b'0']])
+
+    def test_state_swaps(self):
+        # A session that takes turn after turn by itself keeps its state on
+        # the machine, and is only copied out when another one comes along
+        async def main():
+            spin = make_machine(SPIN_PROGRAM, regs={'SPH': 0x80})
+            host = pptserve.Host(spin.snapshot(), slice_steps=10)
+            counts = {'restore': 0, 'snapshot': 0}
+            for name in counts:
+                def counted(*args, name=name, fn=getattr(host.vm, name)):
+                    counts[name] += 1
+                    return fn(*args)
+                setattr(host.vm, name, counted)
+            server = await host.start('localhost', 0)
+            port = server.sockets[0].getsockname()[1]
+            first = await asyncio.open_connection('localhost', port)
+            for i in range(20):
+                await asyncio.sleep(0)
+            self.assertEqual(counts, {'restore': 1, 'snapshot': 0})
+            second = await asyncio.open_connection('localhost', port)
+            for i in range(20):
+                await asyncio.sleep(0)
+            self.assertGreater(counts['snapshot'], 1)
+            self.assertEqual(host.sessions, 2)
+            for reader, writer in [first, second]:
+                writer.close()
+            server.close()
+
+        asyncio.run(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import io
+import pptvm
+
+# Helpers shared by the *_tests.py modules
+
+def make_machine(program, console=False, regs=None, **kwargs):
+    """A MachineState running program, given as one 'CMD ARG' per line with
+    an optional '# comment'. With console set, output goes to a StringIO
+    (m.io.out) and input comes from an empty one, so only lines fed to m.io
+    are read. regs presets byte registers by name. Other keyword arguments
+    go to MachineState."""
+    text = []
+    for line in program.strip().split('\n'):
+        line, _, comment = line.partition('#')
+        parts = line.split()
+        text.append(pptvm.Instruction(parts[0], parts[1:], comment.strip() or None))
+    if console:
+        kwargs['io'] = pptvm.IOChannel(out=io.StringIO(), inp=io.StringIO())
+    m = pptvm.MachineState(text, **kwargs)
+    for r, value in (regs or {}).items():
+        m.regfile[pptvm.REG_INDEX[r]] = value
+    return m
+
+# EXEC ops that random_block draws from: the ones that don't jump, halt or
+# do I/O
+EXEC_OPS = [
+    'ADDB', 'ADCB', 'ADDW', 'ADCW', 'SUBB', 'SBBB', 'SUBW', 'SBBW', 'CMPB', 'CMPW',
+    'ANDB', 'ANDW', 'ORB', 'ORW', 'XORB', 'XORW', 'TESTB', 'TESTW',
+    'INCB', 'INCW', 'DECB', 'DECW', 'NEGB', 'NEGW', 'NOTB', 'NOTW',
+    'SHLB', 'SHLW', 'SHRB', 'SHRW', 'SARB', 'SARW',
+    'SHIFTADDR1', 'SHIFTADDR2', 'SHIFTADDR3', 'ADDADDR', 'INC2W', 'DEC2W',
+    'CBW', 'CWD', 'CLC', 'STC', 'CMC', 'VA', 'VC', 'VZ', 'VO', 'VS', 'VG', 'VL', 'NV',
+    'MULB', 'MULW', 'IMULB', 'IMULW', 'DIVB', 'DIVW', 'IDIVB', 'IDIVW',
+    'SMP', 'IMP', 'DMP', 'RMEM', 'WMEM', 'RMEMW', 'WMEMW', 'PUSHW', 'POPW']
+
+def random_block(rng, length):
+    """length random micro-ops, as a program for make_machine."""
+    regs = [r for r in pptvm.REG_NAMES if not r.startswith('SP')]
+    lines = []
+    for i in range(length):
+        kind = rng.randrange(6)
+        if kind == 0:
+            lines.append('%s %s' % (rng.choice(list(pptvm.LOAD_DST)), rng.choice(regs)))
+        elif kind == 1:
+            lines.append('%s %s' % (rng.choice(list(pptvm.STORE_SRC)), rng.choice(regs)))
+        elif kind == 2:
+            cmd = rng.choice(list(pptvm.CONST_DST) + list(pptvm.CLEAR_DST) + list(pptvm.COPY_DST_SRC))
+            lines.append('%s %s' % (cmd, pptvm.uint_to_byte(rng.randrange(256))))
+        else:
+            lines.append('EXEC ' + rng.choice(EXEC_OPS))
+    return '\n'.join(lines)
+
+# Counts CX down from 3, then halts
+COUNTDOWN_PROGRAM = '''
+    CONSTL 00000011   # movw $3,%cx
+    STOREL CL
+    LOAD1H CH         # decw %cx
+    LOAD1L CL
+    EXEC DECW
+    STOREH CH
+    STOREL CL
+    EXEC VZ           # jne L$1
+    EXEC NV
+    CONSTH 00000000
+    CONSTL 00000010
+    LOAD1H M3H
+    LOAD1L M3L
+    EXEC JV
+    EXEC HLT          # hlt
+'''
+
+# Prints the primes below 30
+PRIMES_GAS = '''.387
+.new_section _TEXT, "crx4"
+isprime_:
+    pushw %bx
+    pushw %cx
+    pushw %dx
+    movw %ax,%cx
+    cmpw $0x2,%ax
+    jge L$1
+    xorw %ax,%ax
+    jmp L$4
+L$1:
+    movw $0x2,%bx
+L$2:
+    movw %bx,%ax
+    imulw %bx
+    cmpw %cx,%ax
+    jg L$3
+    movw %cx,%ax
+    ctwd
+    idivw %bx
+    testw %dx,%dx
+    je L$5
+    incw %bx
+    jmp L$2
+L$5:
+    xorw %ax,%ax
+    jmp L$4
+L$3:
+    movw $0x1,%ax
+L$4:
+    popw %dx
+    popw %cx
+    popw %bx
+    ret
+main_:
+    pushw %bx
+    xorw %bx,%bx
+L$6:
+    movw %bx,%ax
+    call isprime_
+    testw %ax,%ax
+    je L$7
+    movw %bx,%ax
+    call ppt_putint_
+    movw $L$8,%ax
+    call ppt_puts_
+L$7:
+    incw %bx
+    cmpw $0x1e,%bx
+    jl L$6
+    xorw %ax,%ax
+    popw %bx
+    ret
+.new_section CONST, "dr2"
+L$8:
+    .asciiz " is prime!\\n"
+'''
@@ -0,0 +1,258 @@
+import io
+from pptvm import *
+from pptjit import JUMP_OPS, MAX_BLOCK_LENGTH, compile_block
+
+# EXEC ops whose effect depends on memory or input, with the registers they
+# set. The trace records these registers after the op runs (with mp and the
+# next ip) so that it can rebuild the steps after them without the memory.
+RECORDED_OPS = {
+    'RMEM': (R_M3L,),
+    'RMEMW': (R_M3H, R_M3L),
+    'POPW': (R_M3H, R_M3L, R_SPH, R_SPL),
+    'RETW': (R_SPH, R_SPL),
+    'PUTS': (R_M1H, R_M1L, R_M3L),
+    'GETS': (R_M1H, R_M1L, R_M2L),
+    'GETINT': (R_AH, R_AL),
+    'RAND': (R_AH, R_AL),
+}
+
+# Ops that end a run of straight-line steps. The trace only records where
+# they were (and for RETW, the registers above), since the others do the
+# same thing again when the steps are rebuilt.
+TRACE_JUMP_OPS = set(JUMP_OPS) | set(BRANCH_OPS)
+
+# Jumps that only move ip, which their record already has, so they are not
+# run again when the steps are rebuilt. The others push or set flags.
+IP_ONLY_OPS = {'JMP', 'JV'}
+
+def flag_bits(flags):
+    return flags.verdict | flags.carry << 1 | flags.zero << 2 | flags.sign << 3 | flags.overflow << 4
+
+def recorded_op(trace, ip, op, regs):
+    """op, recording regs (register indices) in trace after running it. A
+    watchpoint stops the machine after the op has run, so it is recorded
+    then too."""
+    vm = trace.vm
+    regfile = vm.regfile
+    record = trace.record
+    def record_regs():
+        value = 0
+        for r in regs:
+            value = value << 8 | regfile[r]
+        record(ip, vm.ip, vm.mp, value)
+    def op_and_record():
+        try:
+            op()
+        except WatchpointHit:
+            record_regs()
+            raise
+        record_regs()
+    return op_and_record
+
+def traced_block(trace, ip, fn):
+    """JIT block fn at ip, noting in trace.fault where it started if it
+    faults. The machine is then left at the block's entry, but the records
+    its probes made are kept so that the steps up to the op that failed can
+    be rebuilt."""
+    def block_or_fault():
+        i = trace.index
+        try:
+            return fn()
+        except Exception:
+            trace.fault = (i, ip)
+            raise
+    return block_or_fault
+
+class Trace:
+    """The state of a machine before each of its last size steps.
+
+    Most steps are not recorded as they run: only jumps and the ops in
+    RECORDED_OPS are, each as its ip, the next ip, mp and the registers it
+    set, in a preallocated list written round at a moving index. The whole
+    register file is saved when the trace is attached and each time the
+    index wraps. entries() rebuilds the steps from the older of the last two
+    of those snapshots by running the code again on a scratch machine, so
+    the cost falls on the dump rather than on the run. Changes made to the
+    machine from outside its code while the trace is attached are not seen.
+
+    With the JIT on, compiled blocks make the same records through probes
+    (see BlockCompiler.probe), and the index only wraps between blocks,
+    where the machine is up to date. A block that faults leaves the machine
+    at its entry, and its records are kept only until the machine moves on,
+    so that the steps still end with the op that failed."""
+    def __init__(self, vm, size=256):
+        self.vm = vm
+        self.size = size
+        # Two laps of at least size records each: the current one and the
+        # one before it. Under the JIT a lap can run over by up to a block.
+        self.lap = size + (MAX_BLOCK_LENGTH if vm.jit is not None else 0)
+        self.records = [None] * (2 * self.lap)
+        self.start = self.index = 0
+        self.end = size
+        self.older = None
+        # (index, ip) at the entry of the JIT block the machine faulted in
+        self.fault = None
+        self.snapshot = self.save()
+        self.code = vm.code
+        self.traced_code = list(vm.code)
+        for ip, inst in enumerate(vm.instructions):
+            if inst.cmd != 'EXEC':
+                continue
+            name = inst.args[0]
+            if name in RECORDED_OPS:
+                self.traced_code[ip] = recorded_op(self, ip, vm.code[ip], RECORDED_OPS[name])
+            elif name in TRACE_JUMP_OPS:
+                self.traced_code[ip] = recorded_op(self, ip, vm.code[ip], ())
+        vm.code = self.traced_code
+        if vm.jit is not None:
+            self.blocks = {}
+            self.probes = { name: (self.probe, RECORDED_OPS.get(name, ()))
+                            for name in TRACE_JUMP_OPS | set(RECORDED_OPS) }
+            vm.jit.lookup = self.lookup
+
+    def save(self):
+        vm = self.vm
+        return bytes(vm.regfile), vm.mp, flag_bits(vm.flags), vm.ip
+
+    def probe(self, *record):
+        """Stores the record (ip, next ip, mp, value) without wrapping."""
+        i = self.index
+        self.records[i] = record
+        self.index = i + 1
+
+    def record(self, *record):
+        """probe, wrapping the index at the end of the lap."""
+        i = self.index
+        self.records[i] = record
+        self.index = i = i + 1
+        if i >= self.end:
+            self.wrap()
+
+    def wrap(self):
+        """Starts the other lap, from the state the machine is in now."""
+        self.older = (self.snapshot, self.start, self.index)
+        self.start = self.index = (self.start + self.lap) % (2 * self.lap)
+        self.end = self.start + self.size
+        self.snapshot = self.save()
+
+    def lookup(self, ip):
+        """Jit.lookup, with blocks that record what the trace needs. Runs
+        look up each block before running it, so this is also where the
+        index wraps under the JIT."""
+        if self.fault is not None:
+            # The machine is moving on from a faulted block, which did not
+            # happen as far as its registers are concerned
+            self.index = self.fault[0]
+            self.fault = None
+        if self.index >= self.end:
+            self.wrap()
+        block = self.blocks.get(ip)
+        if block is None:
+            # Blocks are compiled against the untraced ops, so that the ops
+            # they call out to do not make records of their own
+            vm = self.vm
+            code = vm.code
+            vm.code = self.code
+            try:
+                block = compile_block(vm, ip, self.probes) or (None, 1)
+            finally:
+                vm.code = code
+            fn, length = block
+            if fn is not None:
+                block = (traced_block(self, ip, fn), length)
+            self.blocks[ip] = block
+        return block
+
+    def detach(self):
+        self.vm.code = self.code
+        if self.vm.jit is not None:
+            del self.vm.jit.lookup
+
+    def entries(self):
+        """(ip, m1, m2, m3, mp, flags) for the last size steps, oldest first.
+        flags maps the names in FLAG_NAMES to bools."""
+        vm = self.vm
+        records = list(range(self.start, self.index))
+        snapshot = self.snapshot
+        if self.older is not None:
+            snapshot, start, stop = self.older
+            records = list(range(start, stop)) + records
+        regfile, mp, bits, ip = snapshot
+        scratch = MachineState(vm.instructions, io=IOChannel(out=io.StringIO(), inp=io.StringIO()),
+                               checked=vm.checked)
+        scratch.regfile[:] = regfile
+        scratch.mp = mp
+        for i, f in enumerate(FLAG_NAMES):
+            setattr(scratch.flags, f, bool(bits >> i & 1))
+        steps = []
+
+        def add_step(ip):
+            steps.append((ip, scratch.m1.read(), scratch.m2.read(), scratch.m3.read(), scratch.mp,
+                          { f: bool(getattr(scratch.flags, f)) for f in FLAG_NAMES }))
+            del steps[:-self.size]
+
+        def run_to(ip, end):
+            """Runs the straight-line steps from ip up to end, leaving end
+            itself to the caller."""
+            while ip < end:
+                add_step(ip)
+                scratch.ip = ip + 1
+                scratch.code[ip]()
+                ip = scratch.ip
+
+        for i in records:
+            op_ip, next_ip, op_mp, value = self.records[i]
+            run_to(ip, op_ip)
+            add_step(op_ip)
+            name = vm.instructions[op_ip].args[0]
+            if name in RECORDED_OPS:
+                for r in reversed(RECORDED_OPS[name]):
+                    scratch.regfile[r] = value & 0xff
+                    value >>= 8
+                scratch.mp = op_mp
+            elif name not in IP_ONLY_OPS:
+                scratch.ip = op_ip + 1
+                scratch.code[op_ip]()
+            ip = next_ip
+        # The op at vm.ip has not run yet unless it halted the machine, and
+        # a faulting op is never run again
+        if self.fault is not None and self.fault[1] == vm.ip:
+            # The block's straight-line ops run on the scratch machine up to
+            # the one that fails there too. A jump or recorded op without a
+            # record is the one that failed itself.
+            instructions = vm.instructions
+            while True:
+                add_step(ip)
+                inst = instructions[ip]
+                if inst.cmd == 'EXEC' and (inst.args[0] in RECORDED_OPS or inst.args[0] in TRACE_JUMP_OPS):
+                    break
+                scratch.ip = ip + 1
+                try:
+                    scratch.code[ip]()
+                except Exception:
+                    break
+                ip = scratch.ip
+        elif vm.halted:
+            run_to(ip, vm.ip)
+            add_step(vm.ip)
+        elif ip != vm.ip:
+            run_to(ip, vm.ip - 1)
+            add_step(vm.ip - 1)
+        return steps
+
+    def dump(self):
+        """The recorded steps as text, with each micro-op's x86 line."""
+        instructions = self.vm.instructions
+        lines = []
+        for ip, m1, m2, m3, mp, flags in self.entries():
+            inst = instructions[ip] if ip < len(instructions) else None
+            text = '%s %s' % (inst.cmd, ' '.join(inst.args)) if inst else '?'
+            source = ''
+            for i in range(min(ip, len(instructions) - 1), -1, -1):
+                if instructions[i].comment is not None:
+                    source = instructions[i].comment
+                    break
+            flag_text = ''.join(f[0].upper() if flags[f] else '-' for f in FLAG_NAMES)
+            lines.append('%04x  %-16s m1=%04x m2=%04x m3=%04x mp=%04x %s  %s' % (
+                ip, text, m1, m2, m3, mp, flag_text, source))
+        return '\n'.join(lines)
@@ -0,0 +1,104 @@
+import random
+import unittest
+import pptvm
+import pptjit
+import ppttrace
+from ppttestutils import make_machine, random_block, COUNTDOWN_PROGRAM
+
+class TestTrace(unittest.TestCase):
+    def test_ring(self):
+        m = make_machine(COUNTDOWN_PROGRAM)
+        trace = ppttrace.Trace(m, 4)
+        m.run(max_steps=8)
+        entries = trace.entries()
+        self.assertEqual([e[0] for e in entries], [4, 5, 6, 7])
+        ip, m1, m2, m3, mp, flags = entries[-1]
+        self.assertEqual((m1, m3), (3, 2))
+        self.assertEqual(flags['zero'], False)
+        m.run()
+        self.assertEqual([e[0] for e in trace.entries()], [11, 12, 13, 14])
+        self.assertTrue(trace.entries()[0][5]['zero'])
+        trace.detach()
+        self.assertIs(m.code, trace.code)
+
+    def test_fault_dump(self):
+        m = make_machine('''
+            CLEARL1        # divb %bl
+            EXEC DIVB
+        ''')
+        trace = ppttrace.Trace(m)
+        self.assertEqual(m.run().status, pptvm.FAULT)
+        dump = trace.dump().split('\n')
+        self.assertEqual(len(dump), 2)
+        self.assertTrue(dump[1].startswith('0001  EXEC DIVB'))
+        self.assertTrue(dump[1].endswith('divb %bl'))
+
+    def test_rebuilt_steps(self):
+        # Small traces wrap many times over the memory ops, and the rebuilt
+        # steps must match stepping the program one op at a time
+        rng = random.Random(13)
+        for i in range(20):
+            program = random_block(rng, 60) + '\nEXEC HLT'
+            expected = []
+            m = make_machine(program)
+            while not m.halted:
+                expected.append((m.ip, m.m1.read(), m.m2.read(), m.m3.read(), m.mp,
+                                 { f: bool(getattr(m.flags, f)) for f in pptvm.FLAG_NAMES }))
+                try:
+                    m.step()
+                except Exception:
+                    break
+            m = make_machine(program)
+            trace = ppttrace.Trace(m, 3)
+            m.run()
+            self.assertEqual(trace.entries(), expected[-3:])
+
+    def test_jit_blocks(self):
+        m = make_machine(COUNTDOWN_PROGRAM)
+        expected = ppttrace.Trace(m, 16)
+        m.run()
+        m = make_machine(COUNTDOWN_PROGRAM)
+        m.jit = pptjit.Jit(m)
+        trace = ppttrace.Trace(m, 16)
+        self.assertEqual(m.run().status, pptvm.HALTED)
+        self.assertEqual(m.regfile[pptvm.REG_INDEX['CL']], 0)
+        self.assertEqual(trace.entries(), expected.entries())
+        trace.detach()
+        self.assertNotIn('lookup', vars(m.jit))
+
+    def test_jit_fault(self):
+        # The block is left at its entry, but its steps up to the DIVB that
+        # failed are rebuilt like the interpreter's, also after a rerun
+        program = '''
+            CLEARL1        # divb %bl
+            EXEC RMEM
+            EXEC DIVB
+        '''
+        m = make_machine(program)
+        expected = ppttrace.Trace(m)
+        self.assertEqual(m.run().status, pptvm.FAULT)
+        m = make_machine(program, jit=True)
+        trace = ppttrace.Trace(m)
+        for i in range(2):
+            self.assertEqual(m.run().status, pptvm.FAULT)
+            self.assertEqual(m.ip, 0)
+            self.assertEqual(trace.entries(), expected.entries())
+        self.assertTrue(trace.dump().split('\n')[-1].startswith('0002  EXEC DIVB'))
+
+    def test_fast_machine(self):
+        # A fast machine's jumps skip the checks, and so do the rebuilt steps:
+        # this JMP runs with SP outside the data segment
+        program = '''
+            CONSTL 00000011
+            LOAD1L M3L
+            EXEC JMP
+            EXEC HLT
+        '''
+        for jit in [False, True]:
+            m = make_machine(program, checked=False, jit=jit)
+            trace = ppttrace.Trace(m)
+            self.assertEqual(m.run().status, pptvm.HALTED)
+            self.assertEqual([e[0] for e in trace.entries()], [0, 1, 2, 3])
+
+if __name__ == '__main__':
+    unittest.main()
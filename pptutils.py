@@ -1,3 +1,5 @@
+import struct
+
 def hex_to_int(hex):
     assert hex.startswith('0x')
     hex = hex[2:]
@@ -131,4 +133,94 @@ def condense_spaces(s):
 
 def pad_to_length(s, l):
     assert l >= len(s)
-    return s + ' ' * (l - len(s))
\ No newline at end of file
+    return s + ' ' * (l - len(s))
+
+def sign_extend(x, bits):
+    if x >> (bits - 1):
+        return x - 2**bits
+    return x
+
+# All byte registers live in a single bytearray (the register file). The
+# names below are the order of the registers in that file.
+REG_NAMES = [
+    'AH', 'AL', 'BH', 'BL', 'CH', 'CL', 'DH', 'DL',
+    'M4H', 'M4L', 'M5H', 'M5L',
+    'DIH', 'DIL', 'SIH', 'SIL', 'BPH', 'BPL', 'SPH', 'SPL',
+    'M1H', 'M1L', 'M2H', 'M2L', 'M3H', 'M3L']
+
+# Text labels inside a function rather than at its entry: Watcom's L$n, gcc's
+# .Ln, and the return points of calls (R$n) and exit stub (X$0) pptasm adds.
+# Code before the first function is counted as STARTUP.
+LOCAL_LABEL_PREFIXES = ('L$', '.L', 'R$', 'X$')
+STARTUP = '<startup>'
+
+# Compare-and-branch ops of the extended ISA, as {name: (compare, condition,
+# negate)}: a CMPB, CMPW, TESTB or TESTW of M1 and M2, then a jump to M3 if
+# the condition's verdict (negated if negate) holds, e.g. CMPWJNL.
+BRANCH_OPS = { compare + 'J' + 'N' * negate + condition: (compare, condition, negate)
+    for compare in ['CMPB', 'CMPW', 'TESTB', 'TESTW']
+    for negate in [False, True]
+    for condition in ['A', 'C', 'Z', 'O', 'S', 'G', 'L'] }
+
+# Opcodes of the binary image format are indices into these lists, so new
+# entries must only ever be appended.
+PPT_COMMANDS = [
+    'LOAD1L', 'LOAD1H', 'LOAD2L', 'LOAD2H', 'STOREL', 'STOREH', 'COPYL', 'COPYH',
+    'CLEARL1', 'CLEARH1', 'CLEARL2', 'CLEARH2', 'CLEARL3', 'CLEARH3',
+    'CONSTL', 'CONSTH', 'EXEC']
+EXEC_OPS = [
+    'ADCB', 'ADCW', 'ADDB', 'ADDW', 'SHIFTADDR1', 'SHIFTADDR2', 'SHIFTADDR3', 'ADDADDR',
+    'ANDB', 'ANDW', 'CBW', 'CLC', 'CMC', 'CMPB', 'CMPW', 'DECB', 'DECW', 'DEC2W', 'INC2W',
+    'CWD', 'DIVB', 'DIVW', 'IDIVB', 'IDIVW', 'IMULB', 'IMULW', 'MULB', 'MULW', 'INCB', 'INCW',
+    'VA', 'VC', 'VZ', 'VO', 'VS', 'VG', 'VL', 'NV', 'JMP', 'JV', 'RMEM', 'WMEM', 'SMP', 'IMP',
+    'DMP', 'NEGB', 'NEGW', 'NOTB', 'NOTW', 'ORB', 'ORW', 'SARB', 'SARW', 'SHLB', 'SHLW',
+    'SHRB', 'SHRW', 'STC', 'SBBB', 'SBBW', 'SUBB', 'SUBW', 'TESTB', 'TESTW', 'XORB', 'XORW',
+    'PUTS', 'PUTINT', 'PUTC', 'GETS', 'GETINT', 'RAND', 'HLT',
+    'PUSHW', 'POPW', 'CALLW', 'RETW', 'RMEMW', 'WMEMW'] + list(BRANCH_OPS)
+
+# Binary image (.pptbin): IMAGE_HEADER (magic, version, number of
+# instructions, data length, const length, number of symbols, number of
+# comments), then two bytes per instruction (opcode, operand), the data and
+# const bytes, the symbols as (ip, name length, name) and the comments as
+# (ip, length, utf-8 text). The operand is a register index, a CONSTL/CONSTH
+# byte or an index into EXEC_OPS.
+IMAGE_MAGIC = b'PPTB'
+IMAGE_VERSION = 2
+IMAGE_HEADER = struct.Struct('<4sHIHHHI')
+IMAGE_SYMBOL = struct.Struct('<IH')
+IMAGE_COMMENT = struct.Struct('<IH')
+
+def pack_image(text, data, const, symbols):
+    """Binary image of a program. text is a list of (cmd, arg, comment) with
+    arg None or a string as in the text format, data and const are bytes and
+    symbols maps text labels to ips."""
+    commands = { c: i for i, c in enumerate(PPT_COMMANDS) }
+    exec_ops = { n: i for i, n in enumerate(EXEC_OPS) }
+    regs = { r: i for i, r in enumerate(REG_NAMES) }
+    code = bytearray()
+    comments = []
+    for ip, (cmd, arg, comment) in enumerate(text):
+        if cmd not in commands or cmd == 'EXEC' and arg not in exec_ops:
+            raise Exception('Instruction %s %s has no binary encoding' % (cmd, arg))
+        if cmd == 'EXEC':
+            operand = exec_ops[arg]
+        elif cmd in ('CONSTL', 'CONSTH'):
+            operand = byte_to_uint(arg)
+        elif arg is None:
+            operand = 0
+        else:
+            operand = regs[arg]
+        code += bytes([commands[cmd], operand])
+        if comment is not None:
+            comment = comment.encode('utf-8')
+            if len(comment) > 0xffff:
+                raise Exception('Comment at ip %d is too long for an image' % ip)
+            comments.append(IMAGE_COMMENT.pack(ip, len(comment)) + comment)
+    parts = [IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, len(text), len(data), len(const),
+                               len(symbols), len(comments)), code, data, const]
+    for name, ip in symbols.items():
+        name = name.encode('utf-8')
+        if len(name) > 0xffff:
+            raise Exception('Symbol name %s... is too long for an image' % name[:32].decode('utf-8', 'replace'))
+        parts.append(IMAGE_SYMBOL.pack(ip, len(name)) + name)
+    return b''.join(parts + comments)
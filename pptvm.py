@@ -1,29 +1,82 @@
+import sys
 import random
 import argparse
+import mmap
+import operator
+import struct
+import collections
 from pptutils import *
 
 class Instruction:
-    def __init__(self, cmd, args):
+    def __init__(self, cmd, args, comment=None):
         self.cmd = cmd
         self.args = args
+        self.comment = comment
+
+# REG_NAMES (from pptutils) is the order of the registers in the register file
+REG_INDEX = { r: i for i, r in enumerate(REG_NAMES) }
+
+R_AH, R_AL = REG_INDEX['AH'], REG_INDEX['AL']
+R_DH, R_DL = REG_INDEX['DH'], REG_INDEX['DL']
+R_SPH, R_SPL = REG_INDEX['SPH'], REG_INDEX['SPL']
+R_M1H, R_M1L = REG_INDEX['M1H'], REG_INDEX['M1L']
+R_M2H, R_M2L = REG_INDEX['M2H'], REG_INDEX['M2L']
+R_M3H, R_M3L = REG_INDEX['M3H'], REG_INDEX['M3L']
 
 class ByteRegister:
-    def __init__(self, name):
+    """View of one byte of the register file."""
+    def __init__(self, name, regfile, index):
         self.name = name
-        self.value = '0' * 8
+        self.regfile = regfile
+        self.index = index
+
+    @property
+    def value(self):
+        return self.regfile[self.index]
+
+    @value.setter
+    def value(self, x):
+        self.regfile[self.index] = x
+
+    @property
+    def bits(self):
+        return uint_to_byte(self.value)
 
 class MemRegister:
-    def __init__(self, name):
+    """View of the high/low byte pair of M1, M2 or M3 in the register file."""
+    def __init__(self, name, regfile, index_high):
         self.name = name
-        self.low = '0' * 8
-        self.high = '0' * 8
+        self.regfile = regfile
+        self.index_high = index_high
+
+    @property
+    def high(self):
+        return self.regfile[self.index_high]
+
+    @high.setter
+    def high(self, x):
+        self.regfile[self.index_high] = x
+
+    @property
+    def low(self):
+        return self.regfile[self.index_high + 1]
+
+    @low.setter
+    def low(self, x):
+        self.regfile[self.index_high + 1] = x
 
     def read(self):
-        return self.high + self.low
+        return self.regfile[self.index_high] << 8 | self.regfile[self.index_high + 1]
 
-    def assign(self, bits):
-        self.high = bits[:8]
-        self.low = bits[8:]
+    def assign(self, x):
+        self.regfile[self.index_high] = x >> 8
+        self.regfile[self.index_high + 1] = x & 0xff
+
+    @property
+    def bits(self):
+        return uint_to_word(self.read())
+
+FLAG_NAMES = ['verdict', 'carry', 'zero', 'sign', 'overflow']
 
 class Flags:
     def __init__(self):
@@ -33,190 +86,743 @@ class Flags:
         self.sign = False
         self.overflow = False
 
-def inc_bits(w):
-    if w == '':
-        return ''
-    if w[-1] == '0':
-        return w[:-1] + '1'
-    else:
-        return inc_bits(w[:-1]) + '0'
-
-def dec_bits(w):
-    if w == '':
-        return ''
-    if w[-1] == '1':
-        return w[:-1] + '0'
-    else:
-        return dec_bits(w[:-1]) + '1'
-
-def and_bits(x, y):
-    if x == '0':
-        return '0'
-    else:
-        return y
-
-def or_bits(x, y):
-    if x == '1':
-        return '1'
-    else:
-        return y
-
-def xor_bits(x, y):
-    if x == y:
-        return '0'
+    def set_arith(self, total, res, top, overflow):
+        """Flags of an add, subtract, increment, decrement or negate whose
+        unmasked result was total. It carried or borrowed iff total != res."""
+        self.carry = total != res
+        self.overflow = overflow
+        self.sign = res >= top
+        self.zero = res == 0
+
+    def set_result(self, res, top):
+        """Flags of a bitwise operation, which leaves carry and overflow alone."""
+        self.zero = res == 0
+        self.sign = res >= top
+
+class LazyFlags(Flags):
+    """Flags that keep the operands of the last flag-producing operation and
+    only work out a flag when it is read.
+
+    _co is the operation that carry and overflow come from and _zs the one
+    that zero and sign come from, both as (total, res, top, overflow). When
+    one is None the flags it covers are held in _carry/_overflow or
+    _zero/_sign."""
+    def __init__(self):
+        self._co = None
+        self._zs = None
+        Flags.__init__(self)
+
+    def set_arith(self, total, res, top, overflow):
+        self._co = self._zs = (total, res, top, overflow)
+
+    def set_result(self, res, top):
+        self._zs = (None, res, top, None)
+
+    @property
+    def carry(self):
+        if self._co is None:
+            return self._carry
+        return self._co[0] != self._co[1]
+
+    @carry.setter
+    def carry(self, value):
+        if self._co is not None:
+            self._overflow = self._co[3]
+            self._co = None
+        self._carry = value
+
+    @property
+    def overflow(self):
+        if self._co is None:
+            return self._overflow
+        return self._co[3]
+
+    @overflow.setter
+    def overflow(self, value):
+        if self._co is not None:
+            self._carry = self._co[0] != self._co[1]
+            self._co = None
+        self._overflow = value
+
+    @property
+    def zero(self):
+        if self._zs is None:
+            return self._zero
+        return self._zs[1] == 0
+
+    @zero.setter
+    def zero(self, value):
+        if self._zs is not None:
+            self._sign = self._zs[1] >= self._zs[2]
+            self._zs = None
+        self._zero = value
+
+    @property
+    def sign(self):
+        if self._zs is None:
+            return self._sign
+        return self._zs[1] >= self._zs[2]
+
+    @sign.setter
+    def sign(self, value):
+        if self._zs is not None:
+            self._zero = self._zs[1] == 0
+            self._zs = None
+        self._sign = value
+
+SEGMENT_SIZE = 2**15
+DATA_BASE = 2**15
+
+class Memory:
+    """The const segment (addresses 0x0000-0x7fff) and the data segment
+    (addresses 0x8000-0xffff), each a fixed 32 KiB buffer."""
+    def __init__(self, data=b'', const=b'', const_segment=None):
+        """const_segment, if given, is an existing 32 KiB const segment to
+        use as is (shared with other machines) instead of loading const."""
+        self.data = bytearray(SEGMENT_SIZE)
+        if const_segment is not None:
+            assert len(const_segment) == SEGMENT_SIZE
+            self.const = const_segment
+        else:
+            self.const = bytearray(SEGMENT_SIZE)
+        self.load(data, const)
+
+    def load(self, data=b'', const=b''):
+        """Copies the images of the data: and const: sections to the start of
+        their segments."""
+        if len(data) > SEGMENT_SIZE or len(const) > SEGMENT_SIZE:
+            raise Exception('Section does not fit in a 32 KiB segment')
+        self.data[:len(data)] = data
+        self.const[:len(const)] = const
+
+    def _segment(self, addr):
+        assert 0 <= addr < 2**16
+        if addr >= DATA_BASE:
+            return self.data, addr - DATA_BASE
+        return self.const, addr
+
+    def read(self, addr):
+        segment, offset = self._segment(addr)
+        return segment[offset]
+
+    def write(self, addr, value):
+        assert addr >= DATA_BASE
+        self.data[addr - DATA_BASE] = value
+
+    def view(self, addr, length):
+        """A memoryview of length bytes at addr, which must not cross a segment."""
+        segment, offset = self._segment(addr)
+        assert offset + length <= SEGMENT_SIZE
+        return memoryview(segment)[offset:offset + length]
+
+    def dump(self, addr, length):
+        return bytes(self.view(addr, length))
+
+    def inspect(self, addr, length, width=16):
+        """Hex dump of length bytes at addr, one line per width bytes."""
+        lines = []
+        for start in range(addr, addr + length, width):
+            chunk = self.dump(start, min(width, addr + length - start))
+            text = ''.join(chr(b) if 32 <= b < 127 else '.' for b in chunk)
+            lines.append('%04x  %s  %s' % (start, chunk.hex(' '), text))
+        return '\n'.join(lines)
+
+# Destination/source register of the micro-ops that only move a byte
+# around the register file. LOADs and STOREs take the other side from
+# their argument.
+LOAD_DST = {'LOAD1L': R_M1L, 'LOAD1H': R_M1H, 'LOAD2L': R_M2L, 'LOAD2H': R_M2H}
+STORE_SRC = {'STOREL': R_M3L, 'STOREH': R_M3H}
+COPY_DST_SRC = {'COPYL': (R_M3L, R_M1L), 'COPYH': (R_M3H, R_M1H)}
+CLEAR_DST = {
+    'CLEARL1': R_M1L, 'CLEARH1': R_M1H, 'CLEARL2': R_M2L,
+    'CLEARH2': R_M2H, 'CLEARL3': R_M3L, 'CLEARH3': R_M3H}
+CONST_DST = {'CONSTL': R_M3L, 'CONSTH': R_M3H}
+
+def move_op(regfile, dst, src):
+    def op():
+        regfile[dst] = regfile[src]
+    return op
+
+def set_op(regfile, dst, value):
+    def op():
+        regfile[dst] = value
+    return op
+
+def unknown_op(inst):
+    def op():
+        raise Exception('Unknown instruction %s %s' % (inst.cmd, ' '.join(inst.args)))
+    return op
+
+class BreakpointHit(Exception):
+    pass
+
+class WatchpointHit(Exception):
+    def __init__(self, address, access):
+        super().__init__('%s of watched address %s' % (access, uint_to_word(address)))
+        self.address = address
+        self.access = access
+
+def breakpoint_op(vm, ip, op):
+    """op, stopping the machine with ip left on it first unless the run is
+    resuming from this breakpoint or the breakpoint has been removed."""
+    def break_or_op():
+        if vm.resume_ip != ip and ip in vm.breakpoints:
+            vm.ip = ip
+            raise BreakpointHit(ip)
+        vm.resume_ip = None
+        op()
+    break_or_op.debug_op = op
+    return break_or_op
+
+# EXEC ops that touch memory: whether they write it, and what they touch:
+# the byte or word at mp, the string at A (ending at mp afterwards), or the
+# word pushed below SP or popped from SP
+WATCHED_OPS = {
+    'RMEM': (False, 'byte'), 'WMEM': (True, 'byte'), 'PUTS': (False, 'string'), 'GETS': (True, 'string'),
+    'PUSHW': (True, 'push'), 'CALLW': (True, 'push'), 'POPW': (False, 'pop'), 'RETW': (False, 'pop'),
+    'RMEMW': (False, 'word'), 'WMEMW': (True, 'word')}
+
+def watched_op(vm, op, is_write, kind):
+    """op, stopping the machine after it if it read or wrote a watched address."""
+    watched = vm.watch_writes if is_write else vm.watch_reads
+    access = 'write' if is_write else 'read'
+    def op_and_watch():
+        first = vm._read_reg('A') if kind == 'string' else vm._read_reg('SP') if kind == 'pop' else vm.mp
+        op()
+        last = first
+        if kind == 'string':
+            last = vm.mp
+        elif kind in ('push', 'pop', 'word'):
+            if kind == 'push':
+                first = vm._read_reg('SP')
+            last = first + 1
+        for address in watched:
+            if first <= address <= last:
+                raise WatchpointHit(address, access)
+    op_and_watch.debug_op = op
+    return op_and_watch
+
+def signed_divmod(x, y):
+    """Quotient and remainder of the IDIV instructions."""
+    if x < 0:
+        x = -x
+        y = -y
+    if y >= 0:
+        z = x // y
+        w = x % y
     else:
-        return '1'
+        z = (x + y + 1) // y
+        w = x - z * y
+    return z, w
+
+HALTED = 'halted'
+BUDGET_EXHAUSTED = 'budget exhausted'
+REACHED_IP = 'reached ip'
+FAULT = 'fault'
+BREAKPOINT = 'breakpoint'
+WATCHPOINT = 'watchpoint'
+WAITING = 'waiting for input'
+
+class RunResult:
+    """Why MachineState.run returned. ip is where the machine stopped, or the
+    ip of the faulting instruction (or JIT block), and error is the exception
+    raised by a fault. watch is (address, 'read' or 'write') for a
+    watchpoint."""
+    def __init__(self, status, steps, ip, error=None, watch=None):
+        self.status = status
+        self.steps = steps
+        self.ip = ip
+        self.error = error
+        self.watch = watch
+
+    def __repr__(self):
+        return 'RunResult(%s, steps=%d, ip=%s)' % (self.status, self.steps, uint_to_word(self.ip))
+
+class InputWanted(Exception):
+    pass
+
+class IOChannel:
+    """Console of a machine. Output is buffered and written to out (stdout
+    by default) once flush_size characters are waiting, before input is
+    read, on HLT and when MachineState.run returns. Input lines are taken
+    from the scripted queue first and then read from inp (stdin by
+    default). EOFError is raised when both are exhausted. With wait set,
+    an empty queue instead stops MachineState.run before the input op, with
+    the status WAITING, so that a host can feed the channel and resume."""
+    def __init__(self, out=None, inp=None, lines=(), flush_size=4096, wait=False):
+        self.out = out
+        self.inp = inp
+        self.lines = collections.deque(lines)
+        self.flush_size = flush_size
+        self.wait = wait
+        self.buffer = []
+        self.buffered = 0
+
+    def feed(self, text):
+        """Queues the lines of text as input."""
+        self.lines.extend(text.splitlines())
+
+    def write(self, s):
+        self.buffer.append(s)
+        self.buffered += len(s)
+        if self.buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            out = self.out or sys.stdout
+            out.write(''.join(self.buffer))
+            out.flush()
+            self.buffer = []
+            self.buffered = 0
+
+    def readline(self):
+        """The next line of input, without its newline."""
+        self.flush()
+        if self.lines:
+            return self.lines.popleft()
+        if self.wait:
+            raise InputWanted()
+        line = (self.inp or sys.stdin).readline()
+        if not line:
+            raise EOFError('No more input')
+        return line.rstrip('\n')
+
+# ip, mp, then one bit per flag in FLAG_NAMES order and one for halted
+SNAPSHOT_HEADER = struct.Struct('<IHB')
+
+class Snapshot:
+    """Saved state of a MachineState. text, const and symbols are the
+    machine's own (read-only) instruction list, const segment and symbol
+    table, shared rather than copied. state is the rest of the machine as
+    bytes: SNAPSHOT_HEADER, the register file and the data segment."""
+    def __init__(self, text, const, state, symbols=None):
+        assert len(state) == SNAPSHOT_HEADER.size + len(REG_NAMES) + SEGMENT_SIZE
+        self.text = text
+        self.const = const
+        self.state = state
+        self.symbols = symbols if symbols is not None else {}
 
 class MachineState:
-    def __init__(self, text_dict, data_dict, const_dict):
-        self.instructions = text_dict
-        self.const = const_dict
-        self.data = data_dict
-        reg_names = [
-            'AH', 'AL', 'BH', 'BL', 'CH', 'CL', 'DH', 'DL', 
-            'M4H', 'M4L', 'M5H', 'M5L',
-            'DIH', 'DIL', 'SIH', 'SIL', 'BPH', 'BPL', 'SPH', 'SPL']
-        self.regs = { r: ByteRegister(r) for r in reg_names }
-        self.flags = Flags()
-        self.m1 = MemRegister('M1')
-        self.m2 = MemRegister('M2')
-        self.m3 = MemRegister('M3')
-        self.ip = '0' * 16
-        self.mp = '0' * 16
+    def __init__(self, text, data=b'', const=b'', jit=False, lazy_flags=False, io=None, checked=True,
+                 alu_tables=False, const_segment=None):
+        self.instructions = text
+        # A checked machine asserts its invariants (SP alignment, SP in the
+        # data segment on JMP, jump targets in the text) as it runs, and a
+        # fast one leaves them out.
+        self.checked = checked
+        if not checked:
+            self.step = self.fast_step
+        self.memory = Memory(data, const, const_segment)
+        self.data = self.memory.data
+        self.const = self.memory.const
+        self.regfile = bytearray(len(REG_NAMES))
+        self.regs = { r: ByteRegister(r, self.regfile, i) for i, r in enumerate(REG_NAMES) }
+        self.flags = LazyFlags() if lazy_flags else Flags()
+        self.m1 = MemRegister('M1', self.regfile, R_M1H)
+        self.m2 = MemRegister('M2', self.regfile, R_M2H)
+        self.m3 = MemRegister('M3', self.regfile, R_M3H)
+        # Byte ALU ops, and the word NOT and shifts, look their results and
+        # flags up in pptalu's tables (the alu_exec_* handlers) instead of
+        # working them out
+        self.alu = None
+        if alu_tables:
+            from pptalu import alu_tables as tables
+            self.alu = tables()
+        self.ip = 0
+        self.mp = 0
+        self.halted = False
+        self.symbols = {}
+        self.io = io or IOChannel()
+        # RAND draws from rng: the random module's shared generator, unless
+        # it is replaced with a random.Random of the machine's own
+        self.rng = random
+        self.code = [self.decode(inst) for inst in text]
+        # Debugging state. While none is set, code is the plain handler table.
+        self.breakpoints = set()
+        self.watch_reads = set()
+        self.watch_writes = set()
+        self.debug_ips = set()
+        self.plain_code = None
+        self.resume_ip = None
+        self.jit = None
+        if jit:
+            from pptjit import Jit
+            self.jit = Jit(self)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, **kwargs):
+        """A new machine in the state saved in snapshot. It shares the
+        snapshot's text, const segment and symbol table."""
+        vm = cls(snapshot.text, const_segment=snapshot.const, **kwargs)
+        vm.symbols = snapshot.symbols
+        vm.restore(snapshot)
+        return vm
+
+    def snapshot(self):
+        bits = self.halted << len(FLAG_NAMES)
+        for i, f in enumerate(FLAG_NAMES):
+            bits |= getattr(self.flags, f) << i
+        header = SNAPSHOT_HEADER.pack(self.ip, self.mp, bits)
+        return Snapshot(self.instructions, self.const, b''.join([header, self.regfile, self.data]), self.symbols)
+
+    def restore(self, snapshot):
+        """Puts the machine back in the state saved in snapshot, which must
+        have been taken of a machine running the same program."""
+        assert snapshot.text is self.instructions
+        state = memoryview(snapshot.state)
+        self.ip, self.mp, bits = SNAPSHOT_HEADER.unpack_from(state)
+        for i, f in enumerate(FLAG_NAMES):
+            setattr(self.flags, f, bool(bits >> i & 1))
+        self.halted = bool(bits >> len(FLAG_NAMES) & 1)
+        regs_end = SNAPSHOT_HEADER.size + len(REG_NAMES)
+        self.regfile[:] = state[SNAPSHOT_HEADER.size:regs_end]
+        self.data[:] = state[regs_end:]
+
+    @property
+    def ip_bits(self):
+        """ip as the bit string used for addresses in .pptasm files."""
+        return uint_to_word(self.ip)
+
+    @property
+    def mp_bits(self):
+        return uint_to_word(self.mp)
+
+    def decode(self, inst):
+        """Returns a function of no arguments that executes inst on this machine."""
+        r = self.regfile
+        cmd = inst.cmd
+        if cmd in LOAD_DST:
+            return move_op(r, LOAD_DST[cmd], REG_INDEX[inst.args[0]])
+        if cmd in STORE_SRC:
+            return move_op(r, REG_INDEX[inst.args[0]], STORE_SRC[cmd])
+        if cmd in COPY_DST_SRC:
+            return move_op(r, *COPY_DST_SRC[cmd])
+        if cmd in CLEAR_DST:
+            return set_op(r, CLEAR_DST[cmd], 0)
+        if cmd in CONST_DST:
+            return set_op(r, CONST_DST[cmd], byte_to_uint(inst.args[0]))
+        if cmd == 'EXEC':
+            name = inst.args[0]
+            assert name == name.upper()
+            handler = self.exec_handler(name)
+            if handler is not None:
+                return handler
+        return unknown_op(inst)
+
+    def exec_handler(self, name):
+        """The handler of EXEC name, or None if there is none."""
+        if name in BRANCH_OPS:
+            return self.branch_op(*BRANCH_OPS[name])
+        handler = None
+        if not self.checked:
+            handler = getattr(self, 'fast_exec_' + name.lower(), None)
+        if handler is None and self.alu is not None:
+            handler = getattr(self, 'alu_exec_' + name.lower(), None)
+        if handler is None:
+            handler = getattr(self, 'exec_' + name.lower(), None)
+        return handler
+
+    def branch_op(self, compare, condition, negate):
+        """Handler of a compare-and-branch op: compare, the verdict of
+        condition (negated if negate), then a jump to M3 if it holds."""
+        compare = self.exec_handler(compare)
+        verdict = self.exec_handler('V' + condition)
+        flags = self.flags
+        m3 = self.m3
+        checked = self.checked
+        def op():
+            compare()
+            verdict()
+            if negate:
+                flags.verdict = not flags.verdict
+            if flags.verdict:
+                target = m3.read()
+                if checked:
+                    assert target < len(self.code)
+                self.ip = target
+        return op
 
     def step(self):
-        if self.ip not in self.instructions:
+        ip = self.ip
+        if ip >= len(self.code):
             raise Exception('ip out of range')
-        assert self._read_reg('SP')[-1] == '0'
-        assert len(self.m2.low) == 8
-        assert len(self.m3.low) == 8
-        inst = self.instructions[self.ip]
-        self.ip = inc_bits(self.ip)
-        if inst.cmd == 'LOAD1L':
-            if inst.args[0] == 'M3H':
-                self.m1.low = self.m3.high
-            elif inst.args[0] == 'M3L':
-                self.m1.low = self.m3.low
-            else:
-                self.m1.low = self.regs[inst.args[0]].value
-        elif inst.cmd == 'LOAD1H':
-            if inst.args[0] == 'M3H':
-                self.m1.high = self.m3.high
-            elif inst.args[0] == 'M3L':
-                self.m1.high = self.m3.low
-            else:
-                self.m1.high = self.regs[inst.args[0]].value
-        elif inst.cmd == 'LOAD2L':
-            if inst.args[0] == 'M3H':
-                self.m2.low = self.m3.high
-            elif inst.args[0] == 'M3L':
-                self.m2.low = self.m3.low
-            else:
-                self.m2.low = self.regs[inst.args[0]].value
-        elif inst.cmd == 'LOAD2H':
-            if inst.args[0] == 'M3H':
-                self.m2.high = self.m3.high
-            elif inst.args[0] == 'M3L':
-                self.m2.high = self.m3.low
+        assert not self.regfile[R_SPL] & 1
+        self.ip = ip + 1
+        self.code[ip]()
+
+    def fast_step(self):
+        """step without the checks, used by machines built with checked=False."""
+        ip = self.ip
+        self.ip = ip + 1
+        self.code[ip]()
+
+    def step_block(self):
+        """Executes the basic block at ip if the JIT is on, otherwise a single
+        instruction. Returns the number of instructions executed."""
+        if self.jit is None:
+            self.step()
+            return 1
+        if not self.debug_ips:
+            return self.jit.run_block()
+        fn, length = self._debug_lookup(self.ip)
+        if fn is None:
+            self.step()
+            return 1
+        self.ip = fn()
+        return length
+
+    def run(self, max_steps=None, until_ip=None):
+        """Runs until HLT, until max_steps micro-ops have executed, or until ip
+        becomes until_ip after a step. Exceptions raised by an instruction stop
+        the run and are reported in the result rather than propagated."""
+        limit = float('inf') if max_steps is None else max_steps
+        until = -1 if until_ip is None else until_ip
+        steps = 0
+        ip = self.ip
+        # Only a run that starts where the last one stopped at a breakpoint
+        # steps over it
+        if self.resume_ip != ip:
+            self.resume_ip = None
+        try:
+            if self.jit is None:
+                step = self.step
+                while not self.halted and steps < limit:
+                    ip = self.ip
+                    step()
+                    steps += 1
+                    if self.ip == until:
+                        return RunResult(REACHED_IP, steps, self.ip)
             else:
-                self.m2.high = self.regs[inst.args[0]].value
-        elif inst.cmd == 'COPYL':
-            self.m3.low = self.m1.low
-        elif inst.cmd == 'COPYH':
-            self.m3.high = self.m1.high
-        elif inst.cmd == 'STOREL':
-            self.regs[inst.args[0]].value = self.m3.low
-        elif inst.cmd == 'STOREH':
-            self.regs[inst.args[0]].value = self.m3.high
-        elif inst.cmd == 'CLEARL1':
-            self.m1.low = '0' * 8
-        elif inst.cmd == 'CLEARH1':
-            self.m1.high = '0' * 8
-        elif inst.cmd == 'CLEARL2':
-            self.m2.low = '0' * 8
-        elif inst.cmd == 'CLEARH2':
-            self.m2.high = '0' * 8
-        elif inst.cmd == 'CLEARL3':
-            self.m3.low = '0' * 8
-        elif inst.cmd == 'CLEARH3':
-            self.m3.high = '0' * 8
-        elif inst.cmd == 'CONSTL':
-            self.m3.low = inst.args[0]
-        elif inst.cmd == 'CONSTH':
-            self.m3.high = inst.args[0]
-        elif inst.cmd == 'EXEC':
-            name = inst.args[0]
-            assert name == name.upper()
-            getattr(self, 'exec_' + name.lower())()
+                # Blocks that would overrun the budget or pass through until_ip
+                # are stepped one instruction at a time instead.
+                lookup = self._debug_lookup if self.debug_ips else self.jit.lookup
+                while not self.halted and steps < limit:
+                    ip = self.ip
+                    fn, length = lookup(ip)
+                    if fn is None or steps + length > limit or ip < until < ip + length:
+                        self.step()
+                        steps += 1
+                    else:
+                        self.ip = fn()
+                        steps += length
+                    if self.ip == until:
+                        return RunResult(REACHED_IP, steps, self.ip)
+        except BreakpointHit:
+            self.resume_ip = self.ip
+            return RunResult(BREAKPOINT, steps, self.ip)
+        except InputWanted:
+            # Input ops read their line before changing anything, and are
+            # always interpreted, so the op at ip can simply run again
+            self.ip = ip
+            return RunResult(WAITING, steps, ip)
+        except WatchpointHit as w:
+            # The watched instruction has run, and is always interpreted
+            return RunResult(WATCHPOINT, steps + 1, self.ip, watch=(w.address, w.access))
+        except Exception as e:
+            return RunResult(FAULT, steps, ip, e)
+        finally:
+            self.io.flush()
+        if self.halted:
+            return RunResult(HALTED, steps, self.ip)
+        return RunResult(BUDGET_EXHAUSTED, steps, self.ip)
+
+    def add_breakpoint(self, ip):
+        """Makes run stop before the instruction at ip (or label ip) executes,
+        reporting BREAKPOINT. The next run resumes by executing it."""
+        if isinstance(ip, str):
+            ip = self.symbols[ip]
+        self.breakpoints.add(ip)
+        self._instrument()
+
+    def remove_breakpoint(self, ip):
+        if isinstance(ip, str):
+            ip = self.symbols[ip]
+        self.breakpoints.discard(ip)
+        self._instrument()
+
+    def add_watchpoint(self, address, read=False, write=True):
+        """Makes run stop after an instruction reads or writes the byte at
+        address, reporting WATCHPOINT."""
+        if read:
+            self.watch_reads.add(address)
+        if write:
+            self.watch_writes.add(address)
+        self._instrument()
+
+    def remove_watchpoint(self, address):
+        self.watch_reads.discard(address)
+        self.watch_writes.discard(address)
+        self._instrument()
+
+    def _instrument(self):
+        """Rewraps the handler table for the breakpoints and watchpoints set
+        now, so that the step loop has no checks of its own. The wrappers
+        from before are stripped from the current table, keeping any that a
+        Profiler, Trace or Recorder has put around the ops since, and only
+        the breakpoint ips and the memory ops are wrapped again. A wrapper
+        left inside another tool's does nothing once what it was for is
+        removed."""
+        plain = []
+        for op in self.code:
+            while hasattr(op, 'debug_op'):
+                op = op.debug_op
+            plain.append(op)
+        code = list(plain)
+        debug_ips = set()
+        for ip, inst in enumerate(self.instructions):
+            if inst.cmd == 'EXEC' and inst.args[0] in WATCHED_OPS:
+                is_write, kind = WATCHED_OPS[inst.args[0]]
+                if self.watch_writes if is_write else self.watch_reads:
+                    code[ip] = watched_op(self, code[ip], is_write, kind)
+                    debug_ips.add(ip)
+        for ip in self.breakpoints:
+            if ip < len(code):
+                code[ip] = breakpoint_op(self, ip, code[ip])
+                debug_ips.add(ip)
+        self.code = code
+        self.plain_code = plain if debug_ips else None
+        self.debug_ips = debug_ips
+
+    def _debug_lookup(self, ip):
+        """Jit.lookup while debugging. Blocks are compiled against the
+        unwrapped handlers, and blocks containing a wrapped one are
+        interpreted."""
+        code = self.code
+        self.code = self.plain_code
+        try:
+            fn, length = self.jit.lookup(ip)
+        finally:
+            self.code = code
+        if fn is not None and any(i in self.debug_ips for i in range(ip, ip + length)):
+            return None, 1
+        return fn, length
+
+    def _alu_byte(self, table, carry, store=True):
+        r = self.regfile
+        res, carry, overflow, sign, zero = table[carry << 16 | r[R_M1L] << 8 | r[R_M2L]]
+        if store:
+            r[R_M3L] = res
+        f = self.flags
+        f.carry = carry
+        f.overflow = overflow
+        f.sign = sign
+        f.zero = zero
+
+    def alu_exec_addb(self):
+        self._alu_byte(self.alu.add, 0)
+
+    def alu_exec_adcb(self):
+        self._alu_byte(self.alu.add, self.flags.carry)
+
+    def alu_exec_subb(self):
+        self._alu_byte(self.alu.sub, 0)
+
+    def alu_exec_sbbb(self):
+        self._alu_byte(self.alu.sub, self.flags.carry)
+
+    def alu_exec_cmpb(self):
+        self._alu_byte(self.alu.sub, 0, store=False)
+
+    def _alu_unary(self, table):
+        r = self.regfile
+        res, carry, overflow, sign, zero = table[r[R_M1L]]
+        r[R_M3L] = res
+        f = self.flags
+        f.carry = carry
+        f.overflow = overflow
+        f.sign = sign
+        f.zero = zero
+
+    def alu_exec_incb(self):
+        self._alu_unary(self.alu.inc)
+
+    def alu_exec_decb(self):
+        self._alu_unary(self.alu.dec)
+
+    def alu_exec_negb(self):
+        self._alu_unary(self.alu.neg)
+
+    def _alu_shift(self, table):
+        r = self.regfile
+        res, carry, overflow = table[r[R_M1L]]
+        r[R_M3L] = res
+        f = self.flags
+        f.carry = carry
+        f.overflow = overflow
+
+    def alu_exec_shlb(self):
+        self._alu_shift(self.alu.shl)
+
+    def alu_exec_sarb(self):
+        self._alu_shift(self.alu.sar)
+
+    def alu_exec_shrb(self):
+        self._alu_shift(self.alu.shr)
+
+    def alu_exec_notb(self):
+        r = self.regfile
+        r[R_M3L] = self.alu.not_[r[R_M1L]]
+
+    def alu_exec_notw(self):
+        r = self.regfile
+        not_ = self.alu.not_
+        r[R_M3H] = not_[r[R_M1H]]
+        r[R_M3L] = not_[r[R_M1L]]
+
+    def alu_exec_shlw(self):
+        r = self.regfile
+        lo, bit, _ = self.alu.shl[r[R_M1L]]
+        hi, carry, overflow = self.alu.shl_in[bit << 8 | r[R_M1H]]
+        r[R_M3H] = hi
+        r[R_M3L] = lo
+        f = self.flags
+        f.carry = carry
+        f.overflow = overflow
+
+    def _alu_word_shift_right(self, table):
+        r = self.regfile
+        hi, bit, overflow = table[r[R_M1H]]
+        lo, carry, _ = self.alu.shr_in[bit << 8 | r[R_M1L]]
+        r[R_M3H] = hi
+        r[R_M3L] = lo
+        f = self.flags
+        f.carry = carry
+        f.overflow = overflow
+
+    def alu_exec_sarw(self):
+        self._alu_word_shift_right(self.alu.sar)
+
+    def alu_exec_shrw(self):
+        self._alu_word_shift_right(self.alu.shr)
 
     def _assign_reg(self, letter, value):
-        assert len(value) == 16
-        self.regs[letter + 'H'].value = value[:8]
-        self.regs[letter + 'L'].value = value[8:]
+        assert 0 <= value < 2**16
+        self.regfile[REG_INDEX[letter + 'H']] = value >> 8
+        self.regfile[REG_INDEX[letter + 'L']] = value & 0xff
 
     def _read_reg(self, letter):
-        return self.regs[letter + 'H'].value + self.regs[letter + 'L'].value
+        return self.regfile[REG_INDEX[letter + 'H']] << 8 | self.regfile[REG_INDEX[letter + 'L']]
 
     def _addb(self, with_carry=False):
-        res = ['0'] * 8
-        carry = False
-        if with_carry:
-            carry = self.flags.carry
-        for i in range(7, -1, -1):
-            if i == 7:
-                self.flags.overflow = carry
-            total = 1 if self.m1.low[i] == '1' else 0
-            total += 1 if self.m2.low[i] == '1' else 0
-            if carry:
-                total += 1
-            if total == 0:
-                carry = False
-            elif total == 1:
-                carry = False
-                res[i] = '1'
-            elif total == 2:
-                carry = True
-            elif total == 3:
-                carry = True
-                res[i] = '1'
-            else:
-                assert False
-        self.flags.carry = carry
-        self.flags.sign = res[0] == '1'
-        self.m3.low = ''.join(res)
-        self.flags.zero = self.m3.low == '0' * 8
-    
+        r = self.regfile
+        carry = 1 if with_carry and self.flags.carry else 0
+        total = r[R_M1L] + r[R_M2L] + carry
+        res = total & 0xff
+        r[R_M3L] = res
+        self.flags.set_arith(total, res, 0x80, carry == 1)
+
     def exec_adcb(self):
         self._addb(with_carry=True)
 
     def _addw(self, with_carry=False):
-        res = ['0'] * 16
-        carry = False
-        if with_carry:
-            carry = self.flags.carry
-        for i in range(15, -1, -1):
-            if i == 15:
-                self.flags.overflow = carry
-            total = 1 if self.m1.read()[i] == '1' else 0
-            total += 1 if self.m2.read()[i] == '1' else 0
-            if carry:
-                total += 1
-            if total == 0:
-                carry = False
-            elif total == 1:
-                carry = False
-                res[i] = '1'
-            elif total == 2:
-                carry = True
-            elif total == 3:
-                carry = True
-                res[i] = '1'
-            else:
-                assert False
-        self.flags.carry = carry
-        self.flags.sign = res[0] == '1'
-        self.m3.assign(''.join(res))
-        self.flags.zero = self.m3.read() == '0' * 16
+        r = self.regfile
+        carry = 1 if with_carry and self.flags.carry else 0
+        total = (r[R_M1H] << 8 | r[R_M1L]) + (r[R_M2H] << 8 | r[R_M2L]) + carry
+        res = total & 0xffff
+        r[R_M3H] = res >> 8
+        r[R_M3L] = res & 0xff
+        self.flags.set_arith(total, res, 0x8000, carry == 1)
 
     def exec_adcw(self):
         self._addw(with_carry=True)
@@ -228,9 +834,7 @@ class MachineState:
         self._addw(with_carry=False)
 
     def _shiftaddr(self, n=1):
-        addr = self.m1.read()
-        addr = addr[n:] + '0' * n
-        self.m3.assign(addr)
+        self.m3.assign((self.m1.read() << n) & 0xffff)
 
     def exec_shiftaddr1(self):
         self._shiftaddr(1)
@@ -242,52 +846,28 @@ class MachineState:
         self._shiftaddr(3)
 
     def exec_addaddr(self):
-        res = ['0'] * 16
-        carry = False
-        for i in range(15, -1, -1):
-            total = 1 if self.m1.read()[i] == '1' else 0
-            total += 1 if self.m2.read()[i] == '1' else 0
-            if carry:
-                total += 1
-            if total == 0:
-                carry = False
-            elif total == 1:
-                carry = False
-                res[i] = '1'
-            elif total == 2:
-                carry = True
-            elif total == 3:
-                carry = True
-                res[i] = '1'
-        self.m3.assign(''.join(res))
+        self.m3.assign((self.m1.read() + self.m2.read()) & 0xffff)
 
     def _bitwiseb(self, fn):
-        res = ['0'] * 8
-        for i in range(8):
-            res[i] = fn(self.m1.low[i], self.m2.low[i])
-        self.m3.low = ''.join(res)
-        self.flags.zero = self.m3.low == '0' * 8
-        self.flags.sign = self.m3.low[0] == '1'
+        r = self.regfile
+        res = fn(r[R_M1L], r[R_M2L])
+        r[R_M3L] = res
+        self.flags.set_result(res, 0x80)
 
     def _bitwisew(self, fn):
-        res = ['0'] * 16
-        for i in range(16):
-            res[i] = fn(self.m1.read()[i], self.m2.read()[i])
-        self.m3.assign(''.join(res))
-        self.flags.zero = self.m3.read() == '0' * 16
-        self.flags.sign = self.m3.high[0] == '1'
+        res = fn(self.m1.read(), self.m2.read())
+        self.m3.assign(res)
+        self.flags.set_result(res, 0x8000)
 
     def exec_andb(self):
-        self._bitwiseb(and_bits)
+        self._bitwiseb(operator.and_)
 
     def exec_andw(self):
-        self._bitwisew(and_bits)
+        self._bitwisew(operator.and_)
 
     def exec_cbw(self):
-        if self.regs['AL'].value[0] == '1':
-            self.regs['AH'].value = '1' * 8
-        else:
-            self.regs['AH'].value = '0' * 8
+        r = self.regfile
+        r[R_AH] = 0xff if r[R_AL] & 0x80 else 0
 
     def exec_clc(self):
         self.flags.carry = False
@@ -306,116 +886,64 @@ class MachineState:
         self.m3.assign(m3)
 
     def exec_decb(self):
-        res = ['0'] * 8
-        borrow = True
-        for i in range(7, -1, -1):
-            if i == 7:
-                self.flags.overflow = borrow
-            if borrow:
-                if self.m1.low[i] == '1':
-                    res[i] = '0'
-                    borrow = False
-                else:
-                    res[i] = '1'
-            else:
-                res[i] = self.m1.low[i]
-        self.m3.low = ''.join(res)
-        self.flags.sign = self.m3.low[0]
-        self.flags.carry = borrow
-        self.flags.zero = self.m3.low == '0' * 8
+        total = self.m1.low - 1
+        res = total & 0xff
+        self.m3.low = res
+        self.flags.set_arith(total, res, 0x80, True)
 
     def exec_decw(self):
-        res = ['0'] * 16
-        borrow = True
-        for i in range(15, -1, -1):
-            if i == 15:
-                self.flags.overflow = borrow
-            if borrow:
-                if self.m1.read()[i] == '1':
-                    res[i] = '0'
-                    borrow = False
-                else:
-                    res[i] = '1'
-            else:
-                res[i] = self.m1.read()[i]
-        self.m3.assign(''.join(res))
-        self.flags.sign = self.m3.high[0]
-        self.flags.carry = borrow
-        self.flags.zero = self.m3.read() == '0' * 16
+        total = self.m1.read() - 1
+        res = total & 0xffff
+        self.m3.assign(res)
+        self.flags.set_arith(total, res, 0x8000, True)
 
     def exec_dec2w(self):
-        x = word_to_uint(self.m1.read()) - 2
-        self.m3.assign(uint_to_word(x))
+        self.m3.assign((self.m1.read() - 2) & 0xffff)
 
     def exec_inc2w(self):
-        x = word_to_uint(self.m1.read()) + 2
-        self.m3.assign(uint_to_word(x))
+        self.m3.assign((self.m1.read() + 2) & 0xffff)
 
     def exec_cwd(self):
-        if self.regs['AH'].value[0] == '1':
-            self.regs['DH'].value = '1' * 8
-            self.regs['DL'].value = '1' * 8
+        if self.regfile[R_AH] & 0x80:
+            self._assign_reg('D', 0xffff)
         else:
-            self.regs['DH'].value = '0' * 8
-            self.regs['DL'].value = '0' * 8
+            self._assign_reg('D', 0)
 
     # TODO: Division
 
     def exec_divb(self):
-        x = word_to_uint(self._read_reg('A'))
-        y = byte_to_uint(self.m1.low)
+        x = self._read_reg('A')
+        y = self.m1.low
         z = x // y
         w = x % y
-        self.regs['AL'].value = uint_to_byte(z)
-        self.regs['AH'].value = uint_to_byte(w)
+        self.regfile[R_AL] = z & 0xff
+        self.regfile[R_AH] = w & 0xff
 
     def exec_divw(self):
-        xdw = self._read_reg('D') + self._read_reg('A')
-        x = dword_to_uint(xdw)
-        y = word_to_uint(self.m1.read())
+        x = self._read_reg('D') << 16 | self._read_reg('A')
+        y = self.m1.read()
         z = x // y
         w = x % y
-        self._assign_reg('A', uint_to_word(z))
-        self._assign_reg('D', uint_to_word(w))
+        self._assign_reg('A', z & 0xffff)
+        self._assign_reg('D', w & 0xffff)
 
     def exec_idivb(self):
-        x = word_to_int(self._read_reg('A'))
-        y = byte_to_int(self.m1.low)
-        if x < 0:
-            x = -x
-            y = -y
-        if y >= 0:
-            z = x // y
-            w = x % y
-        else:
-            z = (x + y + 1) // y
-            w = x - z * y
-        self.regs['AL'].value = int_to_byte(z)
-        self.regs['AH'].value = int_to_byte(w)
+        z, w = signed_divmod(sign_extend(self._read_reg('A'), 16), sign_extend(self.m1.low, 8))
+        self.regfile[R_AL] = z & 0xff
+        self.regfile[R_AH] = w & 0xff
 
     def exec_idivw(self):
-        xdw = self._read_reg('D') + self._read_reg('A')
-        x = dword_to_int(xdw)
-        y = word_to_int(self.m1.read())
-        if x < 0:
-            x = -x
-            y = -y
-        if y >= 0:
-            z = x // y
-            w = x % y
-        else:
-            z = (x + y + 1) // y
-            w = x - z * y
-        self._assign_reg('A', int_to_word(z))
-        self._assign_reg('D', int_to_word(w))
+        x = sign_extend(self._read_reg('D') << 16 | self._read_reg('A'), 32)
+        z, w = signed_divmod(x, sign_extend(self.m1.read(), 16))
+        self._assign_reg('A', z & 0xffff)
+        self._assign_reg('D', w & 0xffff)
 
     def exec_imulb(self):
-        x = byte_to_int(self.regs['AL'].value)
-        y = byte_to_int(self.m1.low)
+        x = sign_extend(self.regfile[R_AL], 8)
+        y = sign_extend(self.m1.low, 8)
         z = x * y
-        res = int_to_word(z)
-        self._assign_reg('A', res)
-        if byte_to_int(self.regs['AL'].value) == z:
+        self._assign_reg('A', z & 0xffff)
+        if sign_extend(self.regfile[R_AL], 8) == z:
             self.flags.carry = False
             self.flags.overflow = False
         else:
@@ -423,13 +951,12 @@ class MachineState:
             self.flags.overflow = True
 
     def exec_imulw(self):
-        x = word_to_int(self._read_reg('A'))
-        y = word_to_int(self.m1.read())
+        x = sign_extend(self._read_reg('A'), 16)
+        y = sign_extend(self.m1.read(), 16)
         z = x * y
-        zh, zl = int_to_dword(z)
-        self._assign_reg('D', zh)
-        self._assign_reg('A', zl)
-        if word_to_int(self._read_reg('A')) == z:
+        self._assign_reg('D', (z >> 16) & 0xffff)
+        self._assign_reg('A', z & 0xffff)
+        if sign_extend(self._read_reg('A'), 16) == z:
             self.flags.carry = False
             self.flags.overflow = False
         else:
@@ -437,12 +964,11 @@ class MachineState:
             self.flags.overflow = True
 
     def exec_mulb(self):
-        x = byte_to_uint(self.regs['AL'].value)
-        y = byte_to_uint(self.m1.low)
+        x = self.regfile[R_AL]
+        y = self.m1.low
         z = x * y
-        res = uint_to_word(z)
-        self._assign_reg('A', res)
-        if self.regs['AH'].value == '0' * 8:
+        self._assign_reg('A', z)
+        if self.regfile[R_AH] == 0:
             self.flags.carry = False
             self.flags.overflow = False
         else:
@@ -450,13 +976,12 @@ class MachineState:
             self.flags.overflow = True
 
     def exec_mulw(self):
-        x = word_to_uint(self._read_reg('A'))
-        y = word_to_uint(self.m1.read())
+        x = self._read_reg('A')
+        y = self.m1.read()
         z = x * y
-        zh, zl = uint_to_dword(z)
-        self._assign_reg('D', zh)
-        self._assign_reg('A', zl)
-        if self._read_reg('D') == '0' * 16:
+        self._assign_reg('D', z >> 16)
+        self._assign_reg('A', z & 0xffff)
+        if self._read_reg('D') == 0:
             self.flags.carry = False
             self.flags.overflow = False
         else:
@@ -464,44 +989,16 @@ class MachineState:
             self.flags.overflow = True
 
     def exec_incb(self):
-        res = ['0'] * 8
-        carry = True
-        for i in range(7, -1, -1):
-            if i == 7:
-                self.flags.overflow = carry
-            if carry:
-                if self.m1.low[i] == '0':
-                    res[i] = '1'
-                    carry = False
-                else:
-                    res[i] = '0'
-                    carry = True
-            else:
-                res[i] = self.m1.low[i]
-        self.m3.low = ''.join(res)
-        self.flags.sign = self.m3.low[0]
-        self.flags.carry = carry
-        self.flags.zero = self.m3.low == '0' * 8
+        total = self.m1.low + 1
+        res = total & 0xff
+        self.m3.low = res
+        self.flags.set_arith(total, res, 0x80, True)
 
     def exec_incw(self):
-        res = ['0'] * 16
-        carry = True
-        for i in range(15, -1, -1):
-            if i == 15:
-                self.flags.overflow = carry
-            if carry:
-                if self.m1.read()[i] == '0':
-                    res[i] = '1'
-                    carry = False
-                else:
-                    res[i] = '0'
-            else:
-                res[i] = self.m1.read()[i]
-                
-        self.m3.assign(''.join(res))
-        self.flags.sign = self.m3.high[0]
-        self.flags.carry = carry
-        self.flags.zero = self.m3.read() == '0' * 16
+        total = self.m1.read() + 1
+        res = total & 0xffff
+        self.m3.assign(res)
+        self.flags.set_arith(total, res, 0x8000, True)
 
     # TODO: IRET
 
@@ -525,202 +1022,181 @@ class MachineState:
 
     def exec_vl(self):
         self.flags.verdict = self.flags.sign != self.flags.overflow
-    
+
     def exec_nv(self):
         self.flags.verdict = not self.flags.verdict
 
     def exec_jmp(self): # Used
-        assert(self.regs['SPH'].value[0] == '1')
+        assert self.regfile[R_SPH] & 0x80
+        target = self.m1.read()
+        assert target < len(self.code)
+        self.ip = target
+
+    def fast_exec_jmp(self):
         self.ip = self.m1.read()
 
     def exec_jv(self): # Used
+        if self.flags.verdict:
+            target = self.m1.read()
+            assert target < len(self.code)
+            self.ip = target
+
+    def fast_exec_jv(self):
         if self.flags.verdict:
             self.ip = self.m1.read()
 
     def exec_rmem(self): # Used
-        if self.mp[0] == '1':
-            self.m3.low = self.data[self.mp]
+        mp = self.mp
+        if mp >= DATA_BASE:
+            self.regfile[R_M3L] = self.data[mp - DATA_BASE]
         else:
-            self.m3.low = self.const[self.mp]
+            self.regfile[R_M3L] = self.const[mp]
 
     def exec_wmem(self):
-        assert self.mp[0] == '1'
-        # assert self.mp in self.data
-        self.data[self.mp] = self.m2.low
+        assert self.mp >= DATA_BASE
+        self.data[self.mp - DATA_BASE] = self.regfile[R_M2L]
 
     def exec_smp(self):
         self.mp = self.m1.read()
 
     def exec_imp(self):
-        self.mp = inc_bits(self.mp)
+        self.mp = (self.mp + 1) & 0xffff
 
     def exec_dmp(self):
-        self.mp = dec_bits(self.mp)
+        self.mp = (self.mp - 1) & 0xffff
+
+    # Extended ISA (pptasm --extended): word memory access and whole stack
+    # operations as one op. The stack ops leave mp alone.
+
+    def exec_rmemw(self):
+        mp = self.mp
+        self.m3.assign(self.memory.read((mp + 1) & 0xffff) << 8 | self.memory.read(mp))
+
+    def exec_wmemw(self):
+        mp = self.mp
+        self.memory.write(mp, self.regfile[R_M3L])
+        self.memory.write((mp + 1) & 0xffff, self.regfile[R_M3H])
+
+    def _push(self, word):
+        sp = (self._read_reg('SP') - 2) & 0xffff
+        # The high byte of a push at 0xffff would wrap into the const segment
+        assert DATA_BASE <= sp < 0xffff
+        self.data[sp - DATA_BASE] = word & 0xff
+        self.data[sp - DATA_BASE + 1] = word >> 8
+        self._assign_reg('SP', sp)
+
+    def _pop(self):
+        sp = self._read_reg('SP')
+        word = self.memory.read((sp + 1) & 0xffff) << 8 | self.memory.read(sp)
+        self._assign_reg('SP', (sp + 2) & 0xffff)
+        return word
+
+    def exec_pushw(self):
+        self._push(self.m1.read())
+
+    def exec_popw(self):
+        self.m3.assign(self._pop())
+
+    def exec_callw(self):
+        target = self.m1.read()
+        assert target < len(self.code)
+        self._push(self.ip)
+        self.ip = target
+
+    def exec_retw(self):
+        target = self._pop()
+        assert target < len(self.code)
+        self.ip = target
+
+    def fast_exec_callw(self):
+        target = self.m1.read()
+        self._push(self.ip)
+        self.ip = target
+
+    def fast_exec_retw(self):
+        self.ip = self._pop()
 
     def exec_negb(self):
-        res = ['0'] * 8
-        for i in range(8):
-            res[i] = '0' if self.m1.low[i] == '1' else '1'
-        m1 = self.m1.low
-        self.m1.low = ''.join(res)
-        self.exec_incb()
-        self.m3.low = self.m1.low
-        self.m1.low = m1
+        total = (~self.m1.low & 0xff) + 1
+        res = total & 0xff
+        self.m3.low = res
+        self.flags.set_arith(total, res, 0x80, True)
 
     def exec_negw(self):
-        res = ['0'] * 16
-        for i in range(16):
-            res[i] = '0' if self.m1.read()[i] == '1' else '1'
-        m1 = self.m1.read()
-        self.m1.assign(''.join(res))
-        self.exec_incw()
-        self.m3.assign(self.m1.read())
-        self.m1.assign(m1)
+        total = (~self.m1.read() & 0xffff) + 1
+        res = total & 0xffff
+        self.m3.assign(res)
+        self.flags.set_arith(total, res, 0x8000, True)
 
     def exec_notb(self):
-        res = ['0'] * 8
-        for i in range(8):
-            res[i] = '0' if self.m1.low[i] == '1' else '1'
-        self.m3.low = ''.join(res)
+        self.m3.low = ~self.m1.low & 0xff
 
     def exec_notw(self):
-        res = ['0'] * 16
-        for i in range(16):
-            res[i] = '0' if self.m1.read()[i] == '1' else '1'
-        self.m3.assign(''.join(res))
+        self.m3.assign(~self.m1.read() & 0xffff)
 
     def exec_orb(self):
-        self._bitwiseb(or_bits)
+        self._bitwiseb(operator.or_)
 
     def exec_orw(self):
-        self._bitwisew(or_bits)
+        self._bitwisew(operator.or_)
 
     def exec_sarb(self):
-        carry = self.m1.low[0] == '1'
-        res = ['0'] * 8
-        for i in range(8):
-            if carry:
-                res[i] = '1'
-            carry = self.m1.low[i] == '1'
-        self.flags.carry = carry
-        self.flags.overflow = res[0] != self.m1.low[0]
-        self.m3.low = ''.join(res)
+        x = self.m1.low
+        self.flags.carry = x & 1 == 1
+        self.flags.overflow = False
+        self.m3.low = x >> 1 | x & 0x80
 
     def exec_sarw(self):
-        carry = self.m1.low[0] == '1'
-        res = ['0'] * 16
-        for i in range(16):
-            if carry:
-                res[i] = '1'
-            carry = self.m1.read()[i] == '1'
-        self.flags.carry = carry
-        self.flags.overflow = res[0] != self.m1.high[0]
-        self.m3.assign(''.join(res))
+        x = self.m1.read()
+        self.flags.carry = x & 1 == 1
+        self.flags.overflow = False
+        self.m3.assign(x >> 1 | x & 0x8000)
 
     def exec_shlb(self): # Used
-        carry = False
-        res = ['0'] * 8
-        for i in range(7, -1, -1):
-            if carry:
-                res[i] = '1'
-            carry = self.m1.low[i] == '1'
-        self.flags.carry = carry
-        self.flags.overflow = res[0] != self.m1.low[0]
-        self.m3.low = ''.join(res)
-        
+        x = self.m1.low
+        res = (x << 1) & 0xff
+        self.flags.carry = x >= 0x80
+        self.flags.overflow = (res ^ x) >= 0x80
+        self.m3.low = res
+
     def exec_shlw(self): # Used
-        carry = False
-        res = ['0'] * 16
-        for i in range(15, -1, -1):
-            if carry:
-                res[i] = '1'
-            carry = self.m1.read()[i] == '1'
-        self.flags.carry = carry
-        self.flags.overflow = res[0] != self.m1.high[0]
-        self.m3.assign(''.join(res))
+        x = self.m1.read()
+        res = (x << 1) & 0xffff
+        self.flags.carry = x >= 0x8000
+        self.flags.overflow = (res ^ x) >= 0x8000
+        self.m3.assign(res)
 
     def exec_shrb(self):
-        carry = False
-        res = ['0'] * 8
-        for i in range(8):
-            if carry:
-                res[i] = '1'
-            carry = self.m1.low[i] == '1'
-        self.flags.carry = carry
-        self.flags.overflow = res[0] != self.m1.low[0]
-        self.m3.low = ''.join(res)
+        x = self.m1.low
+        self.flags.carry = x & 1 == 1
+        self.flags.overflow = x >= 0x80
+        self.m3.low = x >> 1
 
     def exec_shrw(self):
-        carry = False
-        res = ['0'] * 16
-        for i in range(16):
-            if carry:
-                res[i] = '1'
-            carry = self.m1.read()[i] == '1'
-        self.flags.carry = carry
-        self.flags.overflow = res[0] != self.m1.high[0]
-        self.m3.assign(''.join(res))
+        x = self.m1.read()
+        self.flags.carry = x & 1 == 1
+        self.flags.overflow = x >= 0x8000
+        self.m3.assign(x >> 1)
 
     def exec_stc(self):
         self.flags.carry = True
 
     def _subb(self, with_borrow=False):
-        res = ['0'] * 8
-        borrow = False
-        if with_borrow:
-            borrow = self.flags.carry
-        for i in range(7, -1, -1):
-            if i == 7:
-                self.flags.overflow = borrow
-            total = 1 if self.m1.low[i] == '1' else 0
-            total -= 1 if self.m2.low[i] == '1' else 0
-            if borrow:
-                total -= 1
-            if total == 0:
-                borrow = False
-            elif total == 1:
-                borrow = False
-                res[i] = '1'
-            elif total == -1:
-                borrow = True
-                res[i] = '1'
-            elif total == -2:
-                borrow = True
-            else:
-                assert False
-        self.flags.carry = borrow
-        self.flags.sign = res[0] == '1'
-        self.m3.low = ''.join(res)
-        self.flags.zero = self.m3.low == '0' * 8
+        r = self.regfile
+        borrow = 1 if with_borrow and self.flags.carry else 0
+        total = r[R_M1L] - r[R_M2L] - borrow
+        res = total & 0xff
+        r[R_M3L] = res
+        self.flags.set_arith(total, res, 0x80, borrow == 1)
 
     def _subw(self, with_borrow=False):
-        res = ['0'] * 16
-        borrow = False
-        if with_borrow:
-            borrow = self.flags.carry
-        for i in range(15, -1, -1):
-            if i == 15:
-                self.flags.overflow = borrow
-            total = 1 if self.m1.read()[i] == '1' else 0
-            total -= 1 if self.m2.read()[i] == '1' else 0
-            if borrow:
-                total -= 1
-            if total == 0:
-                borrow = False
-            elif total == 1:
-                borrow = False
-                res[i] = '1'
-            elif total == -1:
-                borrow = True
-                res[i] = '1'
-            elif total == -2:
-                borrow = True
-            else:
-                assert False
-        self.flags.carry = borrow
-        self.flags.sign = res[0] == '1'
-        self.m3.assign(''.join(res))
-        self.flags.zero = self.m3.read() == '0' * 16
+        r = self.regfile
+        borrow = 1 if with_borrow and self.flags.carry else 0
+        total = (r[R_M1H] << 8 | r[R_M1L]) - (r[R_M2H] << 8 | r[R_M2L]) - borrow
+        res = total & 0xffff
+        r[R_M3H] = res >> 8
+        r[R_M3L] = res & 0xff
+        self.flags.set_arith(total, res, 0x8000, borrow == 1)
 
     def exec_sbbb(self):
         self._subb(with_borrow=True)
@@ -745,56 +1221,68 @@ class MachineState:
         self.m3.assign(m3)
 
     def exec_xorb(self):
-        self._bitwiseb(xor_bits)
+        self._bitwiseb(operator.xor)
 
     def exec_xorw(self):
-        self._bitwisew(xor_bits)
+        self._bitwisew(operator.xor)
 
     def exec_puts(self):
-        m3 = self.m3.low
-        self.m1.assign(self._read_reg('A'))
-        self.exec_smp()
-        self.exec_rmem()
-        while self.m3.low != '0' * 8:
-            print(chr(byte_to_uint(self.m3.low)), end='')
-            self.exec_imp()
+        addr = self._read_reg('A')
+        self.m1.assign(addr)
+        segment, offset = self.memory._segment(addr)
+        end = segment.find(0, offset)
+        if end < 0:
+            # The string runs into the next segment
+            m3 = self.m3.low
+            self.exec_smp()
             self.exec_rmem()
-        self.m3.low = m3
+            while self.m3.low != 0:
+                self.io.write(chr(self.m3.low))
+                self.exec_imp()
+                self.exec_rmem()
+            self.m3.low = m3
+            return
+        self.io.write(segment[offset:end].decode('latin-1'))
+        self.mp = addr + end - offset
 
     def exec_putint(self):
-        print(str(word_to_int(self._read_reg('A'))), end='')
+        self.io.write(str(sign_extend(self._read_reg('A'), 16)))
 
     def exec_putc(self):
-        print(chr(byte_to_uint(self.regs['AL'].value)), end='')
+        self.io.write(chr(self.regfile[R_AL]))
 
     def exec_gets(self):
+        s = self.io.readline()
+        addr = self._read_reg('A')
+        self.m1.assign(addr)
+        if addr >= DATA_BASE and addr + len(s) < 2**16:
+            offset = addr - DATA_BASE
+            self.data[offset:offset + len(s) + 1] = bytes([ord(c) & 0xff for c in s] + [0])
+            self.mp = addr + len(s)
+            return
+        # Faults like writing byte by byte would, after the same partial writes
         m2 = self.m2.low
-        s = input()
-        self.m1.assign(self._read_reg('A'))
         self.exec_smp()
         for c in s:
-            self.m2.low = uint_to_byte(ord(c))
+            self.m2.low = ord(c) & 0xff
             self.exec_wmem()
             self.exec_imp()
-        self.m2.low = '0' * 8
+        self.m2.low = 0
         self.exec_wmem()
         self.m2.low = m2
 
     def exec_getint(self):
-        self._assign_reg('A', int_to_word(int(input())))
+        self._assign_reg('A', int(self.io.readline()) & 0xffff)
 
     def exec_rand(self):
-        r = random.randint(0, 2 ** 15 - 1)
-        self._assign_reg('A', int_to_word(r))
+        r = self.rng.randint(0, 2 ** 15 - 1)
+        self._assign_reg('A', r)
 
     def exec_hlt(self):
-        exit(0)
-
-
-def run(pptasm_dict):
-    vm = MachineState(pptasm_dict)
-    while True:
-        vm.step()
+        # Leave ip on the HLT so that stepping a halted machine halts again.
+        self.ip -= 1
+        self.halted = True
+        self.io.flush()
 
 def test_verdict(cmd1, cmd2):
     print('Testing ' + cmd1 + ' and ' + cmd2)
@@ -824,45 +1312,149 @@ def test():
         cmd = k[6:]
         if cmd[0] != 'n':
             test_verdict(k, 'exec_vn' + cmd)
-    
+
     print(names)
 
-def parse_file(file_path):
+def parse_section(lines, i, end_marker, base):
+    """Reads the address/byte lines of a data: or const: section starting
+    at lines[i] into a bytearray. Returns it and the index of end_marker."""
+    image = bytearray()
+    while i < len(lines) and lines[i] != end_marker:
+        parts = split_on_spaces(lines[i])
+        if word_to_uint(parts[0]) != base + len(image):
+            raise Exception('Byte at %s is out of order' % parts[0])
+        image.append(byte_to_uint(parts[1]))
+        i += 1
+    return image, i
+
+def parse_file(file_path, **kwargs):
     with open(file_path, mode='rt') as file:
         lines = file.readlines()
         lines = [line.strip() for line in lines]
         lines = [line for line in lines if line]
-    text = {}
-    data = {}
-    const = {}
+    text = []
     i = 0
     assert lines[i] == 'text:'
     i += 1
     while lines[i] != 'data:':
-        parts = split_on_spaces(lines[i])
-        text[parts[0]] = Instruction(parts[1], parts[2:])
+        line, _, comment = lines[i].partition('#')
+        parts = split_on_spaces(line)
+        if word_to_uint(parts[0]) != len(text):
+            raise Exception('Instruction at %s is out of order' % parts[0])
+        text.append(Instruction(parts[1], parts[2:], comment.strip() or None))
         i += 1
-    i += 1
-    while lines[i] != 'const:':
-        parts = split_on_spaces(lines[i])
-        data[parts[0]] = parts[1]
-        i += 1
-    i += 1
-    while i < len(lines):
-        parts = split_on_spaces(lines[i])
-        const[parts[0]] = parts[1]
-        i += 1
-    return MachineState(text, data, const)    
+    data, i = parse_section(lines, i + 1, 'const:', DATA_BASE)
+    const, i = parse_section(lines, i + 1, 'symbols:', 0)
+    vm = MachineState(text, data, const, **kwargs)
+    # The symbols: section (text labels) is optional
+    for line in lines[i + 1:]:
+        addr, name = split_on_spaces(line)
+        vm.symbols[name] = word_to_uint(addr)
+    return vm
+
+def load_image(file_path, **kwargs):
+    """Loads a binary image written by pptasm --binary. The file is mapped
+    rather than read: the text is decoded and the data and const sections
+    are copied into the machine's segments straight from the mapping, which
+    is closed once loading finishes. The segments are not views of the file,
+    since they are always 32 KiB and the sections are usually shorter."""
+    with open(file_path, mode='rb') as file:
+        image = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(image)
+    try:
+        magic, version, n_text, n_data, n_const, n_symbols, n_comments = IMAGE_HEADER.unpack_from(view)
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+            raise Exception('%s is not a version %d pptasm image' % (file_path, IMAGE_VERSION))
+        i = IMAGE_HEADER.size
+        # Every instruction with the same opcode and operand gets the same args list
+        args = []
+        for cmd in PPT_COMMANDS:
+            if cmd == 'EXEC':
+                args.append([[name] for name in EXEC_OPS])
+            elif cmd in CONST_DST:
+                args.append([[uint_to_byte(x)] for x in range(256)])
+            elif cmd in CLEAR_DST or cmd in COPY_DST_SRC:
+                args.append([[]] * 256)
+            else:
+                args.append([[r] for r in REG_NAMES])
+        text = [Instruction(PPT_COMMANDS[op], args[op][x])
+                for op, x in zip(view[i:i + 2 * n_text:2], view[i + 1:i + 2 * n_text:2])]
+        i += 2 * n_text
+        vm = MachineState(text, view[i:i + n_data], view[i + n_data:i + n_data + n_const], **kwargs)
+        i += n_data + n_const
+        for j in range(n_symbols):
+            ip, length = IMAGE_SYMBOL.unpack_from(view, i)
+            i += IMAGE_SYMBOL.size
+            vm.symbols[str(view[i:i + length], 'utf-8')] = ip
+            i += length
+        for j in range(n_comments):
+            ip, length = IMAGE_COMMENT.unpack_from(view, i)
+            i += IMAGE_COMMENT.size
+            text[ip].comment = str(view[i:i + length], 'utf-8')
+            i += length
+    finally:
+        view.release()
+        image.close()
+    return vm
+
+def load_file(file_path, **kwargs):
+    """Loads a .pptasm file in either the text or the binary format."""
+    with open(file_path, mode='rb') as file:
+        magic = file.read(len(IMAGE_MAGIC))
+    if magic == IMAGE_MAGIC:
+        return load_image(file_path, **kwargs)
+    return parse_file(file_path, **kwargs)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run .pptasm files')
-    parser.add_argument('file', help='.pptasm file to run', type=str)
+    parser.add_argument('file', help='.pptasm or .pptbin file to run', type=str)
+    parser.add_argument('--jit', help='compile basic blocks to Python functions', action='store_true')
+    parser.add_argument('--lazy-flags', help='only compute flags when they are read', action='store_true')
+    parser.add_argument('--fast', help='skip the invariant checks', action='store_true')
+    parser.add_argument('--alu-tables', help='look up byte ALU results in precomputed tables', action='store_true')
+    parser.add_argument('--profile', help='print a hot-spot report to stderr', action='store_true')
+    parser.add_argument('--profile-json', help='write execution counts to this JSON file', type=str)
+    parser.add_argument('--trace', help='keep the last N steps and print them to stderr on a fault', type=int, metavar='N')
+    parser.add_argument('--record', help='log the results of RAND and the input read to this file', type=str)
+    parser.add_argument('--replay', help='take RAND results and input from a log written by --record', type=str)
+    parser.add_argument('--checkpoint-every', help='with --record, save a checkpoint in the log every N steps '
+                        '(the machine\'s state, compressed: usually a few hundred bytes each)',
+                        type=int, metavar='N')
+    parser.add_argument('--from-checkpoint', help='with --replay, resume from the log\'s checkpoint with index K '
+                        '(-1 for the last)', type=int, metavar='K')
     args = parser.parse_args()
-    vm = parse_file(args.file)
-    while True:
-        try:
-            vm.step()
-        except SystemExit:
-            exit(0)
-        except:
-            raise Exception('Error while running line %s' % vm.ip)
+    profiling = args.profile or args.profile_json
+    if profiling and args.jit:
+        parser.error('--profile and --profile-json cannot be used with --jit')
+    vm = load_file(args.file, jit=args.jit, lazy_flags=args.lazy_flags, checked=not args.fast,
+                   alu_tables=args.alu_tables)
+    if profiling:
+        from pptprof import Profiler
+        profiler = Profiler(vm)
+    if args.trace:
+        from ppttrace import Trace
+        trace = Trace(vm, args.trace)
+    if args.record:
+        from pptreplay import Recorder
+        recorder = Recorder(vm)
+    if args.checkpoint_every and not args.record:
+        parser.error('--checkpoint-every needs --record')
+    if args.from_checkpoint is not None and not args.replay:
+        parser.error('--from-checkpoint needs --replay')
+    if args.replay:
+        from pptreplay import Replayer
+        Replayer.load(vm, args.replay, args.from_checkpoint)
+    result = vm.run(args.checkpoint_every)
+    while args.checkpoint_every and result.status == BUDGET_EXHAUSTED:
+        recorder.checkpoint()
+        result = vm.run(args.checkpoint_every)
+    if args.record:
+        recorder.save(args.record)
+    if args.profile:
+        print(profiler.report(), file=sys.stderr)
+    if args.profile_json:
+        profiler.dump(args.profile_json)
+    if result.status == FAULT:
+        if args.trace:
+            print(trace.dump(), file=sys.stderr)
+        raise Exception('Error while running line %s' % uint_to_word(result.ip)) from result.error
\ No newline at end of file
@@ -1,6 +1,18 @@
 import unittest
+import random
+import tempfile
+import os
 import pptvm
 import copy
+import io
+from ppttestutils import make_machine
+
+# Jumps back to 0 forever. JMP needs SP in the data segment.
+COUNT_PROGRAM = '''
+    CLEARL1
+    CLEARH1
+    EXEC JMP
+'''
 
 class TestBitConversions(unittest.TestCase):
     def test_byte_v_uint(self):
@@ -40,14 +52,553 @@ class TestBitConversions(unittest.TestCase):
 
 class TestMachineInstructions(unittest.TestCase):
     def setUp(self):
-        const_dict = {pptvm.uint_to_word(i+2**15): pptvm.uint_to_word(i*10) for i in range(20)}
-        data_dict = {pptvm.uint_to_word(i): pptvm.uint_to_word(i*20) for i in range(20)}
-        pptasm_dict = {
-            'code': {},
-            'const': const_dict,
-            'data': data_dict,
-        }
-        self.machine_state = pptvm.MachineState(pptasm_dict)
+        self.machine_state = pptvm.MachineState([], data=b'\x05\x06', const=b'hi\x00')
+
+    def test_register_views(self):
+        m = self.machine_state
+        m.regs['AL'].value = 5
+        m.m1.assign(0x1234)
+        self.assertEqual(m.regs['AL'].bits, '00000101')
+        self.assertEqual(m.m1.high, 0x12)
+        self.assertEqual(m.m1.low, 0x34)
+        self.assertEqual(m.m1.bits, '0001001000110100')
+        self.assertEqual(m.regfile[pptvm.REG_INDEX['M1L']], 0x34)
+
+    def test_addw(self):
+        m = self.machine_state
+        m.m1.assign(0xffff)
+        m.m2.assign(0x0001)
+        m.exec_addw()
+        self.assertEqual(m.m3.read(), 0)
+        self.assertTrue(m.flags.carry)
+        self.assertTrue(m.flags.zero)
+        self.assertFalse(m.flags.sign)
+
+    def test_subb(self):
+        m = self.machine_state
+        m.m1.low = 3
+        m.m2.low = 5
+        m.exec_subb()
+        self.assertEqual(m.m3.low, 0xfe)
+        self.assertTrue(m.flags.carry)
+        self.assertTrue(m.flags.sign)
+        self.assertFalse(m.flags.zero)
+
+    def test_neg(self):
+        # The two's complement, not the bitwise NOT (0xfa)
+        m = self.machine_state
+        m.m1.low = 5
+        m.exec_negb()
+        self.assertEqual(m.m3.low, 0xfb)
+        self.assertTrue(m.flags.sign)
+        m.m1.assign(5)
+        m.exec_negw()
+        self.assertEqual(m.m3.read(), 0xfffb)
+        m.m1.assign(0)
+        m.exec_negw()
+        self.assertEqual(m.m3.read(), 0)
+        self.assertTrue(m.flags.zero)
+
+    def test_memory(self):
+        m = self.machine_state
+        m.m1.assign(0x8001)
+        m.exec_smp()
+        m.exec_rmem()
+        self.assertEqual(m.m3.low, 6)
+        m.m2.low = 7
+        m.exec_wmem()
+        self.assertEqual(m.memory.read(0x8001), 7)
+        m.exec_dmp()
+        m.exec_rmem()
+        self.assertEqual(m.m3.low, 5)
+        m.mp = 1
+        m.exec_rmem()
+        self.assertEqual(m.m3.low, ord('i'))
+        self.assertEqual(m.memory.dump(0, 3), b'hi\x00')
+        self.assertEqual(m.memory.inspect(0x8000, 2), '8000  05 07  ..')
+        with self.assertRaises(AssertionError):
+            m.exec_wmem()
+        m.mp = 0x8000
+        m.exec_rmemw()
+        self.assertEqual(m.m3.read(), 0x0705)
+        m.m3.assign(0x1234)
+        m.mp = 0x8001
+        m.exec_wmemw()
+        self.assertEqual(m.memory.dump(0x8000, 3), b'\x05\x34\x12')
+        m.mp = 0xffff
+        with self.assertRaises(AssertionError):
+            m.exec_wmemw()
+        self.assertEqual(m.memory.read(0xffff), 0x34)
+
+    def test_sarw(self):
+        # Fills from the sign bit of the high byte, not of the low byte
+        m = self.machine_state
+        m.m1.assign(0x8002)
+        m.exec_sarw()
+        self.assertEqual(m.m3.read(), 0xc001)
+        self.assertFalse(m.flags.carry)
+        m.m1.assign(0x0081)
+        m.exec_sarw()
+        self.assertEqual(m.m3.read(), 0x0040)
+        self.assertTrue(m.flags.carry)
+
+
+class TestLazyFlags(unittest.TestCase):
+    def test_matches_eager_flags(self):
+        ops = [
+            'exec_addb', 'exec_adcw', 'exec_subw', 'exec_sbbb', 'exec_cmpb', 'exec_andw',
+            'exec_xorb', 'exec_incb', 'exec_decw', 'exec_negb', 'exec_negw', 'exec_shlw',
+            'exec_sarb', 'exec_mulb', 'exec_clc', 'exec_cmc', 'exec_va', 'exec_vg', 'exec_vl']
+        flag_names = ['verdict', 'carry', 'zero', 'sign', 'overflow']
+        rng = random.Random(5)
+        eager = pptvm.MachineState([])
+        lazy = pptvm.MachineState([], lazy_flags=True)
+        self.assertIsInstance(lazy.flags, pptvm.LazyFlags)
+        for i in range(5000):
+            regs = bytes(rng.choice([0, 1, 0x7f, 0x80, 0xff, rng.randrange(256)]) for r in pptvm.REG_NAMES)
+            eager.regfile[:] = regs
+            lazy.regfile[:] = regs
+            op = rng.choice(ops)
+            getattr(eager, op)()
+            getattr(lazy, op)()
+            self.assertEqual(eager.regfile, lazy.regfile)
+            if rng.random() < 0.5:
+                for f in flag_names:
+                    self.assertEqual(getattr(eager.flags, f), getattr(lazy.flags, f), op)
+
+class TestDecodedProgram(unittest.TestCase):
+    def test_step(self):
+        m = make_machine('''
+            CONSTH 00000001
+            CONSTL 00000010
+            STOREH AH
+            STOREL AL
+            LOAD1H AH
+            LOAD1L AL
+            EXEC INCW
+        ''')
+        for i in range(7):
+            m.step()
+        self.assertEqual(m.ip, 7)
+        self.assertEqual(m.ip_bits, '0000000000000111')
+        self.assertEqual(m._read_reg('A'), 0x0102)
+        self.assertEqual(m.m3.read(), 0x0103)
+        with self.assertRaises(Exception):
+            m.step()
+
+    def test_jmp(self):
+        m = make_machine('''
+            CONSTH 10000000
+            STOREH SPH
+            CONSTH 00000000
+            CONSTL 00000000
+            LOAD1H M3H
+            LOAD1L M3L
+            EXEC JMP
+        ''')
+        for i in range(7):
+            m.step()
+        self.assertEqual(m.ip, 0)
+
+    def test_parse_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'test.pptasm')
+            with open(path, 'wt') as f:
+                f.write('''text:
+    0000000000000000    CONSTL  00000101  # movw $5,%ax
+    0000000000000001    STOREL  AL
+
+data:
+    1000000000000000    00000001
+    1000000000000001    00000010
+
+const:
+    0000000000000000    01101000
+''')
+            m = pptvm.parse_file(path)
+        self.assertEqual(m.instructions[0].comment, 'movw $5,%ax')
+        self.assertIsNone(m.instructions[1].comment)
+        m.step()
+        m.step()
+        self.assertEqual(m.regs['AL'].value, 5)
+        self.assertEqual(m.memory.dump(0x8000, 3), b'\x01\x02\x00')
+        self.assertEqual(m.memory.read(0), ord('h'))
+        self.assertEqual(m.symbols, {})
+
+    def test_parse_symbols(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'test.pptasm')
+            with open(path, 'wt') as f:
+                f.write('''text:
+    0000000000000000    EXEC    HLT
+    0000000000000001    EXEC    HLT
+
+data:
+
+const:
+
+symbols:
+    0000000000000001    main_
+''')
+            m = pptvm.parse_file(path)
+        self.assertEqual(m.symbols, {'main_': 1})
+
+class TestRunLoop(unittest.TestCase):
+    def test_run(self):
+        m = make_machine('''
+            CONSTL 00000011
+            STOREL AL
+            EXEC HLT
+        ''')
+        result = m.run(max_steps=1)
+        self.assertEqual((result.status, result.steps, result.ip), (pptvm.BUDGET_EXHAUSTED, 1, 1))
+        result = m.run(until_ip=2)
+        self.assertEqual((result.status, result.steps, result.ip), (pptvm.REACHED_IP, 1, 2))
+        result = m.run()
+        self.assertEqual((result.status, result.steps, result.ip), (pptvm.HALTED, 1, 2))
+        self.assertTrue(m.halted)
+        self.assertEqual(m.regfile[pptvm.R_AL], 3)
+        self.assertEqual(m.run().status, pptvm.HALTED)
+
+    def test_run_fault(self):
+        m = make_machine('''
+            CLEARL1
+            EXEC DIVB
+        ''')
+        result = m.run()
+        self.assertEqual((result.status, result.steps, result.ip), (pptvm.FAULT, 1, 1))
+        self.assertIsInstance(result.error, ZeroDivisionError)
+        self.assertFalse(m.halted)
+
+class TestSnapshot(unittest.TestCase):
+    def test_snapshot(self):
+        m = make_machine('''
+            CONSTH 10000000
+            STOREH SPH
+            CONSTL 00000111
+            STOREL AL
+            EXEC STC
+            LOAD1L AL
+            EXEC ADCB
+            STOREL AL
+            LOAD1H SPH
+            CONSTL 00010000
+            LOAD1L M3L
+            EXEC SMP
+            LOAD2L AL
+            EXEC WMEM
+            EXEC HLT
+        ''')
+        m.symbols = {'store': 12}
+        m.run(until_ip=5)
+        snapshot = m.snapshot()
+        m.run()
+        self.assertTrue(m.halted)
+        self.assertEqual(m.data[0x10], 8)
+        m.restore(snapshot)
+        self.assertEqual((m.ip, m.halted, m.flags.carry), (5, False, True))
+        self.assertEqual(m.data[0x10], 0)
+        copy = pptvm.MachineState.from_snapshot(snapshot, lazy_flags=True)
+        self.assertIs(copy.const, m.const)
+        self.assertIs(copy.memory.const, m.const)
+        copy.add_breakpoint('store')
+        self.assertEqual((copy.run().status, copy.ip), (pptvm.BREAKPOINT, 12))
+        copy.remove_breakpoint('store')
+        for vm in (m, copy):
+            vm.run()
+            self.assertEqual(vm.regfile[pptvm.R_AL], 8)
+        self.assertEqual(copy.snapshot().state, m.snapshot().state)
+
+class TestImage(unittest.TestCase):
+    def test_load_image(self):
+        text = [
+            ('CONSTL', '00000101', 'movw $5,%ax'),
+            ('STOREL', 'AL', None),
+            ('CLEARH3', None, None),
+            ('EXEC', 'HLT', 'hlt')]
+        image = pptvm.pack_image(text, b'\x01\x02', b'h', {'main_': 0})
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'test.pptbin')
+            with open(path, 'wb') as f:
+                f.write(image)
+            m = pptvm.load_file(path)
+        self.assertEqual([(i.cmd, i.args, i.comment) for i in m.instructions], [
+            ('CONSTL', ['00000101'], 'movw $5,%ax'),
+            ('STOREL', ['AL'], None),
+            ('CLEARH3', [], None),
+            ('EXEC', ['HLT'], 'hlt')])
+        self.assertEqual(m.symbols, {'main_': 0})
+        self.assertEqual(m.memory.dump(0x8000, 3), b'\x01\x02\x00')
+        self.assertEqual(m.memory.read(0), ord('h'))
+        self.assertEqual(m.run().status, pptvm.HALTED)
+        self.assertEqual(m.regfile[pptvm.R_AL], 5)
+        with self.assertRaises(Exception):
+            pptvm.pack_image([('EXEC', 'FOO', None)], b'', b'', {})
+
+    def test_long_symbols(self):
+        # Names longer than a byte can count still load, and ones too long
+        # for the image are refused by name rather than by struct
+        name = 'L$' + 'x' * 300
+        image = pptvm.pack_image([('EXEC', 'HLT', None)], b'', b'', {name: 0})
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'test.pptbin')
+            with open(path, 'wb') as f:
+                f.write(image)
+            self.assertEqual(pptvm.load_file(path).symbols, {name: 0})
+        with self.assertRaisesRegex(Exception, 'too long'):
+            pptvm.pack_image([('EXEC', 'HLT', None)], b'', b'', {'x' * 70000: 0})
+
+class TestIOChannel(unittest.TestCase):
+    def test_io(self):
+        m = make_machine('''
+            EXEC GETS
+            EXEC PUTS
+            EXEC PUTC
+            EXEC GETINT
+            EXEC PUTINT
+            EXEC HLT
+        ''')
+        out = io.StringIO()
+        m.io = pptvm.IOChannel(out=out, inp=io.StringIO('-3\n'), flush_size=100)
+        m.io.feed('hello\n')
+        m.regfile[pptvm.R_AH] = 0x80
+        m.run(max_steps=2)
+        self.assertEqual(m.memory.dump(0x8000, 6), b'hello\x00')
+        self.assertEqual(m.mp, 0x8005)
+        self.assertEqual(out.getvalue(), 'hello')
+        m.run(max_steps=1)
+        m.io.write('x' * 200)
+        self.assertEqual(out.getvalue(), 'hello\x00' + 'x' * 200)
+        self.assertEqual(m.run().status, pptvm.HALTED)
+        self.assertEqual(out.getvalue(), 'hello\x00' + 'x' * 200 + '-3')
+        with self.assertRaises(EOFError):
+            m.io.readline()
+
+    def test_puts_across_segments(self):
+        m = make_machine('''
+            EXEC PUTS
+        ''')
+        out = io.StringIO()
+        m.io = pptvm.IOChannel(out=out)
+        m.const[-2:] = b'ab'
+        m.data[:2] = b'c\x00'
+        m.regfile[pptvm.R_AH] = 0x7f
+        m.regfile[pptvm.R_AL] = 0xfe
+        m.run()
+        self.assertEqual(out.getvalue(), 'abc')
+        self.assertEqual(m.mp, 0x8001)
+
+    def test_io_wait(self):
+        m = make_machine('''
+            EXEC GETINT
+            EXEC PUTINT
+            EXEC HLT
+        ''')
+        m.io = pptvm.IOChannel(out=io.StringIO(), wait=True)
+        result = m.run()
+        self.assertEqual((result.status, result.steps, m.ip), (pptvm.WAITING, 0, 0))
+        m.io.feed('5')
+        self.assertEqual(m.run().status, pptvm.HALTED)
+        self.assertEqual(m.io.out.getvalue(), '5')
+
+class TestCheckedMode(unittest.TestCase):
+    def test_checked(self):
+        program = '''
+            CONSTL 00000001
+            STOREL SPL
+            CONSTL 00000111
+            LOAD1L M3L
+            EXEC JMP
+        '''
+        m = make_machine(program)
+        self.assertEqual(m.run().ip, 2)
+        m = pptvm.MachineState(m.instructions, checked=False)
+        result = m.run(max_steps=5)
+        self.assertEqual((result.status, m.ip), (pptvm.BUDGET_EXHAUSTED, 7))
+        m = make_machine(program.replace('00000001', '00000000'))
+        m.regfile[pptvm.R_SPH] = 0x80
+        result = m.run()
+        self.assertEqual((result.status, result.ip), (pptvm.FAULT, 4))
+        self.assertIsInstance(result.error, AssertionError)
+
+class TestBreakpoints(unittest.TestCase):
+    def test_breakpoints(self):
+        # Writes M2L to 0x8003, 0x8004, ... forever
+        program = make_machine('''
+            CONSTH 10000000
+            CONSTL 00000011
+            LOAD1H M3H
+            LOAD1L M3L
+            EXEC SMP
+            EXEC WMEM
+            EXEC IMP
+            CONSTH 00000000
+            CONSTL 00000101
+            LOAD1H M3H
+            LOAD1L M3L
+            EXEC JMP
+        ''').instructions
+        for jit in [False, True]:
+            m = pptvm.MachineState(program, jit=jit)
+            m.regfile[pptvm.R_SPH] = 0x80
+            m.symbols = {'loop': 5}
+            code = m.code
+            m.add_breakpoint('loop')
+            result = m.run()
+            self.assertEqual((result.status, result.steps, result.ip), (pptvm.BREAKPOINT, 5, 5))
+            result = m.run()
+            self.assertEqual((result.status, result.steps, result.ip), (pptvm.BREAKPOINT, 7, 5))
+            self.assertEqual(m.mp, 0x8004)
+            m.remove_breakpoint(5)
+            m.add_watchpoint(0x8006)
+            m.add_watchpoint(0x8000, read=True, write=False)
+            result = m.run()
+            self.assertEqual((result.status, result.steps, result.ip), (pptvm.WATCHPOINT, 15, 6))
+            self.assertEqual(result.watch, (0x8006, 'write'))
+            m.remove_watchpoint(0x8006)
+            m.remove_watchpoint(0x8000)
+            self.assertEqual(m.code, code)
+            self.assertNotIn('lookup', vars(m.jit) if jit else {})
+            self.assertEqual(m.run(max_steps=70).status, pptvm.BUDGET_EXHAUSTED)
+            self.assertEqual(m.mp, 0x8010)
+
+    def test_breakpoint_at_start(self):
+        # A fresh run stops at a breakpoint on its first op, and only the
+        # run resuming from it steps over it
+        for jit in [False, True]:
+            m = make_machine(COUNT_PROGRAM, regs={'SPH': 0x80}, jit=jit)
+            m.add_breakpoint(0)
+            result = m.run(max_steps=10)
+            self.assertEqual((result.status, result.steps, result.ip), (pptvm.BREAKPOINT, 0, 0))
+            result = m.run(max_steps=10)
+            self.assertEqual((result.status, result.steps, result.ip), (pptvm.BREAKPOINT, 3, 0))
+            m.ip = 1
+            m.run(max_steps=2)
+            self.assertEqual(m.run(max_steps=10).status, pptvm.BREAKPOINT)
+
+    def test_breakpoints_keep_wrappers(self):
+        # Removing the last breakpoint keeps a profiler attached after it
+        import pptprof
+        m = make_machine(COUNT_PROGRAM, regs={'SPH': 0x80})
+        m.add_breakpoint(1)
+        profiler = pptprof.Profiler(m)
+        m.remove_breakpoint(1)
+        m.run(max_steps=6)
+        self.assertEqual(profiler.total(), 6)
+        profiler.detach()
+        m.run(max_steps=6)
+        self.assertEqual(profiler.total(), 6)
+
+    def test_breakpoints_new_jit(self):
+        # Breakpoints hold when the JIT is swapped, and leave both JITs alone
+        import pptjit
+        m = make_machine(COUNT_PROGRAM, regs={'SPH': 0x80}, jit=True)
+        old_jit = m.jit
+        m.add_breakpoint(2)
+        m.jit = pptjit.Jit(m)
+        result = m.run(max_steps=10)
+        self.assertEqual((result.status, result.ip), (pptvm.BREAKPOINT, 2))
+        m.remove_breakpoint(2)
+        self.assertEqual(m.run(max_steps=7).status, pptvm.BUDGET_EXHAUSTED)
+        self.assertEqual(m.ip, 0)
+        self.assertNotIn('lookup', vars(m.jit))
+        self.assertNotIn('lookup', vars(old_jit))
+
+class TestExtendedIsa(unittest.TestCase):
+    def test_checked_calls(self):
+        # Only a checked machine faults on a call or return out of the text,
+        # as compiled blocks do
+        for ops, ip in [('EXEC CALLW', 6), ('EXEC PUSHW\nEXEC RETW', 7)]:
+            program = '''
+                CONSTH 10000000
+                STOREH SPH
+                CONSTL 00010000
+                STOREL SPL
+                CONSTL 00100000
+                LOAD1L M3L
+            ''' + ops
+            result = make_machine(program).run()
+            self.assertEqual((result.status, result.ip), (pptvm.FAULT, ip))
+            self.assertIsInstance(result.error, AssertionError)
+            m = make_machine(program, checked=False)
+            result = m.run(max_steps=ip + 1)
+            self.assertEqual((result.status, m.ip), (pptvm.BUDGET_EXHAUSTED, 0x20))
+
+    def test_stack_ops(self):
+        # Pushes 0x1234, calls 16, which returns, then pops it into M3
+        program = make_machine('''
+            CONSTH 10000000
+            CONSTL 00010000
+            STOREH SPH
+            STOREL SPL
+            CONSTH 00010010
+            CONSTL 00110100
+            LOAD1H M3H
+            LOAD1L M3L
+            EXEC PUSHW
+            CONSTH 00000000
+            CONSTL 00010000
+            LOAD1H M3H
+            LOAD1L M3L
+            EXEC CALLW
+            EXEC POPW
+            EXEC HLT
+            EXEC RETW
+        ''').instructions
+        for jit in [False, True]:
+            m = pptvm.MachineState(program, jit=jit)
+            result = m.run()
+            self.assertEqual((result.status, result.steps, result.ip), (pptvm.HALTED, 17, 15))
+            self.assertEqual((m.m3.read(), m._read_reg('SP')), (0x1234, 0x8010))
+            self.assertEqual(m.memory.dump(0x800c, 4), bytes([14, 0, 0x34, 0x12]))
+            m = pptvm.MachineState(program, jit=jit)
+            m.add_watchpoint(0x800d)
+            m.add_watchpoint(0x800f, read=True, write=False)
+            result = m.run()
+            self.assertEqual((result.status, result.steps, result.ip), (pptvm.WATCHPOINT, 14, 16))
+            self.assertEqual(result.watch, (0x800d, 'write'))
+            result = m.run()
+            self.assertEqual((result.status, result.steps, result.ip), (pptvm.WATCHPOINT, 2, 15))
+            self.assertEqual(result.watch, (0x800f, 'read'))
+
+    def test_stack_wraps(self):
+        # A pop at 0xffff takes its high byte from address 0, and a push that
+        # would write there faults without writing anything
+        for jit in [False, True]:
+            m = make_machine('''
+                EXEC POPW
+                EXEC HLT
+            ''', regs={'SPH': 0xff, 'SPL': 0xff}, const=b'\x12', checked=False, jit=jit)
+            m.data[0x7fff] = 0x34
+            self.assertEqual(m.run().status, pptvm.HALTED)
+            self.assertEqual((m.m3.read(), m._read_reg('SP')), (0x1234, 0x0001))
+            m = make_machine('''
+                EXEC PUSHW
+                EXEC HLT
+            ''', regs={'SPH': 0x00, 'SPL': 0x01}, checked=False, jit=jit)
+            self.assertEqual(m.run().status, pptvm.FAULT)
+            self.assertEqual((m._read_reg('SP'), m.data[0x7fff]), (0x0001, 0))
+
+    def test_branch_ops(self):
+        # Each compare-and-branch op jumps (to 0, in M3) and leaves the flags
+        # like the compare, verdict and EXEC JV it stands for
+        rng = random.Random(25)
+        for name, (compare, condition, negate) in pptvm.BRANCH_OPS.items():
+            unfused = ['EXEC ' + compare, 'EXEC V' + condition] + ['EXEC NV'] * negate
+            unfused += ['LOAD1H M3H', 'LOAD1L M3L', 'EXEC JV']
+            for i in range(20):
+                regs = bytearray(rng.randrange(256) for r in pptvm.REG_NAMES)
+                regs[pptvm.R_M2L] = rng.choice([regs[pptvm.R_M1L], regs[pptvm.R_M2L]])
+                regs[pptvm.R_M3H] = regs[pptvm.R_M3L] = 0
+                regs[pptvm.R_SPL] &= 0xfe
+                states = []
+                for program in ['EXEC ' + name, '\n'.join(unfused)]:
+                    for jit in [False, True]:
+                        m = pptvm.MachineState(make_machine(program).instructions, jit=jit)
+                        m.regfile[:] = regs
+                        m.run(max_steps=len(m.code))
+                        states.append((m.ip == 0, [getattr(m.flags, f) for f in pptvm.FLAG_NAMES]))
+                self.assertEqual(states, [states[0]] * 4, name)
 
 
 if __name__ == '__main__':